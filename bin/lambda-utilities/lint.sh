@@ -32,7 +32,7 @@ pip install -r requirements.txt > /dev/null
 
 files_to_format=$(
   git ls-files "$ROOT_DIR" --full-name |
-     grep '.*\(src\).*\.py')
+     grep '.*\(src\|git2s3_sync/lambda\).*\.py')
 
 cd "$ROOT_DIR"
 if [[ ${1:-''} == "--fix" ]]; then
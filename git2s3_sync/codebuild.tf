@@ -29,9 +29,18 @@ data "aws_iam_policy_document" "codebuild_base" {
   statement {
     sid    = "CodeBuildS3OutputBucketAccess"
     effect = "Allow"
-    actions = [
-      "s3:PutObject"
-    ]
+    actions = concat(
+      [
+        "s3:PutObject"
+      ],
+      # Reading the previous ZIP file and its manifest, and copying from it.
+      # Without ListBucket, S3 reports missing objects as 403s, not 404s.
+      var.sync_mode == "delta" ? [
+        "s3:GetObject",
+        "s3:ListBucket",
+        "s3:AbortMultipartUpload"
+      ] : []
+    )
     resources = [
       aws_s3_bucket.codebuild_output.arn,
       "${aws_s3_bucket.codebuild_output.arn}/*"
@@ -137,6 +146,16 @@ resource "aws_codebuild_project" "git2s3" {
     compute_type = "BUILD_GENERAL1_SMALL"
     image        = "aws/codebuild/standard:4.0"
     type         = "LINUX_CONTAINER"
+
+    environment_variable {
+      name  = "SYNC_MODE"
+      value = var.sync_mode
+    }
+
+    environment_variable {
+      name  = "DELTA_SYNC_SCRIPT_URI"
+      value = var.sync_mode == "delta" ? "s3://${aws_s3_bucket.codebuild_output.id}/${aws_s3_object.delta_sync_script[0].key}" : ""
+    }
   }
 
   source {
@@ -152,3 +171,14 @@ resource "aws_codebuild_project" "git2s3" {
   }
 }
 
+# Script run by buildspec.yml to publish in delta mode. Kept under a prefix no
+# GitHub owner can have, so it can't collide with a published repo.
+resource "aws_s3_object" "delta_sync_script" {
+  count = var.sync_mode == "delta" ? 1 : 0
+
+  bucket      = aws_s3_bucket.codebuild_output.id
+  key         = "_git2s3/delta_sync.py"
+  source      = "${path.module}/lambda/delta_sync.py"
+  source_hash = filemd5("${path.module}/lambda/delta_sync.py")
+}
+
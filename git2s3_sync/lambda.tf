@@ -8,12 +8,66 @@ data "aws_iam_policy_document" "lambda_access" {
     effect = "Allow"
     actions = [
       "codebuild:BatchGetBuilds",
-      "codebuild:StartBuild"
+      "codebuild:StartBuild",
+      "codebuild:StopBuild"
     ]
     resources = [
       aws_codebuild_project.git2s3.arn
     ]
   }
+
+  dynamic "statement" {
+    for_each = var.webhook_secret_arn == "" ? [] : [1]
+    content {
+      sid    = "LambdaWebhookSecretAccess"
+      effect = "Allow"
+      actions = [
+        "secretsmanager:GetSecretValue"
+      ]
+      resources = [
+        var.webhook_secret_arn
+      ]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = var.build_table_enabled ? [1] : []
+    content {
+      sid    = "LambdaDynamoDBBuilds"
+      effect = "Allow"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+      ]
+      resources = [
+        aws_dynamodb_table.builds[0].arn
+      ]
+    }
+  }
+}
+
+# Latest build started for each repo and ref, used to skip pushes of commits
+# that are already built and stop builds of commits that have been superseded
+resource "aws_dynamodb_table" "builds" {
+  count = var.build_table_enabled ? 1 : 0
+
+  name         = "${var.git2s3_project_name}-builds"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "ref"
+
+  attribute {
+    name = "ref"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires"
+    enabled        = true
+  }
+
+  server_side_encryption {
+    enabled = true
+  }
 }
 
 module "lambda_git2s3" {
@@ -26,11 +80,13 @@ module "lambda_git2s3" {
   source_code_filename = "lambda_function.py"
   source_dir           = "${path.module}/lambda/"
   runtime              = "python3.12"
-  timeout              = 900
+  timeout              = 30
   memory_size          = 128
 
   environment_variables = {
     codebuild_project_name = aws_codebuild_project.git2s3.name
+    build_table            = var.build_table_enabled ? aws_dynamodb_table.builds[0].name : ""
+    webhook_secret_id      = var.webhook_secret_arn
   }
 
   cloudwatch_retention_days = var.cloudwatch_retention_days
@@ -39,3 +95,66 @@ module "lambda_git2s3" {
 
   lambda_iam_policy_document = data.aws_iam_policy_document.lambda_access.json
 }
+
+# Builds are tracked when CodeBuild reports they've finished, rather than by
+# module.lambda_git2s3 polling them until they do
+
+data "aws_iam_policy_document" "lambda_builds_access" {
+  statement {
+    sid    = "LambdaCodeBuildAccess"
+    effect = "Allow"
+    actions = [
+      "codebuild:BatchGetBuilds"
+    ]
+    resources = [
+      aws_codebuild_project.git2s3.arn
+    ]
+  }
+}
+
+module "lambda_git2s3_builds" {
+  source = "github.com/18F/identity-terraform//lambda_function?ref=026f69d0a5e2b8af458888a5f21a72d557bbe1fe"
+  #source = "../lambda_function"
+
+  region                = data.aws_region.current.region
+  function_name         = "${var.git2s3_project_name}-builds"
+  description           = "Record the outcome of ${var.git2s3_project_name} CodeBuild project builds"
+  source_code_filename  = "lambda_function.py"
+  handler_function_name = "build_state_change_handler"
+  source_dir            = "${path.module}/lambda/"
+  runtime               = "python3.12"
+  timeout               = 30
+  memory_size           = 128
+
+  cloudwatch_retention_days = var.cloudwatch_retention_days
+  insights_enabled          = false
+  alarm_actions             = []
+
+  lambda_iam_policy_document = data.aws_iam_policy_document.lambda_builds_access.json
+}
+
+resource "aws_cloudwatch_event_rule" "codebuild_state_change" {
+  name        = "${var.git2s3_project_name}-build-state-change"
+  description = "Finished builds of the ${var.git2s3_project_name} CodeBuild project"
+  event_pattern = jsonencode({
+    source      = ["aws.codebuild"]
+    detail-type = ["CodeBuild Build State Change"]
+    detail = {
+      project-name = [aws_codebuild_project.git2s3.name]
+      build-status = ["SUCCEEDED", "FAILED", "FAULT", "STOPPED", "TIMED_OUT"]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "codebuild_state_change" {
+  rule = aws_cloudwatch_event_rule.codebuild_state_change.name
+  arn  = module.lambda_git2s3_builds.lambda_arn
+}
+
+resource "aws_lambda_permission" "codebuild_state_change" {
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = module.lambda_git2s3_builds.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.codebuild_state_change.arn
+}
@@ -0,0 +1,473 @@
+"""
+Publishes a ZIP file of a git checkout to S3, reusing the unchanged parts of
+the previously published ZIP file, so that a push changing a few files of a
+large repo doesn't mean compressing and uploading all of it again.
+
+Run by the CodeBuild project (see buildspec.yml) when the sync_mode variable
+is "delta", from the root of the cloned repo:
+
+  python3 delta_sync.py --bucket OUTPUT_BUCKET --key OUTPUT_BUCKET_PATH/KEY.zip
+
+Alongside the ZIP file, a manifest (KEY.zip.manifest.json) records the git
+blob ID of every file it holds. The next sync compares those to the blob IDs
+of the new commit's tree to find the changed files, and:
+
+1. Copies the entries of unchanged files from the old ZIP file as they are,
+   without decompressing or compressing them again.
+2. Compresses only the new and changed files.
+3. Uploads the new ZIP file with a multipart upload, in which long runs of
+   unchanged entries are copied from the old object within S3
+   (UploadPartCopy), so only the changed bytes leave the build.
+
+Without a manifest, or if the published ZIP file doesn't match its manifest
+(e.g. it was last published by a full sync), every file is compressed and
+uploaded. With --local-store DIR, a directory stands in for the bucket.
+
+Prints one JSON summary of the sync.
+"""
+
+from abc import ABC, abstractmethod
+import argparse
+import copy
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+# S3 multipart upload limits: every part but the last must be at least 5 MiB,
+# and no part may be over 5 GiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# Size of the parts uploaded from the build
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+# git ls-tree modes of the files that go into the ZIP file; submodules
+# (160000) are left out, as zip -r of a shallow clone leaves them empty
+FILE_MODES = {"100644": 0o100644, "100755": 0o100755, "120000": 0o120777}
+
+
+class Store(ABC):
+    """
+    Store is where ZIP files and their manifests are published.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Returns the object's contents, or None if it doesn't exist
+        """
+
+    @abstractmethod
+    def download(self, key, filename):
+        """
+        Downloads the object to filename, returning False if it doesn't exist
+        """
+
+    @abstractmethod
+    def put(self, key, data):
+        pass
+
+    @abstractmethod
+    def compose(self, key, filename, parts, source_key=None):
+        """
+        Publishes the contents of filename as key. parts is a list of
+        ("upload", start, end) ranges of filename to upload, and ("copy",
+        start, end, source_start) ranges whose bytes are the same as those of
+        source_key from source_start, to copy instead.
+        """
+
+
+def is_missing(error):
+    """
+    Returns whether a boto3 error means the object doesn't exist: GetObject
+    raises NoSuchKey, while download_file's HeadObject only gets a 404
+    """
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ["404", "NoSuchKey"]
+
+
+class S3Store(Store):
+    def __init__(self, bucket, s3_client=None):
+        if s3_client is None:
+            from boto3 import client
+
+            s3_client = client(service_name="s3")
+        self.bucket = bucket
+        self.s3_client = s3_client
+
+    def get(self, key):
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except Exception as e:
+            if is_missing(e):
+                return None
+            raise
+
+    def download(self, key, filename):
+        try:
+            self.s3_client.download_file(self.bucket, key, filename)
+        except Exception as e:
+            if is_missing(e):
+                return False
+            raise
+        return True
+
+    def put(self, key, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def compose(self, key, filename, parts, source_key=None):
+        if not any(part[0] == "copy" for part in parts):
+            # Nothing to copy, so let boto3 split it into parts (or not)
+            self.s3_client.upload_file(filename, self.bucket, key)
+            return
+
+        upload = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        upload_id = upload["UploadId"]
+        try:
+            completed = []
+            with open(filename, "rb") as f:
+                for number, part in enumerate(parts, start=1):
+                    if part[0] == "copy":
+                        _, start, end, source_start = part
+                        response = self.s3_client.upload_part_copy(
+                            Bucket=self.bucket,
+                            Key=key,
+                            UploadId=upload_id,
+                            PartNumber=number,
+                            CopySource={"Bucket": self.bucket, "Key": source_key},
+                            CopySourceRange="bytes=%d-%d"
+                            % (source_start, source_start + end - start - 1),
+                        )
+                        etag = response["CopyPartResult"]["ETag"]
+                    else:
+                        _, start, end = part
+                        f.seek(start)
+                        response = self.s3_client.upload_part(
+                            Bucket=self.bucket,
+                            Key=key,
+                            UploadId=upload_id,
+                            PartNumber=number,
+                            Body=f.read(end - start),
+                        )
+                        etag = response["ETag"]
+                    completed.append({"PartNumber": number, "ETag": etag})
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": completed},
+            )
+        except Exception:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+            raise
+
+
+class LocalStore(Store):
+    """
+    LocalStore keeps objects as files under a local directory, for trying
+    syncs out without a bucket. It builds each object from the parts it's
+    given, copying from the source object like S3 would, so a wrong part
+    plan shows up as a corrupt ZIP file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def download(self, key, filename):
+        try:
+            shutil.copyfile(self.path(key), filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, data):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        with open(self.path(key), "wb") as f:
+            f.write(data)
+
+    def compose(self, key, filename, parts, source_key=None):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        # Like S3, the source may be the object being replaced
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as out:
+            with open(filename, "rb") as f:
+                for part in parts:
+                    if part[0] == "copy":
+                        _, start, end, source_start = part
+                        with open(self.path(source_key), "rb") as source:
+                            source.seek(source_start)
+                            out.write(source.read(end - start))
+                    else:
+                        _, start, end = part
+                        f.seek(start)
+                        out.write(f.read(end - start))
+        os.replace(out.name, self.path(key))
+
+
+def list_files(source_dir):
+    """
+    Returns {path: [blob ID, mode]} for every file in the HEAD commit of the
+    git checkout in source_dir
+    """
+    output = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", "--full-tree", "HEAD"],
+        cwd=source_dir,
+        check=True,
+        capture_output=True,
+    ).stdout.decode("utf-8")
+    files = {}
+    for line in output.split("\0"):
+        if not line:
+            continue
+        info, path = line.split("\t", 1)
+        mode, object_type, blob = info.split()
+        if object_type == "blob" and mode in FILE_MODES:
+            files[path] = [blob, mode]
+    return files
+
+
+def get_commit(source_dir):
+    output = subprocess.run(
+        ["git", "log", "-1", "--format=%H %ct"],
+        cwd=source_dir,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    return output[0], int(output[1])
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_ranges(archive):
+    """
+    Returns {filename: (start, end)}, the bytes of archive (an open ZipFile)
+    holding each entry's local header and data
+    """
+    infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+    ranges = {}
+    for info, following in zip(infos, infos[1:] + [None]):
+        end = following.header_offset if following else archive.start_dir
+        ranges[info.filename] = (info.header_offset, end)
+    return ranges
+
+
+def copy_entry(archive, old_archive, info, start, end):
+    """
+    Appends the raw bytes of an entry of old_archive to archive, as they are.
+    zipfile has no public way to do this, so it uses the same bookkeeping as
+    ZipFile.write does.
+    """
+    info = copy.copy(info)
+    archive.fp.seek(archive.start_dir)
+    info.header_offset = archive.fp.tell()
+    old_archive.fp.seek(start)
+    remaining = end - start
+    while remaining:
+        chunk = old_archive.fp.read(min(remaining, 1024 * 1024))
+        archive.fp.write(chunk)
+        remaining -= len(chunk)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+
+
+def write_entry(archive, source_dir, path, mode, date_time):
+    info = zipfile.ZipInfo(path, date_time=date_time)
+    info.external_attr = FILE_MODES[mode] << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    full_path = os.path.join(source_dir, path)
+    if mode == "120000":
+        archive.writestr(info, os.readlink(full_path).encode("utf-8"))
+        return
+    with open(full_path, "rb") as f, archive.open(info, "w") as entry:
+        shutil.copyfileobj(f, entry, 1024 * 1024)
+
+
+def plan_parts(size, copies):
+    """
+    Splits a file of size bytes into multipart upload parts. copies is a
+    sorted list of (start, end, source_start) ranges that can be copied from
+    the source object; those long enough to make parts of their own are
+    copied, and everything else is uploaded.
+    """
+    parts = []
+    position = 0
+    for start, end, source_start in copies:
+        pending = start - position
+        if 0 < pending < MIN_PART_SIZE:
+            # Upload the start of the copy along with the bytes before it
+            taken = MIN_PART_SIZE - pending
+            start += taken
+            source_start += taken
+        if end - start < MIN_PART_SIZE:
+            continue
+        parts += split_range("upload", position, start)
+        parts += split_range("copy", start, end, source_start)
+        position = end
+    if position < size or not parts:
+        parts += split_range("upload", position, size)
+    return parts
+
+
+def split_range(kind, start, end, source_start=None):
+    """
+    Splits a range into parts no bigger than the part size for kind, all of
+    at least MIN_PART_SIZE (given a range at least that long)
+    """
+    length = end - start
+    if length <= 0:
+        return []
+    part_size = MAX_PART_SIZE if kind == "copy" else UPLOAD_PART_SIZE
+    count = max(1, length // part_size + (1 if length % part_size else 0))
+    if count > 1 and length // count < MIN_PART_SIZE:
+        count = max(1, length // MIN_PART_SIZE)
+    parts = []
+    for n in range(count):
+        part_start = start + length * n // count
+        part_end = start + length * (n + 1) // count
+        if kind == "copy":
+            parts.append(
+                ("copy", part_start, part_end, source_start + part_start - start)
+            )
+        else:
+            parts.append(("upload", part_start, part_end))
+    return parts
+
+
+def sync(source_dir, store, key, workdir):
+    """
+    Publishes a ZIP file of the HEAD commit of source_dir to store as key,
+    along with its manifest, and returns a summary of what was reused
+    """
+    started = time.perf_counter()
+    files = list_files(source_dir)
+    commit, commit_time = get_commit(source_dir)
+    date_time = time.gmtime(max(commit_time, 315532800))[:6]
+    manifest_key = key + MANIFEST_SUFFIX
+
+    old_filename = os.path.join(workdir, "old.zip")
+    new_filename = os.path.join(workdir, "new.zip")
+    old_manifest = None
+    data = store.get(manifest_key)
+    if data is not None:
+        old_manifest = json.loads(data)
+        if old_manifest.get("version") != MANIFEST_VERSION:
+            old_manifest = None
+    if old_manifest is not None:
+        if not store.download(key, old_filename) or (
+            file_sha256(old_filename) != old_manifest["archive_sha256"]
+        ):
+            # Published some other way since the manifest was written
+            old_manifest = None
+
+    reused = []
+    copies = []
+    with zipfile.ZipFile(new_filename, "w", zipfile.ZIP_DEFLATED) as archive:
+        if old_manifest is not None:
+            with zipfile.ZipFile(old_filename) as old_archive:
+                ranges = entry_ranges(old_archive)
+                unchanged = [
+                    info
+                    for info in old_archive.infolist()
+                    if files.get(info.filename)
+                    and old_manifest["files"].get(info.filename) == files[info.filename]
+                ]
+                # Kept in their old order, so runs of them can be copied
+                for info in sorted(unchanged, key=lambda info: info.header_offset):
+                    start, end = ranges[info.filename]
+                    new_start = archive.start_dir
+                    copy_entry(archive, old_archive, info, start, end)
+                    reused.append(info.filename)
+                    # Extend the last run if this entry followed it before too
+                    if (
+                        copies
+                        and copies[-1][1] == new_start
+                        and copies[-1][2] + new_start - copies[-1][0] == start
+                    ):
+                        copies[-1][1] = archive.start_dir
+                    else:
+                        copies.append([new_start, archive.start_dir, start])
+
+        reused_set = set(reused)
+        changed = sorted(path for path in files if path not in reused_set)
+        for path in changed:
+            write_entry(archive, source_dir, path, files[path][1], date_time)
+
+    size = os.path.getsize(new_filename)
+    parts = plan_parts(size, [tuple(c) for c in copies])
+    store.compose(key, new_filename, parts, source_key=key)
+    store.put(
+        manifest_key,
+        json.dumps(
+            {
+                "version": MANIFEST_VERSION,
+                "commit": commit,
+                "archive_sha256": file_sha256(new_filename),
+                "files": files,
+            },
+            sort_keys=True,
+        ).encode("utf-8"),
+    )
+
+    removed = 0
+    if old_manifest is not None:
+        removed = len([path for path in old_manifest["files"] if path not in files])
+    return {
+        "mode": "delta" if old_manifest is not None else "full",
+        "commit": commit,
+        "files": len(files),
+        "reused": len(reused),
+        "changed": len(changed),
+        "removed": removed,
+        "archive_bytes": size,
+        "copied_bytes": sum(p[2] - p[1] for p in parts if p[0] == "copy"),
+        "uploaded_bytes": sum(p[2] - p[1] for p in parts if p[0] == "upload"),
+        "parts": len(parts),
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--bucket")
+    parser.add_argument("--local-store")
+    parser.add_argument("--source-dir", default=".")
+    args = parser.parse_args(argv)
+    if bool(args.bucket) == bool(args.local_store):
+        parser.error("one of --bucket or --local-store is required")
+
+    if args.local_store:
+        store = LocalStore(args.local_store)
+    else:
+        store = S3Store(args.bucket)
+    with tempfile.TemporaryDirectory() as workdir:
+        result = sync(args.source_dir, store, args.key, workdir)
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import hashlib
+import io
+import json
+import os
+import random
+import subprocess
+import zipfile
+import pytest
+import delta_sync
+from delta_sync import (
+    LocalStore,
+    MAX_PART_SIZE,
+    MIN_PART_SIZE,
+    entry_ranges,
+    plan_parts,
+    sync,
+)
+
+KEY = "18F/identity-example/main/18F_identity-example.zip"
+
+
+def git(repo, *args):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="Test",
+        GIT_AUTHOR_EMAIL="test@example.com",
+        GIT_COMMITTER_NAME="Test",
+        GIT_COMMITTER_EMAIL="test@example.com",
+    )
+    return subprocess.run(
+        ["git", *args], cwd=repo, env=env, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def write(repo, path, data):
+    full_path = os.path.join(repo, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = str(tmp_path / "repo")
+    os.makedirs(repo)
+    git(repo, "init", "--quiet")
+    rng = random.Random(0)
+    for n in range(12):
+        # Incompressible, so every entry is a few KiB in the ZIP file
+        write(repo, "lib/file%02d.bin" % n, rng.randbytes(4096))
+    write(repo, "README.md", b"# Example\n" * 100)
+    write(repo, "bin/run.sh", b"#!/bin/sh\necho run\n")
+    os.chmod(os.path.join(repo, "bin/run.sh"), 0o755)
+    os.symlink("README.md", os.path.join(repo, "README"))
+    git(repo, "add", "--all")
+    git(repo, "commit", "--quiet", "--message", "First")
+    return repo
+
+
+def commit_change(repo, path, data):
+    write(repo, path, data)
+    git(repo, "commit", "--quiet", "--all", "--message", "Change %s" % path)
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def check_published(store, repo):
+    """
+    Checks the published ZIP file is intact, holds every tracked file as
+    it is in the checkout, and matches its manifest
+    """
+    with open(store.path(KEY), "rb") as f:
+        published = f.read()
+    manifest = json.loads(store.get(KEY + delta_sync.MANIFEST_SUFFIX))
+    assert manifest["archive_sha256"] == sha256(published)
+    assert manifest["commit"] == git(repo, "rev-parse", "HEAD")
+
+    with zipfile.ZipFile(store.path(KEY)) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(manifest["files"])
+        for info in archive.infolist():
+            full_path = os.path.join(repo, info.filename)
+            if os.path.islink(full_path):
+                assert archive.read(info).decode("utf-8") == os.readlink(full_path)
+                continue
+            with open(full_path, "rb") as f:
+                assert archive.read(info) == f.read()
+            assert info.external_attr >> 16 == os.stat(full_path).st_mode
+    return published
+
+
+def raw_entries(data):
+    """
+    Returns {filename: local header and data bytes} of a ZIP file's entries
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {
+            name: data[start:end]
+            for name, (start, end) in entry_ranges(archive).items()
+        }
+
+
+@pytest.mark.parametrize("min_part_size", [MIN_PART_SIZE, 1024])
+def test_sync_reuses_unchanged_entries(repo, tmp_path, monkeypatch, min_part_size):
+    # A small minimum part size makes runs of reused entries long enough to
+    # be copied from the old object, as they would be for a large repo
+    monkeypatch.setattr(delta_sync, "MIN_PART_SIZE", min_part_size)
+    store = LocalStore(str(tmp_path / "bucket"))
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+
+    first = sync(repo, store, KEY, str(workdir))
+    assert first["mode"] == "full"
+    assert first["reused"] == 0
+    assert first["changed"] == first["files"] == 15
+    old = raw_entries(check_published(store, repo))
+
+    commit_change(repo, "lib/file05.bin", b"changed\n")
+    second = sync(repo, store, KEY, str(workdir))
+    assert second["mode"] == "delta"
+    assert second["reused"] == 14
+    assert second["changed"] == 1
+    assert second["removed"] == 0
+    new = raw_entries(check_published(store, repo))
+
+    # Unchanged entries are byte for byte the old ones
+    assert new.keys() == old.keys()
+    for name in new:
+        if name == "lib/file05.bin":
+            assert new[name] != old[name]
+        else:
+            assert new[name] == old[name]
+
+    assert second["copied_bytes"] + second["uploaded_bytes"] == second["archive_bytes"]
+    if min_part_size < MIN_PART_SIZE:
+        assert second["copied_bytes"] > 0
+    else:
+        assert second["copied_bytes"] == 0
+
+
+def test_sync_removes_deleted_files(repo, tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    sync(repo, store, KEY, str(tmp_path))
+
+    git(repo, "rm", "--quiet", "lib/file00.bin")
+    git(repo, "commit", "--quiet", "--message", "Remove file00")
+    result = sync(repo, store, KEY, str(tmp_path))
+    assert result["mode"] == "delta"
+    assert result["removed"] == 1
+    assert result["reused"] == 14
+    check_published(store, repo)
+
+
+def test_sync_ignores_stale_manifest(repo, tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    sync(repo, store, KEY, str(tmp_path))
+    # Published by a full sync since the manifest was written
+    store.put(KEY, b"not the ZIP file the manifest describes")
+
+    result = sync(repo, store, KEY, str(tmp_path))
+    assert result["mode"] == "full"
+    assert result["reused"] == 0
+    check_published(store, repo)
+
+
+def check_parts(size, copies, parts):
+    # Nothing to upload only when there's nothing at all
+    assert parts or size == 0
+    position = 0
+    for n, part in enumerate(parts):
+        kind, start, end = part[:3]
+        assert start == position
+        assert end > start
+        position = end
+        if n < len(parts) - 1:
+            assert end - start >= MIN_PART_SIZE
+        assert end - start <= MAX_PART_SIZE
+        if kind == "copy":
+            source_start = part[3]
+            # Within a copyable range, at the same offset into it
+            assert any(
+                c_start <= start
+                and end <= c_end
+                and source_start - start == c_source_start - c_start
+                for c_start, c_end, c_source_start in copies
+            )
+    assert position == size
+
+
+def random_copies(rng, size):
+    copies = []
+    position = 0
+    while True:
+        position += rng.choice([0, 1, rng.randrange(MIN_PART_SIZE * 2)])
+        length = rng.choice(
+            [
+                1,
+                MIN_PART_SIZE - 1,
+                MIN_PART_SIZE,
+                MIN_PART_SIZE + 1,
+                rng.randrange(1, MIN_PART_SIZE * 3),
+                rng.randrange(1, MAX_PART_SIZE * 3),
+            ]
+        )
+        if position + length > size:
+            return copies
+        copies.append((position, position + length, rng.randrange(size)))
+        position += length
+
+
+def test_plan_parts_respects_part_sizes():
+    rng = random.Random(0)
+    for _ in range(2000):
+        size = rng.choice(
+            [
+                0,
+                rng.randrange(1, MIN_PART_SIZE * 2),
+                rng.randrange(MIN_PART_SIZE * 2, MIN_PART_SIZE * 40),
+                rng.randrange(MIN_PART_SIZE * 40, MAX_PART_SIZE * 4),
+            ]
+        )
+        copies = random_copies(rng, size)
+        check_parts(size, copies, plan_parts(size, copies))
+
+
+@pytest.mark.parametrize(
+    "size,copies",
+    [
+        (0, []),
+        (100, []),
+        (MIN_PART_SIZE * 3, [(0, MIN_PART_SIZE * 3, 0)]),
+        # Too short to copy
+        (MIN_PART_SIZE * 3, [(10, MIN_PART_SIZE - 1, 10)]),
+        # A copy right after a few uploaded bytes lends them some of its own
+        (MIN_PART_SIZE * 3, [(10, MIN_PART_SIZE * 2, 10)]),
+        (MIN_PART_SIZE * 3, [(10, MIN_PART_SIZE + 9, 10)]),
+        (
+            MIN_PART_SIZE * 4,
+            [(0, MIN_PART_SIZE, 0), (MIN_PART_SIZE + 1, MIN_PART_SIZE * 3, 5)],
+        ),
+        (MAX_PART_SIZE * 3, [(0, MAX_PART_SIZE * 2 + 1, 0)]),
+    ],
+)
+def test_plan_parts_edge_cases(size, copies):
+    check_parts(size, copies, plan_parts(size, copies))
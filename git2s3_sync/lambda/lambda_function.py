@@ -5,52 +5,331 @@
 #  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
 #  See the License for the specific language governing permissions and limitations under the License.
 
-from boto3 import client
+from abc import ABC, abstractmethod
+from boto3 import client, resource
+from bisect import bisect_right
+from functools import lru_cache
+import hashlib
+import hmac
+import json
 import os
+import re
 import time
 from ipaddress import ip_network, ip_address
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-logger.handlers[0].setFormatter(
-    logging.Formatter("[%(asctime)s][%(levelname)s] %(message)s")
-)
+# The Lambda runtime adds a handler to the root logger; outside of it (e.g.
+# when invoking a handler locally with a test event) there isn't one
+for handler in logger.handlers:
+    handler.setFormatter(logging.Formatter("[%(asctime)s][%(levelname)s] %(message)s"))
 logging.getLogger("boto3").setLevel(logging.ERROR)
 logging.getLogger("botocore").setLevel(logging.ERROR)
 
+# CodeBuild build statuses of builds that finished without succeeding
+FAILED_BUILD_STATUSES = ["FAILED", "FAULT", "STOPPED", "TIMED_OUT"]
+# DynamoDB table remembering the latest build of each repo and ref. If unset,
+# it's only remembered by the container that started the build.
+BUILD_TABLE = os.getenv("build_table")
+# Days to remember a ref's latest build for
+BUILD_TTL_DAYS = 30
+# "after" SHA of a push deleting a branch or tag
+NULL_SHA = "0" * 40
+# Secrets Manager secret holding the GitHub webhook secret. If unset,
+# requests are only checked by source IP.
+WEBHOOK_SECRET_ID = os.getenv("webhook_secret_id")
+# Seconds to reuse the webhook secret before reading it again, so a rotated
+# secret is picked up without a redeploy
+WEBHOOK_SECRET_TTL = 300
+# X-Hub-Signature-256 header value: "sha256=" and the lowercase hex HMAC
+SIGNATURE_PATTERN = re.compile(r"sha256=[0-9a-f]{64}")
+# GitHub webhook events that start a build; others (e.g. ping) are ignored
+BUILD_EVENTS = ["push"]
+
+# Created once per container and reused by every invocation it serves
+webhook_secret_cache = {"secret": None, "expires": 0.0}
+
+
+class IPAllowlist:
+    """
+    IPAllowlist matches IP addresses against a list of CIDR blocks. The
+    blocks are merged into sorted, non-overlapping ranges of addresses for
+    each IP version, so a lookup is a binary search rather than a check of
+    every block.
+    """
+
+    def __init__(self, cidrs):
+        ranges = {4: [], 6: []}
+        for cidr in cidrs:
+            net = ip_network(cidr)
+            ranges[net.version].append(
+                (int(net.network_address), int(net.broadcast_address))
+            )
+
+        self.starts = {}
+        self.ends = {}
+        for version, version_ranges in ranges.items():
+            starts = []
+            ends = []
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[version] = starts
+            self.ends[version] = ends
+
+    def __contains__(self, address):
+        address = ip_address(address)
+        value = int(address)
+        i = bisect_right(self.starts[address.version], value) - 1
+        return i >= 0 and value <= self.ends[address.version][i]
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+
+@lru_cache(maxsize=16)
+def get_ip_allowlist(allowed_ips):
+    """
+    Returns the IPAllowlist for a comma-separated list of CIDR blocks, parsed
+    once per container for each distinct list
+    """
+    return IPAllowlist(cidr.strip() for cidr in allowed_ips.split(",") if cidr.strip())
+
+
+class BuildStore(ABC):
+    """
+    BuildStore remembers the latest build started for each repo and ref, as
+    {"sha": pushed commit SHA, "build_id": CodeBuild build ID}, so pushes of
+    a commit that's already built (or building) can be skipped, and builds
+    of commits that have since been superseded can be stopped.
+
+    put only records a build if the latest build is still expected_build_id
+    (None for no build), and returns whether it did, so two pushes handled
+    at once can't both replace the same build.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def put(self, key, build, expected_build_id=None):
+        pass
+
+
+class MemoryBuildStore(BuildStore):
+    def __init__(self):
+        self.builds = {}
+
+    def get(self, key):
+        return self.builds.get(key)
+
+    def put(self, key, build, expected_build_id=None):
+        latest = self.builds.get(key)
+        if (latest and latest["build_id"]) != expected_build_id:
+            return False
+        self.builds[key] = dict(build)
+        return True
+
+
+class DynamoDBBuildStore(BuildStore):
+    def __init__(self, table_name):
+        self.table = resource("dynamodb").Table(table_name)
+
+    def get(self, key):
+        item = self.table.get_item(Key={"ref": key}, ConsistentRead=True).get("Item")
+        if item is None:
+            return None
+        return {"sha": item["sha"], "build_id": item["build_id"]}
+
+    def put(self, key, build, expected_build_id=None):
+        if expected_build_id is None:
+            condition = {"ConditionExpression": "attribute_not_exists(#ref)"}
+            condition["ExpressionAttributeNames"] = {"#ref": "ref"}
+        else:
+            condition = {"ConditionExpression": "build_id = :build_id"}
+            condition["ExpressionAttributeValues"] = {":build_id": expected_build_id}
+        try:
+            self.table.put_item(
+                Item={
+                    "ref": key,
+                    "sha": build["sha"],
+                    "build_id": build["build_id"],
+                    "expires": int(time.time()) + BUILD_TTL_DAYS * 24 * 60 * 60,
+                },
+                **condition,
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+
+build_store = None
+
+
+def get_build_store():
+    global build_store
+    if build_store is None:
+        build_store = (
+            DynamoDBBuildStore(BUILD_TABLE) if BUILD_TABLE else MemoryBuildStore()
+        )
+    return build_store
+
+
+def get_build_status(codebuild_client, build_id):
+    builds = codebuild_client.batch_get_builds(ids=[build_id])["builds"]
+    if not builds:
+        return None
+    return builds[0]["buildStatus"]
+
+
+def coalesce_build(codebuild_client, latest, sha, before=None):
+    """
+    Decides whether a push of sha, on top of before, needs a build, given
+    the latest build recorded for its repo and ref. It doesn't if that build
+    is of the same commit and is in progress or succeeded. A build still in
+    progress of before, the commit this push replaced, is stopped, as the new
+    build will replace its artifact. Builds of any other commit are left to
+    finish: arriving later doesn't make a push newer.
+    """
+    if latest is None:
+        return True
+
+    status = get_build_status(codebuild_client, latest["build_id"])
+    if latest["sha"] == sha:
+        if status in ["IN_PROGRESS", "SUCCEEDED"]:
+            logger.info(
+                "Skipping push of %s: build %s is %s"
+                % (sha, latest["build_id"], status)
+            )
+            return False
+        return True
+
+    if status == "IN_PROGRESS" and latest["sha"] == before:
+        logger.info(
+            "Stopping build %s of %s, superseded by %s"
+            % (latest["build_id"], latest["sha"], sha)
+        )
+        stop_build(codebuild_client, latest["build_id"])
+    return True
+
+
+def stop_build(codebuild_client, build_id):
+    try:
+        codebuild_client.stop_build(id=build_id)
+    except Exception as e:
+        # It may have finished in the meantime
+        logger.info("Could not stop build %s: %s" % (build_id, e))
+
+
+def get_header(event, name):
+    # Header names are as the sender cased them
+    for header, value in event.get("params", {}).get("header", {}).items():
+        if header.lower() == name.lower():
+            return value
+    return None
+
+
+def get_webhook_secret():
+    """
+    Returns the GitHub webhook secret from Secrets Manager, cached for
+    WEBHOOK_SECRET_TTL seconds
+    """
+    now = time.monotonic()
+    if now >= webhook_secret_cache["expires"]:
+        secretsmanager_client = client(service_name="secretsmanager")
+        webhook_secret_cache["secret"] = secretsmanager_client.get_secret_value(
+            SecretId=WEBHOOK_SECRET_ID
+        )["SecretString"].encode("utf-8")
+        webhook_secret_cache["expires"] = now + WEBHOOK_SECRET_TTL
+    return webhook_secret_cache["secret"]
+
+
+def verify_signature(payload, signature, secret):
+    """
+    Checks GitHub's X-Hub-Signature-256 header, an HMAC of the payload
+    bytes, in constant time
+    """
+    if not signature:
+        return False
+    expected = "sha256=" + hmac.new(secret, payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.encode("utf-8"), signature.encode("utf-8"))
+
+
+def verify_webhook(event):
+    """
+    Checks the request was signed with the webhook secret. Requests without
+    a well-formed signature are rejected before the secret is read, so
+    unsigned junk costs no Secrets Manager calls; a rotated secret is picked
+    up within WEBHOOK_SECRET_TTL seconds.
+    """
+    signature = get_header(event, "X-Hub-Signature-256")
+    # Anything GitHub couldn't have sent is rejected without the secret
+    if not signature or not SIGNATURE_PATTERN.fullmatch(signature):
+        return False
+    # The raw body, as escaped into the event by apigateway-webhook.json
+    payload = event["context"]["raw-body"].encode("utf-8")
+    return verify_signature(payload, signature, get_webhook_secret())
+
+
+def get_body(event):
+    if "body-json" in event:
+        return event["body-json"]
+    return json.loads(event["context"]["raw-body"])
+
 
 def lambda_handler(event, context):
-    print(event)
     secret_id = event["context"]["secret-id"]
     output_bucket = event["context"]["output-bucket"]
 
     # Source IP ranges to allow requests from, if the IP is in one of these the request will not be checked for an api key
-    ip_ranges = []
-    if event["context"]["allowed-ips"]:
-        for i in event["context"]["allowed-ips"].split(","):
-            ip_ranges.append(ip_network("%s" % i))
     secure = False
-    source_ip = ip_address(event['context']['source-ip'])
-    if ip_ranges:
-        for net in ip_ranges:
-            if source_ip in net:
-                secure = True
+    source_ip = ip_address(event["context"]["source-ip"])
+    if event["context"]["allowed-ips"]:
+        secure = source_ip in get_ip_allowlist(event["context"]["allowed-ips"])
     if not secure:
         logger.error("Source IP %s is not allowed" % source_ip)
         raise Exception("Source IP %s is not allowed" % source_ip)
 
+    # Requests that won't start a build are dropped here, before the body is
+    # parsed or logged. API Gateway invokes this asynchronously, so they are
+    # returned from rather than raised, which would only get them retried.
+    github_event = get_header(event, "X-GitHub-Event")
+    if github_event and github_event not in BUILD_EVENTS:
+        logger.info("Ignoring %s event from %s" % (github_event, source_ip))
+        return
+    if WEBHOOK_SECRET_ID and not verify_webhook(event):
+        logger.error("Request from %s is not signed by the webhook secret" % source_ip)
+        return
+
+    print(event)
+    body = get_body(event)
+
     # only GitHub supported for now
-    github_repo_name = event["body-json"]["repository"]["full_name"]
-    github_ssh_url = event["body-json"]["repository"]["ssh_url"]
+    github_repo_name = body["repository"]["full_name"]
+    github_ssh_url = body["repository"]["ssh_url"]
     github_branch = (
-        event["body-json"]["ref"]
-        .replace("refs/heads/", "")
-        .replace("refs/tags/", "tags/")
+        body["ref"].replace("refs/heads/", "").replace("refs/tags/", "tags/")
     )
 
+    github_sha = body.get("after")
+    if github_sha == NULL_SHA:
+        logger.info("Skipping deletion of %s" % body["ref"])
+        return
+    output_bucket_path = "%s/%s/" % (github_repo_name, github_branch)
+
     try:
         codebuild_client = client(service_name="codebuild")
+        store = get_build_store()
+        latest = store.get(output_bucket_path) if github_sha else None
+        if github_sha and not coalesce_build(
+            codebuild_client, latest, github_sha, body.get("before")
+        ):
+            return
         new_build = codebuild_client.start_build(
             projectName=os.getenv("codebuild_project_name"),
             environmentVariablesOverride=[
@@ -69,45 +348,87 @@ def lambda_handler(event, context):
                 },
                 {
                     "name": "OUTPUT_BUCKET_PATH",
-                    "value": "%s/%s/" % (github_repo_name, github_branch),
+                    "value": output_bucket_path,
                     "type": "PLAINTEXT",
                 },
+                {"name": "GITHUB_SHA", "value": github_sha or "", "type": "PLAINTEXT"},
             ],
         )
         build_id = new_build["build"]["id"]
         logger.info("CodeBuild Build ID is %s" % (build_id))
-        build_status = "NOT_KNOWN"
-        counter = 0
-        while (
-            counter < 60 and build_status != "SUCCEEDED"
-        ):  # capped this, so it just fails if it takes too long
-            logger.info("Waiting for CodeBuild to complete")
-            time.sleep(5)
-            logger.info(counter)
-            counter = counter + 1
-            current_build = codebuild_client.batch_get_builds(ids=[build_id])
-            print(current_build)
-            build_status = current_build["builds"][0]["buildStatus"]
-            logger.info("CodeBuild Build Status is %s" % (build_status))
-            if build_status == "SUCCEEDED":
-                env_variables = current_build["builds"][0][
-                    "exportedEnvironmentVariables"
-                ]
-                commit_id = [
-                    env for env in env_variables if env["name"] == "GIT_COMMIT_ID"
-                ][0]["value"]
-                commit_message = [
-                    env for env in env_variables if env["name"] == "GIT_COMMIT_MSG"
-                ][0]["value"]
-                print("commit_id: " + commit_id)
-                print("commit_msg: " + commit_message)
-                break
-            elif (
-                build_status == "FAILED"
-                or build_status == "FAULT"
-                or build_status == "STOPPED"
-                or build_status == "TIMED_OUT"
-            ):
-                break
+        if github_sha and not store.put(
+            output_bucket_path,
+            {"sha": github_sha, "build_id": build_id},
+            latest and latest["build_id"],
+        ):
+            # Another push to the ref was handled at the same time, and its
+            # build was recorded first
+            current = store.get(output_bucket_path)
+            if current and current["sha"] == github_sha:
+                logger.info(
+                    "Stopping build %s, a duplicate of build %s"
+                    % (build_id, current["build_id"])
+                )
+                stop_build(codebuild_client, build_id)
+                return
+            logger.info(
+                "Build %s of %s started, but build %s was recorded first"
+                % (build_id, github_sha, current and current["build_id"])
+            )
     except Exception as e:
         logger.info("Error in Function: %s" % (e))
+        return
+
+    # The build is tracked by build_state_change_handler, which is invoked by
+    # EventBridge when it finishes, rather than polled for here
+    return {"build_id": build_id}
+
+
+def get_build_variable(variables, name):
+    for variable in variables:
+        if variable["name"] == name:
+            return variable["value"]
+    return None
+
+
+def build_state_change_handler(event, context):
+    """
+    Handles a "CodeBuild Build State Change" EventBridge event for a finished
+    build of the CodeBuild project started by lambda_handler, logging the
+    commit it synced (from the GIT_COMMIT_ID and GIT_COMMIT_MSG variables
+    exported by buildspec.yml) or why it failed.
+    """
+    print(event)
+    detail = event["detail"]
+    build_id = detail["build-id"]
+    build_status = detail["build-status"]
+    info = detail.get("additional-information", {})
+    environment = info.get("environment", {}).get("environment-variables", [])
+    result = {
+        "build_id": build_id,
+        "build_status": build_status,
+        "output_path": get_build_variable(environment, "OUTPUT_BUCKET_PATH"),
+    }
+    logger.info("CodeBuild Build %s status is %s" % (build_id, build_status))
+
+    if build_status in FAILED_BUILD_STATUSES:
+        logger.error(
+            "CodeBuild Build %s for %s finished with status %s"
+            % (build_id, result["output_path"], build_status)
+        )
+        return result
+    if build_status != "SUCCEEDED":
+        return result
+
+    exported = info.get("exported-environment-variables")
+    if exported is None:
+        # Not every event includes them, so read them from the build itself
+        codebuild_client = client(service_name="codebuild")
+        current_build = codebuild_client.batch_get_builds(ids=[build_id])
+        exported = current_build["builds"][0].get("exportedEnvironmentVariables", [])
+
+    result["commit_id"] = get_build_variable(exported, "GIT_COMMIT_ID")
+    result["commit_message"] = get_build_variable(exported, "GIT_COMMIT_MSG")
+    print("commit_id: %s" % result["commit_id"])
+    print("commit_msg: %s" % result["commit_message"])
+    return result
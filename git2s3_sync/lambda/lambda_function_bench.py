@@ -0,0 +1,127 @@
+"""
+Benchmarks the per-request cost of checking a webhook's source IP against the
+allowed-ips allowlist, comparing the cached IPAllowlist to parsing and
+scanning every CIDR block on each request, as lambda_handler used to.
+
+Example:
+
+  python lambda_function_bench.py --entries 10 100 1000 10000
+
+Prints one JSON result per line.
+"""
+
+from ipaddress import ip_address, ip_network
+import argparse
+import json
+import random
+import time
+
+# autopep8: off
+from lambda_function import get_ip_allowlist
+
+# autopep8: on
+
+
+def generate_allowlist(entries, ipv6_fraction=0.25, seed=0):
+    """
+    generate_allowlist returns a comma-separated list of entries random CIDR
+    blocks, about ipv6_fraction of them IPv6, as the allowed-ips stage
+    variable holds them.
+    """
+    rng = random.Random(seed)
+    cidrs = []
+    for _ in range(entries):
+        if rng.random() < ipv6_fraction:
+            prefix = rng.randint(32, 64)
+            address = rng.getrandbits(128)
+            cidrs.append(str(ip_network((address, prefix), strict=False)))
+        else:
+            prefix = rng.randint(16, 32)
+            address = rng.getrandbits(32)
+            cidrs.append(str(ip_network((address, prefix), strict=False)))
+    return ",".join(cidrs)
+
+
+def linear_match(allowed_ips, source_ip):
+    ip_ranges = [ip_network(i) for i in allowed_ips.split(",")]
+    source_ip = ip_address(source_ip)
+    secure = False
+    for net in ip_ranges:
+        if source_ip in net:
+            secure = True
+    return secure
+
+
+def cached_match(allowed_ips, source_ip):
+    return ip_address(source_ip) in get_ip_allowlist(allowed_ips)
+
+
+def time_per_call(match, allowed_ips, source_ips, min_time=0.2):
+    """
+    time_per_call returns the mean seconds taken by match for each of the
+    source_ips, repeated until at least min_time has passed.
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for source_ip in source_ips:
+            match(allowed_ips, source_ip)
+        calls += len(source_ips)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def run_benchmark(entries, lookups=100, min_time=0.2):
+    """
+    run_benchmark times both matchers against an allowlist of entries
+    blocks, for a mix of allowed and rejected source IPs. The cached
+    matcher's first call, which parses the allowlist, is timed separately.
+    """
+    allowed_ips = generate_allowlist(entries)
+    cidrs = [ip_network(c) for c in allowed_ips.split(",")]
+    rng = random.Random(1)
+    source_ips = []
+    for n in range(lookups):
+        if n % 2:
+            source_ips.append(str(rng.choice(cidrs).network_address))
+        else:
+            source_ips.append(str(ip_address(rng.getrandbits(32))))
+
+    for source_ip in source_ips:
+        if linear_match(allowed_ips, source_ip) != cached_match(allowed_ips, source_ip):
+            raise AssertionError("matchers disagree on %s" % source_ip)
+
+    get_ip_allowlist.cache_clear()
+    start = time.perf_counter()
+    get_ip_allowlist(allowed_ips)
+    parse_time = time.perf_counter() - start
+
+    linear = time_per_call(linear_match, allowed_ips, source_ips, min_time)
+    cached = time_per_call(cached_match, allowed_ips, source_ips, min_time)
+    return {
+        "entries": entries,
+        "ranges": len(get_ip_allowlist(allowed_ips)),
+        "linear_us": linear * 1e6,
+        "cached_us": cached * 1e6,
+        "first_request_us": parse_time * 1e6,
+        "speedup": linear / cached,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--entries", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--lookups", type=int, default=100)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    for entries in args.entries:
+        result = run_benchmark(entries, lookups=args.lookups, min_time=args.min_time)
+        print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+import boto3
+import hashlib
+import hmac
+from ipaddress import ip_address, ip_network
+import json
+import os
+import pytest
+from moto import mock_aws
+from unittest.mock import patch, MagicMock
+import lambda_function
+from lambda_function import (
+    IPAllowlist,
+    build_state_change_handler,
+    get_ip_allowlist,
+    get_webhook_secret,
+    lambda_handler,
+    verify_signature,
+    verify_webhook,
+)
+
+SECRET = b"webhook secret"
+SECRET_ID = "arn:aws:secretsmanager:us-west-2:123456789012:secret:webhook"
+
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    lambda_function.webhook_secret_cache.update({"secret": None, "expires": 0.0})
+    lambda_function.get_ip_allowlist.cache_clear()
+    with patch("lambda_function.build_store", lambda_function.MemoryBuildStore()):
+        yield
+
+
+@pytest.fixture
+def clients():
+    """
+    Patches boto3's client(), returning a MagicMock per service name, so
+    tests can check which clients were created
+    """
+    created = {}
+
+    def create(service_name):
+        if service_name not in created:
+            created[service_name] = MagicMock()
+            if service_name == "secretsmanager":
+                created[service_name].get_secret_value.return_value = {
+                    "SecretString": SECRET.decode("utf-8")
+                }
+        return created[service_name]
+
+    with patch("lambda_function.client", side_effect=create) as client:
+        client.created = created
+        yield client
+
+
+def sign(payload, secret=SECRET):
+    return "sha256=" + hmac.new(secret, payload, hashlib.sha256).hexdigest()
+
+
+def escape_javascript(text):
+    """
+    Escapes text as API Gateway's $util.escapeJavaScript does (Apache Commons
+    StringEscapeUtils.escapeJavaScript), one UTF-16 code unit at a time
+    """
+    named = {"\b": "\\b", "\n": "\\n", "\t": "\\t", "\f": "\\f", "\r": "\\r"}
+    quoted = {"'": "\\'", '"': '\\"', "\\": "\\\\", "/": "\\/"}
+    utf16 = text.encode("utf-16-be")
+    escaped = []
+    for i in range(0, len(utf16), 2):
+        unit = int.from_bytes(utf16[i : i + 2], "big")
+        char = chr(unit)
+        if unit > 0x7F or (unit < 32 and char not in named):
+            escaped.append("\\u%04X" % unit)
+        else:
+            escaped.append(named.get(char) or quoted.get(char) or char)
+    return "".join(escaped)
+
+
+def render_raw_body(payload):
+    """
+    Returns the raw-body apigateway-webhook.json passes on for payload, as
+    the Lambda function sees it once the rendered template is parsed
+    """
+    escaped = escape_javascript(payload.decode("utf-8")).replace("\\'", "'")
+    rendered = '{"context": {"raw-body": "%s"}}' % escaped
+    return json.loads(rendered)["context"]["raw-body"]
+
+
+def push_body(sha="a" * 40, before="b" * 40, ref="refs/heads/main"):
+    return json.dumps(
+        {
+            "ref": ref,
+            "before": before,
+            "after": sha,
+            "repository": {
+                "full_name": "18F/identity-example",
+                "ssh_url": "git@github.com:18F/identity-example.git",
+            },
+        }
+    ).encode("utf-8")
+
+
+def webhook_event(payload, headers=None, source_ip="192.0.2.10"):
+    return {
+        "params": {"header": dict(headers or {}), "path": {}, "querystring": {}},
+        "context": {
+            "secret-id": "git2s3-ssh",
+            "output-bucket": "git2s3-output",
+            "source-ip": source_ip,
+            "allowed-ips": "192.0.2.0/24",
+            "raw-body": render_raw_body(payload),
+        },
+    }
+
+
+def signed_event(payload, event_type="push"):
+    return webhook_event(
+        payload,
+        {"X-GitHub-Event": event_type, "X-Hub-Signature-256": sign(payload)},
+    )
+
+
+def test_verify_signature():
+    payload = push_body()
+    assert verify_signature(payload, sign(payload), SECRET)
+    assert not verify_signature(payload, sign(payload, b"other secret"), SECRET)
+    assert not verify_signature(payload + b" ", sign(payload), SECRET)
+    assert not verify_signature(payload, None, SECRET)
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_signed_push_starts_a_build(clients):
+    codebuild = clients("codebuild")
+    codebuild.start_build.return_value = {"build": {"id": "git2s3:1"}}
+    clients.reset_mock()
+
+    assert lambda_handler(signed_event(push_body()), None) == {"build_id": "git2s3:1"}
+    codebuild.start_build.assert_called_once()
+    clients.created["secretsmanager"].get_secret_value.assert_called_once_with(
+        SecretId=SECRET_ID
+    )
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_header_names_are_case_insensitive(clients):
+    payload = push_body()
+    event = webhook_event(payload, {"x-hub-signature-256": sign(payload)})
+    assert verify_webhook(event)
+
+
+@pytest.mark.parametrize(
+    "signature",
+    [
+        None,
+        "",
+        "sha1=" + hmac.new(SECRET, push_body(), hashlib.sha1).hexdigest(),
+        sign(push_body()).upper(),
+        sign(push_body()).replace("sha256=", "SHA256="),
+        sign(push_body())[:-1],
+        sign(push_body()) + "0",
+    ],
+)
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_malformed_signatures_are_rejected_without_clients(clients, signature):
+    payload = push_body()
+    headers = {"X-GitHub-Event": "push"}
+    if signature is not None:
+        headers["X-Hub-Signature-256"] = signature
+
+    assert lambda_handler(webhook_event(payload, headers), None) is None
+    clients.assert_not_called()
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_wrong_signatures_are_rejected_without_starting_builds(clients):
+    payload = push_body()
+    get_webhook_secret()
+    clients.reset_mock()
+
+    event = webhook_event(
+        payload,
+        {
+            "X-GitHub-Event": "push",
+            "X-Hub-Signature-256": sign(payload, b"other secret"),
+        },
+    )
+    assert lambda_handler(event, None) is None
+    # The cached secret is used, and nothing else is created
+    clients.assert_not_called()
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_ping_returns_early(clients):
+    event = webhook_event(
+        b'{"zen": "Keep it logically awesome."}', {"X-GitHub-Event": "ping"}
+    )
+    assert lambda_handler(event, None) is None
+    clients.assert_not_called()
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_disallowed_source_ip_is_rejected(clients):
+    event = signed_event(push_body())
+    event["context"]["source-ip"] = "198.51.100.1"
+    with pytest.raises(Exception, match="not allowed"):
+        lambda_handler(event, None)
+    clients.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"message": "caf\u00e9 \u2603 \U0001f680"}',
+        '{"message": "it\'s a \\"quote\\""}',
+        '{"url": "https://github.com/18F/identity-example/compare/a...b"}',
+        '{\n\t"message": "\\\\n \\u0001",\r\n "raw": "\x01\x1f\x7f\b\f"\n}',
+        "\\' '\\ \\\\' ''",
+    ],
+)
+def test_raw_body_decodes_to_signed_bytes(text):
+    payload = text.encode("utf-8")
+    raw_body = render_raw_body(payload)
+    assert raw_body.encode("utf-8") == payload
+
+    event = webhook_event(payload, {"X-Hub-Signature-256": sign(payload)})
+    with patch("lambda_function.get_webhook_secret", return_value=SECRET):
+        assert verify_webhook(event)
+
+
+def test_get_body_parses_raw_body():
+    payload = push_body()
+    assert lambda_function.get_body(webhook_event(payload)) == json.loads(payload)
+
+
+@patch("lambda_function.WEBHOOK_SECRET_ID", SECRET_ID)
+def test_webhook_secret_is_cached(clients):
+    with patch("lambda_function.time.monotonic", return_value=1000.0):
+        assert get_webhook_secret() == SECRET
+        assert get_webhook_secret() == SECRET
+    secretsmanager = clients.created["secretsmanager"]
+    assert secretsmanager.get_secret_value.call_count == 1
+
+    expires = 1000.0 + lambda_function.WEBHOOK_SECRET_TTL
+    with patch("lambda_function.time.monotonic", return_value=expires - 1):
+        assert get_webhook_secret() == SECRET
+    assert secretsmanager.get_secret_value.call_count == 1
+
+    secretsmanager.get_secret_value.return_value = {"SecretString": "rotated"}
+    with patch("lambda_function.time.monotonic", return_value=expires):
+        assert get_webhook_secret() == b"rotated"
+    assert secretsmanager.get_secret_value.call_count == 2
+
+
+KEY = "18F/identity-example/main/"
+SHA = "a" * 40
+BEFORE = "b" * 40
+
+
+def codebuild_client(statuses=None, build_ids=("git2s3:new",)):
+    """
+    Returns a mock CodeBuild client whose builds have the given
+    {build ID: status}, and whose start_build returns build_ids in turn
+    """
+    statuses = dict(statuses or {})
+    codebuild = MagicMock()
+    codebuild.batch_get_builds.side_effect = lambda ids: {
+        "builds": [{"id": i, "buildStatus": statuses[i]} for i in ids if i in statuses]
+    }
+    codebuild.start_build.side_effect = [
+        {"build": {"id": build_id}} for build_id in build_ids
+    ]
+    return codebuild
+
+
+def push(codebuild, sha=SHA, before=BEFORE, ref="refs/heads/main"):
+    with patch("lambda_function.client", return_value=codebuild):
+        return lambda_handler(webhook_event(push_body(sha, before, ref)), None)
+
+
+@pytest.mark.parametrize("status", ["IN_PROGRESS", "SUCCEEDED"])
+def test_push_of_built_commit_is_skipped(status):
+    lambda_function.build_store.put(KEY, {"sha": SHA, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": status})
+
+    assert push(codebuild) is None
+    codebuild.start_build.assert_not_called()
+    codebuild.stop_build.assert_not_called()
+
+
+@pytest.mark.parametrize("status", ["FAILED", "STOPPED", "TIMED_OUT"])
+def test_push_of_failed_commit_is_built_again(status):
+    lambda_function.build_store.put(KEY, {"sha": SHA, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": status})
+
+    assert push(codebuild) == {"build_id": "git2s3:new"}
+    assert lambda_function.build_store.get(KEY) == {
+        "sha": SHA,
+        "build_id": "git2s3:new",
+    }
+
+
+def test_build_of_replaced_commit_is_stopped():
+    lambda_function.build_store.put(KEY, {"sha": BEFORE, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": "IN_PROGRESS"})
+
+    assert push(codebuild) == {"build_id": "git2s3:new"}
+    codebuild.stop_build.assert_called_once_with(id="git2s3:old")
+    assert lambda_function.build_store.get(KEY)["build_id"] == "git2s3:new"
+
+
+def test_build_of_unrelated_commit_is_not_stopped():
+    # e.g. a newer push whose webhook was delivered first
+    lambda_function.build_store.put(KEY, {"sha": "c" * 40, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": "IN_PROGRESS"})
+
+    assert push(codebuild, before="d" * 40) == {"build_id": "git2s3:new"}
+    codebuild.stop_build.assert_not_called()
+
+
+def test_failure_to_stop_a_finished_build_is_ignored():
+    lambda_function.build_store.put(KEY, {"sha": BEFORE, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": "IN_PROGRESS"})
+    codebuild.stop_build.side_effect = Exception("Build has already completed")
+
+    assert push(codebuild) == {"build_id": "git2s3:new"}
+
+
+def test_duplicate_build_losing_the_race_is_stopped():
+    codebuild = codebuild_client()
+
+    def start_build(**kwargs):
+        # The same push, redelivered, is handled by another container while
+        # this one is starting its build, and records its build first
+        lambda_function.build_store.put(KEY, {"sha": SHA, "build_id": "git2s3:other"})
+        return {"build": {"id": "git2s3:new"}}
+
+    codebuild.start_build.side_effect = start_build
+    assert push(codebuild) is None
+    codebuild.stop_build.assert_called_once_with(id="git2s3:new")
+    assert lambda_function.build_store.get(KEY)["build_id"] == "git2s3:other"
+
+
+def test_build_losing_the_race_to_another_commit_keeps_running():
+    codebuild = codebuild_client()
+
+    def start_build(**kwargs):
+        lambda_function.build_store.put(
+            KEY, {"sha": "c" * 40, "build_id": "git2s3:other"}
+        )
+        return {"build": {"id": "git2s3:new"}}
+
+    codebuild.start_build.side_effect = start_build
+    assert push(codebuild) == {"build_id": "git2s3:new"}
+    codebuild.stop_build.assert_not_called()
+    assert lambda_function.build_store.get(KEY)["build_id"] == "git2s3:other"
+
+
+def test_branch_deletion_never_starts_a_build():
+    lambda_function.build_store.put(KEY, {"sha": BEFORE, "build_id": "git2s3:old"})
+    codebuild = codebuild_client({"git2s3:old": "IN_PROGRESS"})
+
+    assert push(codebuild, sha=lambda_function.NULL_SHA) is None
+    codebuild.start_build.assert_not_called()
+    codebuild.stop_build.assert_not_called()
+
+
+def test_memory_build_store_put_is_conditional():
+    store = lambda_function.MemoryBuildStore()
+    assert store.put(KEY, {"sha": SHA, "build_id": "1"})
+    assert not store.put(KEY, {"sha": BEFORE, "build_id": "2"})
+    assert not store.put(KEY, {"sha": BEFORE, "build_id": "2"}, "0")
+    assert store.put(KEY, {"sha": BEFORE, "build_id": "2"}, "1")
+    assert store.get(KEY) == {"sha": BEFORE, "build_id": "2"}
+
+
+@mock_aws
+def test_dynamodb_build_store_put_is_conditional(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    boto3.client("dynamodb").create_table(
+        TableName="git2s3-builds",
+        KeySchema=[{"AttributeName": "ref", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "ref", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    store = lambda_function.DynamoDBBuildStore("git2s3-builds")
+    assert store.get(KEY) is None
+    assert store.put(KEY, {"sha": SHA, "build_id": "1"})
+    assert not store.put(KEY, {"sha": BEFORE, "build_id": "2"})
+    assert not store.put(KEY, {"sha": BEFORE, "build_id": "2"}, "0")
+    assert store.put(KEY, {"sha": BEFORE, "build_id": "2"}, "1")
+    assert store.get(KEY) == {"sha": BEFORE, "build_id": "2"}
+
+
+def test_adjacent_and_overlapping_cidrs_are_merged():
+    allowlist = IPAllowlist(
+        ["10.0.0.0/25", "10.0.0.128/25", "10.0.1.0/24", "10.0.0.64/26"]
+    )
+    assert len(allowlist) == 1
+    assert allowlist.starts[4] == [int(ip_address("10.0.0.0"))]
+    assert allowlist.ends[4] == [int(ip_address("10.0.1.255"))]
+
+    # A gap of one address keeps them apart
+    assert len(IPAllowlist(["10.0.0.0/32", "10.0.0.2/32"])) == 2
+    # Nested blocks merge into the outer one
+    assert len(IPAllowlist(["10.0.0.0/8", "10.1.0.0/16"])) == 1
+
+
+def test_ip_versions_are_kept_apart():
+    # ::a00:0/120 holds the same integers as 10.0.0.0/24
+    allowlist = IPAllowlist(["10.0.0.0/24", "2001:db8::/32"])
+    assert "10.0.0.1" in allowlist
+    assert "::a00:1" not in allowlist
+    assert "::ffff:10.0.0.1" not in allowlist
+    assert "2001:db8::1" in allowlist
+    assert "32.1.13.184" not in allowlist
+
+    assert "10.0.0.1" not in IPAllowlist(["::/0"])
+    assert "::1" not in IPAllowlist(["0.0.0.0/0"])
+
+
+@pytest.mark.parametrize(
+    "cidr",
+    ["192.0.2.0/24", "198.51.100.7/32", "10.0.0.0/8", "2001:db8:1::/48", "::1/128"],
+)
+def test_range_boundaries(cidr):
+    allowlist = IPAllowlist(["172.16.0.0/12", cidr, "2001:db8:ff::/48"])
+    net = ip_network(cidr)
+    assert net.network_address in allowlist
+    assert net.broadcast_address in allowlist
+    assert net.network_address - 1 not in allowlist
+    assert net.broadcast_address + 1 not in allowlist
+
+
+def test_empty_allowlist():
+    allowlist = IPAllowlist([])
+    assert len(allowlist) == 0
+    assert "192.0.2.1" not in allowlist
+    assert "::1" not in allowlist
+
+
+def test_allowed_ips_whitespace_and_empty_entries():
+    allowlist = get_ip_allowlist(" 192.0.2.0/24 ,, 2001:db8::/32,\t,198.51.100.0/24 ,")
+    assert len(allowlist) == 3
+    assert "192.0.2.255" in allowlist
+    assert "198.51.100.0" in allowlist
+    assert "2001:db8::1" in allowlist
+    assert "203.0.113.1" not in allowlist
+
+
+def test_get_ip_allowlist_is_cached_by_string():
+    allowlist = get_ip_allowlist("192.0.2.0/24,198.51.100.0/24")
+    assert get_ip_allowlist("192.0.2.0/24,198.51.100.0/24") is allowlist
+    # The same blocks, written differently, are parsed again
+    assert get_ip_allowlist("198.51.100.0/24,192.0.2.0/24") is not allowlist
+    assert get_ip_allowlist.cache_info().hits == 1
+    assert get_ip_allowlist.cache_info().misses == 2
+
+    # Changing the stage variable takes effect without a new container
+    assert "203.0.113.1" not in get_ip_allowlist("192.0.2.0/24")
+    assert "203.0.113.1" in get_ip_allowlist("192.0.2.0/24,203.0.113.0/24")
+
+
+def load_event(filename="codebuild_state_change_event.json"):
+    with open(os.path.join(os.path.dirname(__file__), filename)) as f:
+        return json.load(f)
+
+
+def test_succeeded_build_with_exported_variables():
+    event = load_event()
+    with patch("lambda_function.client") as client:
+        result = build_state_change_handler(event, None)
+    client.assert_not_called()
+    assert result == {
+        "build_id": event["detail"]["build-id"],
+        "build_status": "SUCCEEDED",
+        "output_path": "18F/identity-example/main/",
+        "commit_id": "0a1b2c3",
+        "commit_message": "Update the example",
+    }
+
+
+def test_succeeded_build_without_exported_variables():
+    event = load_event()
+    del event["detail"]["additional-information"]["exported-environment-variables"]
+    codebuild = MagicMock()
+    codebuild.batch_get_builds.return_value = {
+        "builds": [
+            {
+                "exportedEnvironmentVariables": [
+                    {"name": "GIT_COMMIT_ID", "value": "4d5e6f7"},
+                    {"name": "GIT_COMMIT_MSG", "value": "Read from the build"},
+                ]
+            }
+        ]
+    }
+    with patch("lambda_function.client", return_value=codebuild):
+        result = build_state_change_handler(event, None)
+    codebuild.batch_get_builds.assert_called_once_with(
+        ids=[event["detail"]["build-id"]]
+    )
+    assert result["commit_id"] == "4d5e6f7"
+    assert result["commit_message"] == "Read from the build"
+
+
+def test_failed_build(caplog):
+    event = load_event()
+    event["detail"]["build-status"] = "FAILED"
+    with patch("lambda_function.client") as client:
+        result = build_state_change_handler(event, None)
+    client.assert_not_called()
+    assert result == {
+        "build_id": event["detail"]["build-id"],
+        "build_status": "FAILED",
+        "output_path": "18F/identity-example/main/",
+    }
+    errors = [r for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 1
+    assert "18F/identity-example/main/ finished with status FAILED" in (
+        errors[0].getMessage()
+    )
@@ -138,3 +138,46 @@ EOM
   type        = number
   default     = 1
 }
+
+variable "build_table_enabled" {
+  description = <<EOM
+(OPTIONAL) Whether to create a DynamoDB table remembering the latest build
+of each repo and branch/tag, so that pushes of an already-built commit are
+skipped, and builds of commits pushed over are stopped, across Lambda
+containers. If
+false, this is only remembered by the container that started the build.
+EOM
+  type        = bool
+  default     = false
+}
+
+variable "sync_mode" {
+  description = <<EOM
+(OPTIONAL) How the CodeBuild project publishes the ZIP file of a branch/tag:
+'full' zips up and uploads the whole clone on every push, while 'delta' (see
+lambda/delta_sync.py) only compresses and uploads the files changed since
+the last published ZIP file, reusing the rest of it. NOTE: the two modes
+publish different sets of files. 'full' ZIP files hold the whole clone,
+including its .git directory, while 'delta' ZIP files only hold the files
+tracked in the commit (no .git directory, and no directory entries or
+empty submodule directories).
+EOM
+  type        = string
+  default     = "full"
+
+  validation {
+    condition     = contains(["full", "delta"], var.sync_mode)
+    error_message = "var.sync_mode must be set to 'full' or 'delta'."
+  }
+}
+
+variable "webhook_secret_arn" {
+  description = <<EOM
+(OPTIONAL) ARN of a Secrets Manager secret whose SecretString is the secret
+set on the GitHub webhook. If specified, the git-pull Lambda function will
+only start builds for requests with a valid X-Hub-Signature-256 header, in
+addition to checking their source IP.
+EOM
+  type        = string
+  default     = ""
+}
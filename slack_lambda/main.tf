@@ -11,9 +11,64 @@ data "aws_iam_policy_document" "lambda_policy" {
       "ssm:DescribeParameters",
       "ssm:GetParameter"
     ]
-    resources = [
-      "arn:aws:ssm:${data.aws_region.current.region}:${data.aws_caller_identity.current.account_id}:parameter${var.slack_webhook_url_parameter}"
-    ]
+    resources = compact([
+      "arn:aws:ssm:${data.aws_region.current.region}:${data.aws_caller_identity.current.account_id}:parameter${var.slack_webhook_url_parameter}",
+      var.slack_bot_token_parameter == "" ? "" : "arn:aws:ssm:${data.aws_region.current.region}:${data.aws_caller_identity.current.account_id}:parameter${var.slack_bot_token_parameter}",
+    ])
+  }
+
+  dynamic "statement" {
+    for_each = var.slack_sqs_batching_enabled ? [1] : []
+    content {
+      sid    = "SQSBatching"
+      effect = "Allow"
+      actions = [
+        "sqs:ReceiveMessage",
+        "sqs:DeleteMessage",
+        "sqs:GetQueueAttributes",
+      ]
+      resources = [
+        aws_sqs_queue.slack[0].arn
+      ]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = var.slack_thread_table_enabled ? [1] : []
+    content {
+      sid    = "DynamoDBThreads"
+      effect = "Allow"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+        "dynamodb:DeleteItem",
+      ]
+      resources = [
+        aws_dynamodb_table.slack_threads[0].arn
+      ]
+    }
+  }
+}
+
+resource "aws_dynamodb_table" "slack_threads" {
+  count = var.slack_thread_table_enabled ? 1 : 0
+
+  name         = "${var.lambda_name}-threads"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "alarm_name"
+
+  attribute {
+    name = "alarm_name"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires"
+    enabled        = true
+  }
+
+  server_side_encryption {
+    enabled = true
   }
 }
 
@@ -32,6 +87,23 @@ module "slack_lambda" {
 
   environment_variables = {
     slack_webhook_url_parameter = var.slack_webhook_url_parameter
+    slack_webhook_url_ttl       = var.slack_webhook_url_ttl
+    slack_max_concurrent_sends  = var.slack_max_concurrent_sends
+    slack_digest_min_alarms     = var.slack_digest_min_alarms
+    slack_digest_window_seconds = var.slack_digest_window_seconds
+    slack_digest_group_pattern  = var.slack_digest_group_pattern
+    slack_dedup_seconds         = var.slack_dedup_seconds
+    slack_transport             = var.slack_transport
+    slack_bot_token_parameter   = var.slack_bot_token_parameter
+    slack_channel_rate          = var.slack_channel_rate
+    slack_max_retry_wait        = var.slack_max_retry_wait
+    slack_thread_table          = var.slack_thread_table_enabled ? aws_dynamodb_table.slack_threads[0].name : ""
+    slack_prepare_at_init       = tostring(var.slack_prepare_at_init)
+    slack_startup_profile       = tostring(var.slack_startup_profile)
+    slack_log_mode              = var.slack_log_mode
+    slack_log_sample_rate       = var.slack_log_sample_rate
+    slack_log_max_length        = var.slack_log_max_length
+    slack_metrics_namespace     = var.slack_metrics_namespace
     slack_channel               = var.slack_channel,
     slack_username              = var.slack_username,
     slack_icon                  = var.slack_icon
@@ -71,7 +143,14 @@ moved {
   to   = module.slack_lambda.aws_iam_role_policy.lambda
 }
 
+# SNS invokes the Lambda with one message at a time. With
+# slack_sqs_batching_enabled, messages are queued in SQS instead, and the
+# Lambda receives them in batches: so alarm storms can be coalesced into
+# digests, and only the messages that failed to send are retried.
+
 resource "aws_lambda_permission" "allow_sns_trigger" {
+  count = var.slack_sqs_batching_enabled ? 0 : 1
+
   statement_id  = "AllowExecutionBySNS"
   action        = "lambda:InvokeFunction"
   function_name = module.slack_lambda.lambda_arn
@@ -80,7 +159,75 @@ resource "aws_lambda_permission" "allow_sns_trigger" {
 }
 
 resource "aws_sns_topic_subscription" "sns_to_lambda" {
+  count = var.slack_sqs_batching_enabled ? 0 : 1
+
   topic_arn = var.slack_topic_arn
   protocol  = "lambda"
   endpoint  = module.slack_lambda.lambda_arn
 }
+
+resource "aws_sqs_queue" "slack_dead_letter" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  name                      = "${var.lambda_name}-dead-letter"
+  message_retention_seconds = 1209600
+  sqs_managed_sse_enabled   = true
+}
+
+resource "aws_sqs_queue" "slack" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  name = var.lambda_name
+  # AWS recommends at least 6 times the function timeout for Lambda sources
+  visibility_timeout_seconds = 6 * var.lambda_timeout
+  sqs_managed_sse_enabled    = true
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.slack_dead_letter[0].arn
+    maxReceiveCount     = 5
+  })
+}
+
+data "aws_iam_policy_document" "sns_to_sqs" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  statement {
+    sid     = "AllowSNS"
+    effect  = "Allow"
+    actions = ["sqs:SendMessage"]
+    principals {
+      type        = "Service"
+      identifiers = ["sns.amazonaws.com"]
+    }
+    resources = [aws_sqs_queue.slack[0].arn]
+    condition {
+      test     = "ArnEquals"
+      variable = "aws:SourceArn"
+      values   = [var.slack_topic_arn]
+    }
+  }
+}
+
+resource "aws_sqs_queue_policy" "sns_to_sqs" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  queue_url = aws_sqs_queue.slack[0].id
+  policy    = data.aws_iam_policy_document.sns_to_sqs[0].json
+}
+
+resource "aws_sns_topic_subscription" "sns_to_sqs" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  topic_arn = var.slack_topic_arn
+  protocol  = "sqs"
+  endpoint  = aws_sqs_queue.slack[0].arn
+}
+
+resource "aws_lambda_event_source_mapping" "sqs_to_lambda" {
+  count = var.slack_sqs_batching_enabled ? 1 : 0
+
+  event_source_arn                   = aws_sqs_queue.slack[0].arn
+  function_name                      = module.slack_lambda.lambda_arn
+  batch_size                         = var.slack_sqs_batch_size
+  maximum_batching_window_in_seconds = var.slack_sqs_batching_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
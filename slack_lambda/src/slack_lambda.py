@@ -1,25 +1,415 @@
 #!/usr/bin/python3.12
-import boto3
+import time
+
+import_started = time.perf_counter()
+
 import urllib3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import contextlib
 import json
 import os
 import re
 import datetime
 import logging
+import random
+import threading
+
+# boto3 is only needed to read SSM parameters (and DynamoDB threads), so it's
+# imported when first needed, during the init phase when running in Lambda
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Seconds to reuse the decrypted Slack webhook URL before reading it from SSM
+# again, so a rotated URL is picked up without a redeploy
+WEBHOOK_URL_TTL = int(os.environ.get("slack_webhook_url_ttl", 300))
+# Most records in a batch to send to Slack at once
+MAX_CONCURRENT_SENDS = int(os.environ.get("slack_max_concurrent_sends", 4))
+# CloudWatch alarms in the same group, state and time window are posted as a
+# single digest once there are at least this many of them (0 never digests)
+DIGEST_MIN_ALARMS = int(os.environ.get("slack_digest_min_alarms", 3))
+# Length of the time windows alarms are grouped into
+DIGEST_WINDOW_SECONDS = int(os.environ.get("slack_digest_window_seconds", 300))
+# Alarms are grouped by the part of their AlarmName this matches, e.g. "prod"
+DIGEST_GROUP_PATTERN = re.compile(
+    os.environ.get("slack_digest_group_pattern", "^[^-]+")
+)
+# Seconds to suppress an alarm repeating the state it was last posted in
+DEDUP_SECONDS = int(os.environ.get("slack_dedup_seconds", 300))
+# Slack rejects section blocks with more text than this, and messages with
+# more blocks than this
+MAX_SECTION_LENGTH = 3000
+MAX_BLOCKS = 50
+# Most characters of block text to put in one message before continuing in a
+# follow-up message, and most follow-ups before truncating
+MAX_MESSAGE_LENGTH = 12000
+MAX_FOLLOW_UPS = 2
+# Slack truncates the top-level text (used in notifications) beyond this
+MAX_TEXT_LENGTH = 4000
+# How to send messages: "webhook" or "web_api" (chat.postMessage, which can
+# thread OK messages under the ALARM message they resolve)
+TRANSPORT = os.environ.get("slack_transport", "webhook")
+# Most messages per second to post to each channel (Slack allows about 1)
+CHANNEL_RATE = float(os.environ.get("slack_channel_rate", 1))
+# Most seconds to spend waiting out Slack 429 Retry-After responses per message
+MAX_RETRY_WAIT = float(os.environ.get("slack_max_retry_wait", 30))
+# DynamoDB table remembering which message to thread an alarm's OK under. If
+# unset, it's only remembered by the container that posted the ALARM.
+THREAD_TABLE = os.environ.get("slack_thread_table")
+# Seconds to remember an ALARM message for threading
+THREAD_TTL = 7 * 24 * 60 * 60
+SLACK_POST_MESSAGE_URL = "https://slack.com/api/chat.postMessage"
+# Web API errors that mean the bot token should be read from SSM again
+TOKEN_ERRORS = ("invalid_auth", "not_authed", "token_revoked", "token_expired")
+# Whether to do the work every invocation needs (importing boto3, creating
+# clients, reading the webhook URL) during the Lambda init phase, rather than
+# in the first invocation
+PREPARE_AT_INIT = os.environ.get("slack_prepare_at_init", "true").lower() == "true"
+# Set to "true" to log how long each step of a cold start took
+STARTUP_PROFILE = os.environ.get("slack_startup_profile", "false").lower() == "true"
+# "full" logs every message, its payload and Slack's response. "structured"
+# logs a JSON line for a sample of successes (and for every failure), with
+# payload text and responses cut to LOG_MAX_LENGTH characters
+LOG_MODE = os.environ.get("slack_log_mode", "structured")
+LOG_SAMPLE_RATE = float(os.environ.get("slack_log_sample_rate", 0.1))
+LOG_MAX_LENGTH = int(os.environ.get("slack_log_max_length", 1000))
+# CloudWatch namespace to publish message counts, send latency and Slack
+# status codes to, as Embedded Metric Format logs. Empty to not publish.
+METRICS_NAMESPACE = os.environ.get("slack_metrics_namespace", "SlackNotifications")
+# EMF records hold at most this many values for a metric
+MAX_METRIC_VALUES = 100
+# Runbook links in CloudWatch alarm descriptions
+RUNBOOK_PATTERN = re.compile("Runbook: (https://\\S+)")
+RUNBOOK_LINE_PATTERN = re.compile("Runbook: (https://\\S+)\n")
+
+# Created once per container and reused by every invocation it serves
+ssm_client = None
+http_pool = None
+webhook_url_cache = {"url": None, "expires": 0.0}
+bot_token_cache = {"url": None, "expires": 0.0}
+transport = None
+thread_store = None
+config = None
+notification_formatter = None
+# Step -> milliseconds taken during this container's cold start
+startup_timings = {}
+first_invocation = True
+# AlarmName -> (state, time.monotonic()) of alarms recently posted
+alarm_states = {}
+alarm_states_lock = threading.Lock()
+
+# Event type -> (formatter function, slack_username, slack_icon)
+FORMATTERS = {}
+
+
+def register_formatter(event_type, slack_username="", slack_icon=""):
+    """
+    Decorator registering a formatter for an event type, as returned by
+    get_event_type. The formatter is called as
+    formatter(SlackNotificationFormatter, data, slack_username, slack_icon),
+    so SlackNotificationFormatter methods can be registered directly. It may
+    return None to fall back to the generic message.
+
+    :param event_type: event type to format
+    :param slack_username: username to post as, instead of the default
+    :param slack_icon: icon to post with, instead of the default
+    :returns: decorator
+    """
+
+    def register(formatter):
+        FORMATTERS[event_type] = (formatter, slack_username, slack_icon)
+        return formatter
+
+    return register
+
+
+def get_event_type(data):
+    """
+    Function to get the event type a message is formatted by: the
+    EventBridge detail-type or CodeStar Notifications detailType, or a fixed
+    type for CloudWatch alarms and Incident Manager events
+
+    :param data: decoded message
+    :returns: event type, or None for a generic message
+    """
+    if not isinstance(data, dict):
+        return None
+    if "detailType" in data:
+        return data["detailType"]
+    if "AlarmName" in data and "AlarmDescription" in data:
+        return "CloudWatch Alarm"
+    if "detail-type" in data:
+        return data["detail-type"]
+    if "IncidentManagerEvent" in data:
+        return "Incident Manager"
+    return None
+
+
+def section_block(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def split_text(text, limit):
+    """
+    Function to split text into chunks of at most limit characters, at line
+    breaks where possible
+
+    :param text: text to split
+    :param limit: longest chunk
+    :returns: list of chunks
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut > 0:
+            chunks.append(text[:cut])
+            text = text[cut + 1 :]
+        else:
+            chunks.append(text[:limit])
+            text = text[limit:]
+    chunks.append(text)
+    return chunks
+
+
+def split_section_text(text):
+    """
+    Function to split section text into chunks Slack will accept, keeping
+    code blocks fenced in each chunk
+
+    :param text: section text
+    :returns: list of chunks
+    """
+    if len(text) <= MAX_SECTION_LENGTH:
+        return [text]
+    if text.startswith("```") and text.endswith("```"):
+        code = text[3:-3].strip("\n")
+        return [
+            f"```\n{chunk}\n```"
+            for chunk in split_text(code, MAX_SECTION_LENGTH - len("```\n\n```"))
+        ]
+    return split_text(text, MAX_SECTION_LENGTH)
+
+
+class SlackPayload(dict):
+    """
+    SlackPayload is a Slack message payload, along with the payloads of any
+    follow-up messages continuing it.
+    """
+
+    def __init__(self, *args, follow_ups=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.follow_ups = follow_ups or []
+
+
+class BlockBuilder:
+    """
+    BlockBuilder collects blocks into messages that keep within Slack's
+    limits, measuring as it goes rather than serializing. Sections with too
+    much text are split into several; once a message has MAX_BLOCKS blocks or
+    MAX_MESSAGE_LENGTH characters, blocks continue in a follow-up message; and
+    after MAX_FOLLOW_UPS follow-ups the rest is dropped, with a notice linking
+    to the full event when there's a link.
+    """
+
+    def __init__(self, link=None):
+        self.link = link
+        self.messages = [[]]
+        self.length = 0
+        self.truncated = False
+
+    def add(self, block):
+        if isinstance(block, dict) and block.get("type") == "section":
+            text = block["text"]["text"]
+            for n, chunk in enumerate(split_section_text(text)):
+                if n == 0:
+                    # The first chunk keeps the section's accessory, if any
+                    chunk_block = dict(block, text=dict(block["text"], text=chunk))
+                else:
+                    chunk_block = section_block(chunk)
+                self.append(chunk_block, len(chunk))
+        else:
+            self.append(block, len(str(block)))
+        return self
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.add(block)
+        return self
+
+    def append(self, block, length):
+        if self.truncated:
+            return
+        message = self.messages[-1]
+        # One block is always kept free for the truncation notice
+        if message and (
+            len(message) >= MAX_BLOCKS - 1 or self.length + length > MAX_MESSAGE_LENGTH
+        ):
+            if len(self.messages) > MAX_FOLLOW_UPS:
+                self.truncate()
+                return
+            message = []
+            self.messages.append(message)
+            self.length = 0
+        message.append(block)
+        self.length += length
+
+    def truncate(self):
+        notice = "_This message was too long for Slack, so it has been truncated._"
+        if self.link:
+            notice += f" <{self.link}|View the full event>"
+        self.messages[-1].append(section_block(notice))
+        self.truncated = True
+
+
+def alarm_console_link(alarm, all_alarms=False):
+    """
+    Function to get the CloudWatch console link for an alarm
+
+    :param alarm: alarm dict
+    :param all_alarms: link to all alarms in the alarm's region instead
+    :returns: URL, or None without the AlarmArn to find the region in
+    """
+    try:
+        region = alarm["AlarmArn"].split(":")[3]
+    except (KeyError, IndexError):
+        return None
+    url = f"https://console.aws.amazon.com/cloudwatch/home?region={region}#alarmsV2:"
+    if all_alarms:
+        return url
+    return url + f'alarm/{quote(alarm["AlarmName"], safe="")}'
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class SlackConfig:
+    """
+    SlackConfig holds the Slack settings from the environment. It's built and
+    validated once per container, so a missing variable fails the Lambda init
+    phase rather than messages in the middle of an alarm storm, and can't be
+    changed afterwards.
+    """
+
+    __slots__ = (
+        "webhook_url_parameter",
+        "bot_token_parameter",
+        "channel",
+        "username",
+        "icon",
+        "alarm_emoji",
+        "warn_emoji",
+        "notice_emoji",
+        "ok_emoji",
+    )
+
+    def __init__(
+        self,
+        channel,
+        username,
+        icon,
+        webhook_url_parameter="",
+        bot_token_parameter="",
+        alarm_emoji="",
+        warn_emoji="",
+        notice_emoji="",
+        ok_emoji="",
+    ):
+        values = locals()
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+    @classmethod
+    def from_environ(cls, environ=None, transport=None):
+        """
+        Reads the config from slack_* environment variables, raising a
+        ConfigError naming every required variable that's missing or empty
+        """
+        if environ is None:
+            environ = os.environ
+        if transport is None:
+            transport = TRANSPORT
+
+        required = ["slack_channel", "slack_username", "slack_icon"]
+        if transport == "web_api":
+            required.append("slack_bot_token_parameter")
+        else:
+            required.append("slack_webhook_url_parameter")
+        missing = [name for name in required if not environ.get(name)]
+        if missing:
+            raise ConfigError("missing environment variables: %s" % ", ".join(missing))
+
+        return cls(**{name: environ.get(f"slack_{name}", "") for name in cls.__slots__})
+
 
 class SlackNotificationFormatter:
     def __init__(
-        self, event, default_slack_username, default_slack_icon, slack_channel
+        self,
+        event=None,
+        default_slack_username=None,
+        default_slack_icon=None,
+        slack_channel=None,
+        config=None,
     ):
+        if config is None:
+            config = get_config()
         self.event = event
-        self.default_slack_username = default_slack_username
-        self.default_slack_icon = default_slack_icon
-        self.slack_channel = slack_channel
+        self.default_slack_username = default_slack_username or config.username
+        self.default_slack_icon = default_slack_icon or config.icon
+        self.slack_channel = slack_channel or config.channel
+        self.alarm_emoji = config.alarm_emoji
+        self.warn_emoji = config.warn_emoji
+        self.notice_emoji = config.notice_emoji
+        self.ok_emoji = config.ok_emoji
+
+    def format_message(self, eventmsg):
+        """
+        Formats a message with the formatter registered for its event type,
+        or as a generic message
+        """
+        return self.format_message_with_type(eventmsg)[1]
+
+    def format_message_with_type(self, eventmsg):
+        """
+        Formats a message like format_message, also returning the event type
+        it was formatted as ("generic" for a generic message)
+        """
+        try:
+            data = json.loads(eventmsg)
+            event_type = get_event_type(data)
+            if event_type in FORMATTERS:
+                if LOG_MODE == "full":
+                    logger.info(event_type)
+                formatter, slack_username, slack_icon = FORMATTERS[event_type]
+                payload = formatter(
+                    self, data, slack_username=slack_username, slack_icon=slack_icon
+                )
+                if payload is not None:
+                    return event_type, payload
+        except Exception as e:
+            if LOG_MODE == "full":
+                logger.info("exception")
+            logger.error(e)
+
+        if LOG_MODE == "full":
+            logger.info("generic")
+        return "generic", self.format_generic_slack_message(eventmsg)
 
+    @register_formatter(
+        "AWS Health Event", slack_username="AWS Health Event", slack_icon=":aws:"
+    )
     def format_aws_health_event(self, data={}, slack_username="", slack_icon=""):
 
         details = data["detail"]
@@ -104,14 +494,25 @@ class SlackNotificationFormatter:
             blocks=blocks,
             slack_username=slack_username,
             slack_icon=slack_icon,
+            link=(
+                "https://health.aws.amazon.com/health/home#/account/event-log"
+                f'?eventID={quote(details["eventArn"], safe="")}'
+            ),
         )
 
     # NOTE: CodePipeline updates MUST come from CodeStar Notifications as those are 'processed' events
+    @register_formatter(
+        "CodePipeline Pipeline Execution State Change",
+        slack_username="AWS CodePipeline",
+    )
     def format_codepipeline_message(self, data={}, slack_username="", slack_icon=""):
+        # Only failures are posted; anything else is a generic message
+        if data["detail"]["state"] != "FAILED":
+            return None
+
         details = data["additionalAttributes"]
 
-        slackAlarmEmoji = os.environ["slack_alarm_emoji"]
-        alertState = f"{slackAlarmEmoji} *FAILED:* "
+        alertState = f"{self.alarm_emoji} *FAILED:* "
 
         blocks = [self.blocks_section(f'{alertState} *{data["detail"]["pipeline"]}*')]
         detail_list = []
@@ -137,27 +538,27 @@ class SlackNotificationFormatter:
             slack_icon=slack_icon,
         )
 
+    @register_formatter(
+        "Lambda Monitor Notification",
+        slack_username="Lambda Monitor Notification",
+        slack_icon=":aws:",
+    )
     def format_lambda_monitor_notification(
         self, data={}, slack_username="", slack_icon=""
     ):
         details = data["detail"]
 
-        slackAlarmEmoji = os.environ["slack_alarm_emoji"]
-        slackWarnEmoji = os.environ["slack_warn_emoji"]
-        slackNoticeEmoji = os.environ["slack_notice_emoji"]
-        slackOkEmoji = os.environ["slack_ok_emoji"]
-
         match data["state"]:
             case "ALARM":
-                alertState = f"{slackAlarmEmoji} *ALARM:* "
+                alertState = f"{self.alarm_emoji} *ALARM:* "
             case "WARN":
-                alertState = f"{slackWarnEmoji} *WARN:* "
+                alertState = f"{self.warn_emoji} *WARN:* "
             case "NOTICE":
-                alertState = f"{slackNoticeEmoji} *NOTICE:* "
+                alertState = f"{self.notice_emoji} *NOTICE:* "
             case "OK":
-                alertState = f"{slackOkEmoji} *OK:* "
+                alertState = f"{self.ok_emoji} *OK:* "
             case _:
-                alertState = f"{slackNoticeEmoji} *NOTICE:* "
+                alertState = f"{self.notice_emoji} *NOTICE:* "
 
         blocks = [self.blocks_section(f'{alertState} *{data["name"]}*')]
         blocks.append(self.blocks_section(data["description"]))
@@ -181,16 +582,16 @@ class SlackNotificationFormatter:
             slack_icon=slack_icon,
         )
 
+    @register_formatter(
+        "CloudWatch Alarm", slack_username="AWS Cloudwatch Alarm", slack_icon=":aws:"
+    )
     def format_cloudwatch_alarm_message(
         self, data={}, slack_username="", slack_icon=""
     ):
-        slackAlarmEmoji = os.environ["slack_alarm_emoji"]
-        slackOkEmoji = os.environ["slack_ok_emoji"]
-
         if data["NewStateValue"] == "ALARM":
-            alertState = f"{slackAlarmEmoji} *ALARM:* "
+            alertState = f"{self.alarm_emoji} *ALARM:* "
         else:
-            alertState = f"{slackOkEmoji} *OK:* "
+            alertState = f"{self.ok_emoji} *OK:* "
 
         blocks = [self.blocks_section(f'{alertState} *{data["AlarmName"]}*')]
 
@@ -202,14 +603,14 @@ class SlackNotificationFormatter:
         except:
             formatted_time = data["StateChangeTime"]
 
-        match = re.search("Runbook: (https://\\S+)", data["AlarmDescription"])
+        match = RUNBOOK_PATTERN.search(data["AlarmDescription"])
         if match:
             runbook_url = match.group(1)
 
             blocks[0]["accessory"] = self.runbook_blocks_button(runbook_url)
 
-            description_no_runbook = re.sub(
-                "Runbook: (https://\\S+)\n", "", data["AlarmDescription"]
+            description_no_runbook = RUNBOOK_LINE_PATTERN.sub(
+                "", data["AlarmDescription"]
             )
             blocks[0]["text"]["text"] += f"\n{description_no_runbook}"
         else:
@@ -242,6 +643,38 @@ class SlackNotificationFormatter:
             blocks=blocks,
             slack_username=slack_username,
             slack_icon=slack_icon,
+            link=alarm_console_link(data),
+        )
+
+    def format_cloudwatch_alarm_digest(
+        self, alarms=[], group="", slack_username="", slack_icon=""
+    ):
+        if alarms[0]["NewStateValue"] == "ALARM":
+            alertState = f"{self.alarm_emoji} *ALARM:* "
+        else:
+            alertState = f"{self.ok_emoji} *OK:* "
+
+        header = f"{alertState} *{len(alarms)} {group} alarms*"
+        blocks = [self.blocks_section(header)]
+
+        lines = []
+        for alarm in alarms:
+            reason = alarm["NewStateReason"]
+            if len(reason) > 200:
+                reason = reason[:199] + "…"
+            lines.append(f'• *{alarm["AlarmName"]}*: {reason}')
+
+        blocks.append(self.blocks_section("\n".join(lines)))
+        blocks.append(self.blocks_section(f'*Region*: {alarms[0]["Region"]}'))
+
+        msgtext = "\n".join([header] + [f'*{alarm["AlarmName"]}*' for alarm in alarms])
+
+        return self.compose_payload(
+            text=msgtext,
+            blocks=blocks,
+            slack_username=slack_username,
+            slack_icon=slack_icon,
+            link=alarm_console_link(alarms[0], all_alarms=True),
         )
 
     def format_generic_slack_message(
@@ -252,6 +685,7 @@ class SlackNotificationFormatter:
             text=eventmsg, slack_username=slack_username, slack_icon=slack_icon
         )
 
+    @register_formatter("Incident Manager", slack_username="AWS Incident Manager")
     def format_aws_incident_manager_message(
         self, data={}, slack_username="", slack_icon=""
     ):
@@ -279,7 +713,15 @@ class SlackNotificationFormatter:
             slack_icon=slack_icon,
         )
 
-    def compose_payload(self, text="", blocks=None, slack_username="", slack_icon=""):
+    def compose_payload(
+        self, text="", blocks=None, slack_username="", slack_icon="", link=None
+    ):
+        """
+        Composes the payload, keeping it within Slack's limits: blocks are
+        run through a BlockBuilder, with any that don't fit in one message
+        sent in follow-ups. Text too long to send whole is truncated, and if
+        there are no blocks it's sent in full as sections instead.
+        """
         msg = {
             "channel": self.slack_channel,
             "username": (
@@ -289,13 +731,24 @@ class SlackNotificationFormatter:
             "icon_emoji": slack_icon if slack_icon else self.default_slack_icon,
         }
 
-        if blocks:
-            msg["blocks"] = blocks
+        builder = BlockBuilder(link=link)
+        if len(text) > MAX_TEXT_LENGTH:
+            msg["text"] = text[: MAX_TEXT_LENGTH - 1] + "…"
+            if not blocks:
+                blocks = [section_block(text)]
+        builder.extend(blocks or [])
 
-        return msg
+        if builder.messages[0]:
+            msg["blocks"] = builder.messages[0]
+
+        follow_ups = [
+            dict(msg, text="(continued)", blocks=message_blocks)
+            for message_blocks in builder.messages[1:]
+        ]
+        return SlackPayload(msg, follow_ups=follow_ups)
 
     def blocks_section(self, txt):
-        return {"type": "section", "text": {"type": "mrkdwn", "text": txt}}
+        return section_block(txt)
 
     def runbook_blocks_button(self, runbook_url):
         return {
@@ -311,115 +764,953 @@ class SlackNotificationFormatter:
         }
 
 
-def get_slack_message_payload(event):
-    formatter = SlackNotificationFormatter(
-        event=event,
-        default_slack_username=os.environ["slack_username"],
-        default_slack_icon=os.environ["slack_icon"],
-        slack_channel=os.environ["slack_channel"],
+def get_record_message(record):
+    """
+    Function to get the message from an SNS record, or from an SQS record
+    carrying an SNS notification (or a raw message, with raw delivery)
+
+    :param record: one of the event's Records
+    :returns: message string
+    """
+    if "Sns" in record:
+        return record["Sns"]["Message"]
+
+    body = record["body"]
+    try:
+        envelope = json.loads(body)
+    except ValueError:
+        return body
+    if isinstance(envelope, dict) and envelope.get("Type") == "Notification":
+        return envelope["Message"]
+    return body
+
+
+def get_record_id(record):
+    """
+    Function to get the ID Lambda uses to identify a record in a batch
+
+    :param record: one of the event's Records
+    :returns: SNS MessageId or SQS messageId
+    """
+    if "Sns" in record:
+        return record["Sns"].get("MessageId")
+    return record.get("messageId")
+
+
+def get_config():
+    """
+    Function to get the container's SlackConfig, reading it from the
+    environment the first time
+
+    :returns: SlackConfig
+    """
+    global config
+    if config is None:
+        config = SlackConfig.from_environ()
+    return config
+
+
+def get_formatter(event=None):
+    """
+    Function to get the container's SlackNotificationFormatter. Formatters
+    keep no state between messages, so one is shared by every event.
+
+    :param event: unused, kept for callers passing the event being formatted
+    :returns: SlackNotificationFormatter
+    """
+    global notification_formatter
+    if notification_formatter is None:
+        notification_formatter = SlackNotificationFormatter(config=get_config())
+    return notification_formatter
+
+
+def get_slack_message_payload(event, index=0, formatter=None):
+    return format_record(event, index, formatter)[1]
+
+
+def format_record(event, index=0, formatter=None):
+    """
+    Function to format one record of the event
+
+    :param event: lambda expected event object
+    :param index: index of the record in event["Records"]
+    :param formatter: SlackNotificationFormatter to format it with
+    :returns: the event type it was formatted as, and the Slack payload
+    """
+    if formatter is None:
+        formatter = get_formatter(event)
+
+    return formatter.format_message_with_type(
+        get_record_message(event["Records"][index])
     )
 
-    eventmsg = event["Records"][0]["Sns"]["Message"]
 
+@contextlib.contextmanager
+def startup_timer(name):
+    """
+    Context manager recording how long a cold start step took in
+    startup_timings
+
+    :param name: step name
+    """
+    started = time.perf_counter()
     try:
-        data = json.loads(eventmsg)
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 3)
 
-        if (
-            "detailType" in data
-            and data["detailType"] == "CodePipeline Pipeline Execution State Change"
-            and data["detail"]["state"] == "FAILED"
-        ):
-            return formatter.format_codepipeline_message(
-                data,
-                slack_username="AWS CodePipeline",
+
+def get_ssm_client():
+    """
+    Function to get the SSM client, importing boto3 and creating the client
+    on first use
+
+    :returns: boto3 SSM client
+    """
+    global ssm_client
+    if ssm_client is None:
+        with startup_timer("boto3_import_ms"):
+            import boto3
+        with startup_timer("ssm_client_ms"):
+            ssm_client = boto3.client("ssm")
+    return ssm_client
+
+
+def get_http_pool():
+    """
+    Function to get the HTTP connection pool, creating it on first use. The
+    pool keeps connections to Slack alive, so warm invocations skip the TLS
+    handshake.
+
+    :returns: urllib3.PoolManager
+    """
+    global http_pool
+    if http_pool is None:
+        with startup_timer("http_pool_ms"):
+            http_pool = urllib3.PoolManager(maxsize=max(1, MAX_CONCURRENT_SENDS))
+    return http_pool
+
+
+def get_parameter_value(name, cache, force_refresh=False):
+    """
+    Function to get a decrypted SSM parameter, cached for WEBHOOK_URL_TTL
+    seconds
+
+    :param name: SSM parameter name
+    :param cache: dict to cache the value in
+    :param force_refresh: read from SSM even if the cached value hasn't expired
+    :returns: parameter value
+    """
+    now = time.monotonic()
+    if force_refresh or not cache["url"] or (now >= cache["expires"]):
+        cache["url"] = get_ssm_client().get_parameter(Name=name, WithDecryption=True)[
+            "Parameter"
+        ]["Value"]
+        cache["expires"] = now + WEBHOOK_URL_TTL
+    return cache["url"]
+
+
+def get_slack_webhook_url(force_refresh=False):
+    """
+    Function to get the decrypted Slack webhook URL from SSM, cached for
+    WEBHOOK_URL_TTL seconds
+
+    :param force_refresh: read from SSM even if the cached URL hasn't expired
+    :returns: Slack webhook URL
+    """
+    return get_parameter_value(
+        get_config().webhook_url_parameter, webhook_url_cache, force_refresh
+    )
+
+
+def get_slack_bot_token(force_refresh=False):
+    """
+    Function to get the decrypted Slack bot token from SSM, cached like the
+    webhook URL
+
+    :param force_refresh: read from SSM even if the cached token hasn't expired
+    :returns: Slack bot token
+    """
+    return get_parameter_value(
+        get_config().bot_token_parameter, bot_token_cache, force_refresh
+    )
+
+
+class TokenBucket:
+    """
+    TokenBucket spaces out calls to rate per second on average, with bursts
+    of up to burst calls.
+    """
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Takes a token, returning the seconds to wait before it can be used.
+        Callers get tokens in the order they ask for them.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+    def pause(self, seconds):
+        """
+        Holds back every caller for at least seconds, as when Slack asks us to
+        with Retry-After
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 1.0 - seconds * self.rate)
+
+
+class SlackResponse:
+    """
+    SlackResponse is the outcome of posting a message: the HTTP status (a Web
+    API error reported with a 200 counts as a 400), the response body and
+    headers, and for the Web API the ts identifying the posted message.
+    """
+
+    def __init__(self, status, data, headers=None, ts=None):
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+        self.ts = ts
+
+
+class SlackTransport(ABC):
+    """
+    SlackTransport posts messages to Slack, no faster than CHANNEL_RATE per
+    second to each channel. When Slack responds 429, every message to that
+    channel waits for the Retry-After it asks for before trying again, for up
+    to MAX_RETRY_WAIT seconds in all.
+    """
+
+    # Whether post() returns the ts of posted messages, to thread replies under
+    threads = False
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, channel):
+        with self.lock:
+            if channel not in self.buckets:
+                self.buckets[channel] = TokenBucket(CHANNEL_RATE)
+            return self.buckets[channel]
+
+    @abstractmethod
+    def post(self, body):
+        pass
+
+    def send(self, payload):
+        bucket = self.bucket(payload.get("channel"))
+        # Serialized once, however many times it's posted
+        body = json.dumps(payload).encode("utf-8")
+        waited = 0.0
+        while True:
+            bucket.wait()
+            response = self.post(body)
+            if response.status != 429:
+                return response
+
+            try:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1.0
+            waited += retry_after
+            if waited > MAX_RETRY_WAIT:
+                return response
+            logger.info(
+                {"rate_limited": payload.get("channel"), "retry_after": retry_after}
             )
-        elif "AlarmName" in data and "AlarmDescription" in data:
-            logger.info("cloudwatch")
-            return formatter.format_cloudwatch_alarm_message(
-                data,
-                slack_username="AWS Cloudwatch Alarm",
-                slack_icon=":aws:",
+            bucket.pause(retry_after)
+
+
+class WebhookTransport(SlackTransport):
+    """
+    WebhookTransport posts to the incoming webhook URL. If Slack rejects the
+    URL with a 4xx, it may have been rotated, so the URL is read from SSM again
+    and, if it changed, the message is sent once more.
+    """
+
+    def post(self, body):
+        url = get_slack_webhook_url()
+        response = get_http_pool().request("POST", url, body=body)
+
+        if 400 <= response.status < 500 and response.status != 429:
+            new_url = get_slack_webhook_url(force_refresh=True)
+            if new_url != url:
+                logger.info("Slack webhook URL changed, resending")
+                response = get_http_pool().request("POST", new_url, body=body)
+
+        return SlackResponse(response.status, response.data, response.headers)
+
+
+class WebApiTransport(SlackTransport):
+    """
+    WebApiTransport posts with chat.postMessage, using the bot token from SSM.
+    It returns the ts of each message, so replies can be threaded under it.
+    """
+
+    threads = True
+
+    def request(self, body, token):
+        return get_http_pool().request(
+            "POST",
+            SLACK_POST_MESSAGE_URL,
+            body=body,
+            headers={
+                "Content-Type": "application/json; charset=utf-8",
+                "Authorization": f"Bearer {token}",
+            },
+        )
+
+    def post(self, body):
+        token = get_slack_bot_token()
+        response = self.request(body, token)
+        result = self.result(response)
+
+        if result.get("error") in TOKEN_ERRORS:
+            new_token = get_slack_bot_token(force_refresh=True)
+            if new_token != token:
+                logger.info("Slack bot token changed, resending")
+                response = self.request(body, new_token)
+                result = self.result(response)
+
+        status = response.status
+        if status == 200 and not result.get("ok"):
+            status = 400
+        return SlackResponse(status, response.data, response.headers, result.get("ts"))
+
+    def result(self, response):
+        try:
+            return json.loads(response.data)
+        except (TypeError, ValueError):
+            return {}
+
+
+def get_transport():
+    """
+    Function to get the SlackTransport chosen by TRANSPORT, creating it on
+    first use so its rate limits hold across warm invocations
+
+    :returns: SlackTransport
+    """
+    global transport
+    if transport is None:
+        if TRANSPORT == "web_api":
+            transport = WebApiTransport()
+        else:
+            transport = WebhookTransport()
+    return transport
+
+
+def send_slack_notification(payload):
+    """
+    Function to forward messages to Slack
+
+    :param payload: Slack message payload
+    :returns: SlackResponse
+    """
+    return get_transport().send(payload)
+
+
+class ThreadStore(ABC):
+    """
+    ThreadStore remembers the ts of the message each alarm's ALARM was posted
+    in, so its OK can be threaded under it.
+    """
+
+    @abstractmethod
+    def get(self, alarm_name):
+        pass
+
+    @abstractmethod
+    def put(self, alarm_name, ts):
+        pass
+
+    @abstractmethod
+    def delete(self, alarm_name):
+        pass
+
+
+class MemoryThreadStore(ThreadStore):
+    def __init__(self):
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def get(self, alarm_name):
+        with self.lock:
+            ts, expires = self.threads.get(alarm_name, (None, 0))
+        return ts if time.time() < expires else None
+
+    def put(self, alarm_name, ts):
+        with self.lock:
+            self.threads[alarm_name] = (ts, time.time() + THREAD_TTL)
+
+    def delete(self, alarm_name):
+        with self.lock:
+            self.threads.pop(alarm_name, None)
+
+
+class DynamoDBThreadStore(ThreadStore):
+    """
+    DynamoDBThreadStore keeps threads in a DynamoDB table keyed by
+    alarm_name, whose "expires" attribute is its TTL attribute.
+    """
+
+    def __init__(self, table):
+        import boto3
+
+        self.table = table
+        self.dynamodb_client = boto3.client("dynamodb")
+
+    def get(self, alarm_name):
+        item = self.dynamodb_client.get_item(
+            TableName=self.table, Key={"alarm_name": {"S": alarm_name}}
+        ).get("Item")
+        # DynamoDB deletes expired items eventually, not straight away
+        if item is None or int(item["expires"]["N"]) < time.time():
+            return None
+        return item["ts"]["S"]
+
+    def put(self, alarm_name, ts):
+        self.dynamodb_client.put_item(
+            TableName=self.table,
+            Item={
+                "alarm_name": {"S": alarm_name},
+                "ts": {"S": ts},
+                "expires": {"N": str(int(time.time() + THREAD_TTL))},
+            },
+        )
+
+    def delete(self, alarm_name):
+        self.dynamodb_client.delete_item(
+            TableName=self.table, Key={"alarm_name": {"S": alarm_name}}
+        )
+
+
+def get_thread_store():
+    global thread_store
+    if thread_store is None:
+        if THREAD_TABLE:
+            thread_store = DynamoDBThreadStore(THREAD_TABLE)
+        else:
+            thread_store = MemoryThreadStore()
+    return thread_store
+
+
+class NotificationBuffer(ABC):
+    """
+    NotificationBuffer holds messages waiting to be sent to Slack, so that
+    they can be coalesced first. Like an SQS queue, put() adds a message and
+    drain() takes out everything buffered so far.
+    """
+
+    @abstractmethod
+    def put(self, index, message):
+        pass
+
+    @abstractmethod
+    def drain(self):
+        pass
+
+
+class LocalNotificationBuffer(NotificationBuffer):
+    """
+    LocalNotificationBuffer buffers messages in memory, for the records of a
+    single invocation. With an SQS subscription, the event source mapping's
+    batching window decides how long messages are buffered for.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def put(self, index, message):
+        with self.lock:
+            self.messages.append((index, message))
+
+    def drain(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        return messages
+
+
+def get_alarm(message):
+    """
+    Function to parse a CloudWatch alarm notification
+
+    :param message: SNS message string
+    :returns: alarm dict, or None if the message isn't a CloudWatch alarm
+    """
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return None
+    # Coalescing needs the state, so alarm-like messages without one are
+    # left to the formatters
+    if isinstance(data, dict) and all(
+        key in data for key in ("AlarmName", "AlarmDescription", "NewStateValue")
+    ):
+        return data
+    return None
+
+
+def is_repeated_alarm(alarm):
+    """
+    Function to check whether an alarm is only repeating the state it's
+    already in, either by its own account (e.g. ALARM -> ALARM) or because
+    it was posted in that state in the last DEDUP_SECONDS
+
+    :param alarm: alarm dict
+    :returns: True if the alarm shouldn't be posted again
+    """
+    if alarm.get("OldStateValue") == alarm["NewStateValue"]:
+        return True
+    with alarm_states_lock:
+        last = alarm_states.get(alarm["AlarmName"])
+    return (
+        last is not None
+        and last[0] == alarm["NewStateValue"]
+        and time.monotonic() - last[1] < DEDUP_SECONDS
+    )
+
+
+def remember_alarm_states(alarms):
+    """
+    Function to record that alarms were posted in their current states
+
+    :param alarms: list of (AlarmName, state)
+    """
+    now = time.monotonic()
+    with alarm_states_lock:
+        for name, state in alarms:
+            alarm_states[name] = (state, now)
+
+
+def get_digest_group(alarm):
+    """
+    Function to get the group an alarm is coalesced into: the part of its
+    name matching DIGEST_GROUP_PATTERN, its state, and the window of
+    DIGEST_WINDOW_SECONDS its state changed in
+
+    :param alarm: alarm dict
+    :returns: tuple of group name, state and window
+    """
+    match = DIGEST_GROUP_PATTERN.search(alarm["AlarmName"])
+    group = match.group(0) if match else alarm["AlarmName"]
+    try:
+        changed = datetime.datetime.strptime(
+            alarm["StateChangeTime"], "%Y-%m-%dT%H:%M:%S.%f%z"
+        )
+        window = int(changed.timestamp()) // max(1, DIGEST_WINDOW_SECONDS)
+    except (KeyError, ValueError):
+        window = None
+    return (group, alarm["NewStateValue"], window)
+
+
+def coalesce_notifications(event, buffer, formatter=None, metrics=None):
+    """
+    Function to turn buffered messages into the notifications to send.
+    Repeated alarms are dropped, and CloudWatch alarms in the same digest
+    group are posted as one digest once there are DIGEST_MIN_ALARMS of them.
+
+    :param event: lambda expected event object
+    :param buffer: NotificationBuffer of (record index, message)
+    :param formatter: SlackNotificationFormatter to format messages with
+    :param metrics: Metrics to count suppressed alarms in
+    :returns: list of notification dicts, with the Slack "payload", the
+              "formatter" (event type) it was formatted as, the "indexes" of
+              the records it covers and the "alarms" it posts
+    """
+    if formatter is None:
+        formatter = get_formatter(event)
+
+    notifications = []
+    groups = {}
+    seen = {}
+    for index, message in buffer.drain():
+        alarm = get_alarm(message)
+        if alarm is None:
+            event_type, payload = format_record(event, index, formatter)
+            notifications.append(
+                {
+                    "payload": payload,
+                    "formatter": event_type,
+                    "indexes": [index],
+                    "alarms": [],
+                }
             )
-        elif "detail-type" in data and data["detail-type"] == "AWS Health Event":
-            logger.info("health")
-            return formatter.format_aws_health_event(
-                data,
-                slack_username="AWS Health Event",
-                slack_icon=":aws:",
+            continue
+
+        key = (alarm["AlarmName"], alarm["NewStateValue"])
+        if key in seen:
+            # Duplicate within the batch: sent (or not) with the first one
+            seen[key].append(index)
+            continue
+        if is_repeated_alarm(alarm):
+            if LOG_MODE == "full":
+                logger.info({"suppressed": alarm["AlarmName"]})
+            if metrics is not None:
+                metrics.count("CloudWatch Alarm", "Suppressed")
+            continue
+        seen[key] = [index]
+        groups.setdefault(get_digest_group(alarm), []).append((index, alarm))
+
+    for (group, _, _), members in groups.items():
+        alarms = [alarm for _, alarm in members]
+        keys = [(alarm["AlarmName"], alarm["NewStateValue"]) for alarm in alarms]
+        if DIGEST_MIN_ALARMS and len(members) >= DIGEST_MIN_ALARMS:
+            notifications.append(
+                {
+                    "payload": formatter.format_cloudwatch_alarm_digest(
+                        alarms,
+                        group=group,
+                        slack_username="AWS Cloudwatch Alarm",
+                        slack_icon=":aws:",
+                    ),
+                    "formatter": "CloudWatch Alarm Digest",
+                    "indexes": [i for key in keys for i in seen[key]],
+                    "alarms": keys,
+                }
             )
-        elif (
-            "detail-type" in data
-            and data["detail-type"] == "Lambda Monitor Notification"
-        ):
-            logger.info("lambda")
-            return formatter.format_lambda_monitor_notification(
-                data,
-                slack_username="Lambda Monitor Notification",
-                slack_icon=":aws:",
+            continue
+        for (index, _), key in zip(members, keys):
+            event_type, payload = format_record(event, index, formatter)
+            notifications.append(
+                {
+                    "payload": payload,
+                    "formatter": event_type,
+                    "indexes": seen[key],
+                    "alarms": [key],
+                }
             )
-        elif "IncidentManagerEvent" in data:
-            logger.info("incidentmanager")
-            return formatter.format_aws_incident_manager_message(
-                data,
-                slack_username="AWS Incident Manager",
+    return notifications
+
+
+def thread_alarm_reply(notification):
+    """
+    Function to thread an OK notification under the message its alarm's ALARM
+    was posted in, when there is one
+
+    :param notification: notification dict from coalesce_notifications
+    """
+    for name, state in notification["alarms"]:
+        if state == "OK":
+            ts = get_thread_store().get(name)
+            if ts:
+                notification["payload"]["thread_ts"] = ts
+                return
+
+
+def remember_alarm_threads(notification, ts):
+    """
+    Function to remember the message ALARMs were posted in, and forget those of
+    alarms that are OK again
+
+    :param notification: notification dict from coalesce_notifications
+    :param ts: ts of the posted message
+    """
+    for name, state in notification["alarms"]:
+        if state == "ALARM" and ts:
+            get_thread_store().put(name, ts)
+        elif state == "OK":
+            get_thread_store().delete(name)
+
+
+class Metrics:
+    """
+    Metrics counts what an invocation did by formatter (event type), and logs
+    it as one CloudWatch Embedded Metric Format (EMF) record per formatter,
+    which CloudWatch turns into metrics without any API calls.
+    """
+
+    units = {"SendLatency": "Milliseconds"}
+
+    def __init__(self):
+        self.formatters = {}
+        self.lock = threading.Lock()
+
+    def count(self, formatter, name, value=1):
+        with self.lock:
+            metrics = self.formatters.setdefault(formatter, {})
+            metrics[name] = metrics.get(name, 0) + value
+
+    def record_latency(self, formatter, milliseconds):
+        with self.lock:
+            values = self.formatters.setdefault(formatter, {}).setdefault(
+                "SendLatency", []
             )
+            if len(values) < MAX_METRIC_VALUES:
+                values.append(round(milliseconds, 3))
+
+    def record_status(self, formatter, status):
+        """
+        Counts a Slack response by status: Status2xx, Status4xx, Status429 or
+        Status5xx
+        """
+        if status == 429:
+            self.count(formatter, "Status429")
         else:
-            logger.info("generic")
-            return formatter.format_generic_slack_message(
-                eventmsg,
+            self.count(formatter, f"Status{status // 100}xx")
+
+    def records(self):
+        timestamp = int(time.time() * 1000)
+        records = []
+        with self.lock:
+            for formatter, metrics in sorted(self.formatters.items()):
+                record = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": METRICS_NAMESPACE,
+                                "Dimensions": [["Formatter"]],
+                                "Metrics": [
+                                    {
+                                        "Name": name,
+                                        "Unit": self.units.get(name, "Count"),
+                                    }
+                                    for name in sorted(metrics)
+                                ],
+                            }
+                        ],
+                    },
+                    "Formatter": formatter,
+                }
+                record.update(metrics)
+                records.append(record)
+        return records
+
+    def emit(self):
+        if METRICS_NAMESPACE:
+            for record in self.records():
+                print(json.dumps(record))
+
+
+def truncate_log(value):
+    """
+    Function to cut a value down to LOG_MAX_LENGTH characters for logging
+
+    :param value: string or bytes
+    :returns: string
+    """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    value = str(value)
+    if len(value) > LOG_MAX_LENGTH:
+        return value[:LOG_MAX_LENGTH] + "…"
+    return value
+
+
+def log_notification(notification, response=None, error=None, latency_ms=None):
+    """
+    Function to log the outcome of sending a notification: everything in
+    "full" LOG_MODE, or a truncated JSON line for failures and a sample of
+    successes in "structured" LOG_MODE
+
+    :param notification: notification dict from coalesce_notifications
+    :param response: SlackResponse, if Slack responded
+    :param error: exception raised sending it, if any
+    :param latency_ms: time taken to send it
+    """
+    failed = error is not None or response.status != 200
+
+    if LOG_MODE == "full":
+        if error is not None:
+            logger.error({"records": notification["indexes"], "error": str(error)})
+        elif failed:
+            logger.error(
+                {
+                    "records": notification["indexes"],
+                    "status_code": response.status,
+                    "response": response.data,
+                }
             )
+        else:
+            logger.info(
+                {
+                    "records": notification["indexes"],
+                    "slack_payload": notification["payload"],
+                    "status_code": response.status,
+                    "response": response.data,
+                }
+            )
+        return
+
+    if not failed and random.random() >= LOG_SAMPLE_RATE:
+        return
+    entry = {
+        "records": notification["indexes"],
+        "formatter": notification.get("formatter"),
+        "text": truncate_log(notification["payload"].get("text", "")),
+        "latency_ms": latency_ms,
+    }
+    if error is not None:
+        entry["error"] = truncate_log(error)
+    else:
+        entry["status_code"] = response.status
+        entry["response"] = truncate_log(response.data)
+    if failed:
+        logger.error(json.dumps(entry))
+    else:
+        entry["sample_rate"] = LOG_SAMPLE_RATE
+        logger.info(json.dumps(entry))
+
 
+def send_notification(notification, metrics=None):
+    """
+    Function to forward a coalesced notification to Slack
+
+    :param notification: notification dict from coalesce_notifications
+    :param metrics: Metrics to count the notification in
+    :returns: True if Slack accepted the message
+    """
+    if metrics is None:
+        metrics = Metrics()
+    formatter = notification.get("formatter", "generic")
+    metrics.count(formatter, "Messages")
+    metrics.count(formatter, "Records", len(notification["indexes"]))
+
+    threads = get_transport().threads
+    started = time.perf_counter()
+    try:
+        if threads:
+            thread_alarm_reply(notification)
+        response = send_slack_notification(notification["payload"])
     except Exception as e:
-        logger.info("exception")
-        logger.error(e)
-        return formatter.format_generic_slack_message(
-            eventmsg,
-        )
+        metrics.count(formatter, "SendErrors")
+        log_notification(notification, error=e)
+        return False
+    latency_ms = (time.perf_counter() - started) * 1000
+    metrics.record_latency(formatter, latency_ms)
+    metrics.record_status(formatter, response.status)
+    log_notification(notification, response=response, latency_ms=latency_ms)
 
+    if response.status != 200:
+        return False
 
-def send_slack_notification(payload):
+    remember_alarm_states(notification["alarms"])
+    if threads:
+        try:
+            remember_alarm_threads(notification, response.ts)
+        except Exception as e:
+            logger.error({"records": notification["indexes"], "error": str(e)})
+    send_follow_ups(notification, response.ts if threads else None)
+    return True
+
+
+def send_follow_ups(notification, ts=None):
     """
-    Function to forward messages to Slack
+    Function to send the follow-up messages continuing a notification's
+    payload, in a thread under it when there's a ts. The notification has
+    already been posted, so failures are logged rather than retried.
 
-    :param payload: Slack message payload
-    :returns: urllib3.response
+    :param notification: notification dict from coalesce_notifications
+    :param ts: ts of the posted message
     """
-    ssm = boto3.client("ssm")
-    slackUrlParam = os.environ["slack_webhook_url_parameter"]
-    url = ssm.get_parameter(Name=slackUrlParam, WithDecryption=True)["Parameter"][
-        "Value"
-    ]
+    thread_ts = notification["payload"].get("thread_ts") or ts
+    for follow_up in getattr(notification["payload"], "follow_ups", []):
+        if thread_ts:
+            follow_up["thread_ts"] = thread_ts
+        try:
+            response = send_slack_notification(follow_up)
+        except Exception as e:
+            log_notification(dict(notification, payload=follow_up), error=e)
+            return
+        if response.status != 200:
+            log_notification(dict(notification, payload=follow_up), response=response)
+            return
 
-    http = urllib3.PoolManager()
 
-    return http.request("POST", url, body=json.dumps(payload).encode("utf-8"))
+def prepare():
+    """
+    Function to do the work every invocation needs up front: creating the
+    HTTP pool and transport, importing boto3 and reading the webhook URL (or
+    bot token) from SSM. A missing environment variable raises a
+    ConfigError, failing the init phase; other failures are logged and left
+    for the first invocation to retry.
+    """
+    with startup_timer("config_ms"):
+        get_formatter()
+    try:
+        with startup_timer("prepare_ms"):
+            get_http_pool()
+            with startup_timer("ssm_fetch_ms"):
+                if TRANSPORT == "web_api":
+                    get_slack_bot_token()
+                else:
+                    get_slack_webhook_url()
+            get_transport()
+            get_thread_store()
+    except Exception as e:
+        logger.error({"prepare": str(e)})
 
 
 def lambda_handler(event, context):
     """
-    Lambda function to parse notification events and forward to Slack
+    Lambda function to parse notification events and forward to Slack. Every
+    record in the batch is buffered and coalesced, and the resulting
+    notifications sent up to MAX_CONCURRENT_SENDS at a time.
 
     :param event: lambda expected event object
     :param context: lambda expected context object
-    :returns: none
+    :returns: batchItemFailures listing the records that weren't sent, so
+              that only those are retried
     """
-    payload = get_slack_message_payload(event)
+    global first_invocation
+    invocation_started = time.perf_counter()
+
+    buffer = LocalNotificationBuffer()
+    for index, record in enumerate(event["Records"]):
+        buffer.put(index, get_record_message(record))
+    metrics = Metrics()
+    notifications = coalesce_notifications(event, buffer, metrics=metrics)
+
+    max_workers = max(1, min(MAX_CONCURRENT_SENDS, len(notifications)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(lambda n: send_notification(n, metrics), notifications)
+        )
+    metrics.emit()
 
-    response = send_slack_notification(payload)
+    failed = sorted(
+        index
+        for notification, sent in zip(notifications, results)
+        if not sent
+        for index in notification["indexes"]
+    )
 
-    if response.status != 200:
-        return logger.error(
-            {
-                "status_code": response.status,
-                "response": response.data,
-            }
-        )
-    else:
-        return logger.info(
-            {
-                "message": event["Records"][0]["Sns"]["Message"],
-                "slack_payload": payload,
-                "status_code": response.status,
-                "response": response.data,
-            }
-        )
+    if first_invocation:
+        first_invocation = False
+        if STARTUP_PROFILE:
+            startup_timings["first_invocation_ms"] = round(
+                (time.perf_counter() - invocation_started) * 1000, 3
+            )
+            logger.info({"startup": startup_timings})
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": get_record_id(event["Records"][index])}
+            for index in failed
+        ]
+    }
+
+
+startup_timings["import_ms"] = round((time.perf_counter() - import_started) * 1000, 3)
+if PREPARE_AT_INIT and "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+    prepare()
@@ -0,0 +1,272 @@
+"""
+Replays a corpus of recorded SNS events through get_slack_message_payload and
+on to a local fake Slack webhook, to see how formatting and sending hold up
+under alarm-storm volumes without touching Slack.
+
+Example:
+
+  python slack_lambda_replay.py recorded_events/ --repeat 1000
+
+The corpus is any mix of Lambda event JSON files (like the *_message.json
+test fixtures, which are used if no corpus is given) and JSON Lines files of
+events. Prints one JSON report.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# slack_lambda reads its config from the environment
+ENVIRONMENT = {
+    "slack_webhook_url_parameter": "/replay/slack/webhook",
+    "slack_channel": "replay",
+    "slack_username": "Replay",
+    "slack_icon": ":replay:",
+    "slack_alarm_emoji": ":alarm:",
+    "slack_warn_emoji": ":warn:",
+    "slack_notice_emoji": ":notice:",
+    "slack_ok_emoji": ":ok:",
+}
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+# autopep8: off
+import slack_lambda
+
+# autopep8: on
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes += len(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSlack:
+    """
+    FakeSlack is a local HTTP server standing in for a Slack webhook. It
+    accepts every message, counting requests and bytes received.
+    """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSlackHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.bytes = 0
+        self.url = "http://127.0.0.1:%d/webhook" % self.server.server_port
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ErrorCounter(logging.Handler):
+    """
+    ErrorCounter counts the errors slack_lambda logs, which it does when a
+    formatter fails and the message falls back to a generic one.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors = 0
+
+    def emit(self, record):
+        self.errors += 1
+
+
+def load_corpus(paths):
+    """
+    load_corpus returns the records of every event in the given files, or in
+    the *.json and *.jsonl files of the given directories.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.json")))
+            files += sorted(glob.glob(os.path.join(path, "*.jsonl")))
+        else:
+            files.append(path)
+
+    records = []
+    for filename in files:
+        with open(filename) as f:
+            if filename.endswith(".jsonl"):
+                events = [json.loads(line) for line in f if line.strip()]
+            else:
+                events = [json.load(f)]
+        for event in events:
+            records += event.get("Records", [])
+    return records
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def measure_import_time(runs=5):
+    """
+    measure_import_time returns the median time to import slack_lambda in a
+    fresh interpreter, as a cold start does.
+    """
+    code = (
+        "import time; start = time.perf_counter(); import slack_lambda; "
+        "print(time.perf_counter() - start)"
+    )
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    times = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=SRC_DIR,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return percentile(times, 50)
+
+
+def get_event_type(record):
+    try:
+        event_type = slack_lambda.get_event_type(
+            json.loads(slack_lambda.get_record_message(record))
+        )
+    except ValueError:
+        event_type = None
+    if event_type not in slack_lambda.FORMATTERS:
+        return "generic"
+    return event_type
+
+
+def replay(records, repeat=1, send=True, import_runs=5):
+    """
+    replay formats (and with send, sends) every record repeat times, and
+    returns the latencies, payload sizes and fallback rates by event type.
+    """
+    errors = ErrorCounter()
+    slack_lambda.logger.addHandler(errors)
+    original_level = slack_lambda.logger.level
+    slack_lambda.logger.setLevel(logging.ERROR)
+    original_transport = slack_lambda.transport
+    original_channel_rate = slack_lambda.CHANNEL_RATE
+    # The fake server doesn't rate limit, so neither should we
+    slack_lambda.transport = None
+    slack_lambda.CHANNEL_RATE = 1e9
+    stats = {}
+    try:
+        with FakeSlack() as slack:
+            slack_lambda.webhook_url_cache.update(url=slack.url, expires=math.inf)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for record in records:
+                    event = {"Records": [record]}
+                    event_type = get_event_type(record)
+                    event_stats = stats.setdefault(
+                        event_type,
+                        {"format": [], "send": [], "size": [], "fallbacks": 0},
+                    )
+
+                    errors_before = errors.errors
+                    started = time.perf_counter()
+                    payload = slack_lambda.get_slack_message_payload(event)
+                    event_stats["format"].append(time.perf_counter() - started)
+                    # Plain text messages log an error too, but aren't fallbacks
+                    if errors.errors > errors_before and event_type != "generic":
+                        event_stats["fallbacks"] += 1
+                    event_stats["size"].append(len(json.dumps(payload)))
+
+                    if send:
+                        started = time.perf_counter()
+                        response = slack_lambda.send_slack_notification(payload)
+                        event_stats["send"].append(time.perf_counter() - started)
+                        if response.status != 200:
+                            raise RuntimeError(
+                                "fake Slack returned %d" % response.status
+                            )
+            wall_time = time.perf_counter() - start
+            requests = slack.server.requests
+    finally:
+        slack_lambda.logger.removeHandler(errors)
+        slack_lambda.logger.setLevel(original_level)
+        slack_lambda.transport = original_transport
+        slack_lambda.CHANNEL_RATE = original_channel_rate
+        slack_lambda.webhook_url_cache.update(url=None, expires=0.0)
+
+    messages = sum(len(s["format"]) for s in stats.values())
+    return {
+        "messages": messages,
+        "wall_time_s": wall_time,
+        "messages_per_s": messages / wall_time if wall_time else None,
+        "slack_requests": requests,
+        "import_time_s": measure_import_time(import_runs) if import_runs else None,
+        "event_types": {
+            event_type: {
+                "messages": len(s["format"]),
+                "format_s": summarize(s["format"]),
+                "send_s": summarize(s["send"]),
+                "payload_bytes": summarize(s["size"]),
+                "fallback_rate": s["fallbacks"] / len(s["format"]),
+            }
+            for event_type, s in sorted(stats.items())
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("corpus", nargs="*", default=[SRC_DIR])
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--no-send", action="store_true")
+    parser.add_argument("--import-runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    records = load_corpus(args.corpus)
+    if not records:
+        parser.error("no events found in %s" % " ".join(args.corpus))
+    result = replay(
+        records,
+        repeat=args.repeat,
+        send=not args.no_send,
+        import_runs=args.import_runs,
+    )
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,20 @@ import boto3
 import logging
 import os
 import pytest
+import subprocess
+import sys
 import json
 import unittest
 import urllib3
 from moto import mock_aws
 from unittest.mock import patch, MagicMock
+import slack_lambda
 from slack_lambda import (
     lambda_handler,
     SlackNotificationFormatter,
     send_slack_notification,
     get_slack_message_payload,
+    get_record_message,
 )
 
 
@@ -113,6 +117,503 @@ class SlackNotificationsTest(unittest.TestCase):
         )
         self.assertEqual(payload["icon_emoji"], os.environ["slack_icon"])
 
+    @patch("slack_lambda.transport", None)
+    @patch("time.sleep")
+    def test_send_slack_notification_reuses_clients(self, sleep):
+        ssm = MagicMock()
+        ssm.get_parameter.return_value = {"Parameter": {"Value": "https://hook/1"}}
+        http = MagicMock()
+        http.request.return_value = MagicMock(status=200)
+
+        with patch.object(slack_lambda, "ssm_client", ssm), patch.object(
+            slack_lambda, "http_pool", http
+        ), patch.dict(slack_lambda.webhook_url_cache, {"url": None, "expires": 0.0}):
+            send_slack_notification({"text": "one"})
+            send_slack_notification({"text": "two"})
+
+        # One SSM decrypt for both messages, sent through the same pool
+        ssm.get_parameter.assert_called_once_with(
+            Name="/slackurl/param", WithDecryption=True
+        )
+        self.assertEqual(http.request.call_count, 2)
+        http.request.assert_called_with(
+            "POST", "https://hook/1", body=b'{"text": "two"}'
+        )
+
+    @patch("slack_lambda.transport", None)
+    @patch("time.sleep")
+    def test_send_slack_notification_refreshes_rejected_url(self, sleep):
+        ssm = MagicMock()
+        ssm.get_parameter.return_value = {"Parameter": {"Value": "https://hook/2"}}
+        http = MagicMock()
+        http.request.side_effect = [MagicMock(status=403), MagicMock(status=200)]
+
+        with patch.object(slack_lambda, "ssm_client", ssm), patch.object(
+            slack_lambda, "http_pool", http
+        ), patch.dict(
+            slack_lambda.webhook_url_cache,
+            {"url": "https://hook/1", "expires": float("inf")},
+        ):
+            response = send_slack_notification({"text": "rotated"})
+
+        self.assertEqual(response.status, 200)
+        ssm.get_parameter.assert_called_once()
+        self.assertEqual(
+            [c.args[1] for c in http.request.call_args_list],
+            ["https://hook/1", "https://hook/2"],
+        )
+
+    def test_lambda_handler_sends_every_record(self):
+        event = {
+            "Records": [
+                {"Sns": {"MessageId": f"id-{n}", "Message": f"message {n}"}}
+                for n in range(5)
+            ]
+        }
+
+        def send(payload):
+            status = 500 if payload["text"] == "message 3" else 200
+            return MagicMock(status=status, data=b"")
+
+        with patch("slack_lambda.send_slack_notification", side_effect=send) as sent:
+            result = lambda_handler(event, None)
+
+        self.assertEqual(
+            sorted(c.args[0]["text"] for c in sent.call_args_list),
+            [f"message {n}" for n in range(5)],
+        )
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "id-3"}]})
+
+    def test_get_record_message_from_sqs(self):
+        notification = {"Type": "Notification", "Message": "from sns"}
+        self.assertEqual(
+            get_record_message({"body": json.dumps(notification)}), "from sns"
+        )
+        self.assertEqual(get_record_message({"body": "raw message"}), "raw message")
+
+    def alarm_record(self, name, new_state="ALARM", old_state="OK", minute=35):
+        alarm = {
+            "AlarmName": name,
+            "AlarmDescription": f"{name} description",
+            "NewStateValue": new_state,
+            "OldStateValue": old_state,
+            "NewStateReason": "Threshold Crossed",
+            "StateChangeTime": f"2024-05-21T08:{minute}:10.393+0000",
+            "Region": "US West (Oregon)",
+        }
+        return {"Sns": {"MessageId": name, "Message": json.dumps(alarm)}}
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    def test_lambda_handler_coalesces_alarm_storms(self):
+        records = [self.alarm_record(f"prod-service-{n}") for n in range(4)]
+        records += [
+            # Another environment, and another time window
+            self.alarm_record("int-service-0"),
+            self.alarm_record("prod-service-9", minute=50),
+            # Duplicate delivery, and an alarm already in ALARM
+            self.alarm_record("prod-service-0"),
+            self.alarm_record("prod-service-8", old_state="ALARM"),
+        ]
+        sent = MagicMock(return_value=MagicMock(status=200, data=b"ok"))
+
+        with patch("slack_lambda.send_slack_notification", sent):
+            result = lambda_handler({"Records": records}, None)
+            self.assertEqual(result, {"batchItemFailures": []})
+            payloads = sorted(
+                (c.args[0] for c in sent.call_args_list), key=lambda p: p["text"]
+            )
+            self.assertEqual(len(payloads), 3)
+            self.assertIn("*4 prod alarms*", payloads[0]["text"])
+            for n in range(4):
+                self.assertIn(
+                    f"prod-service-{n}", payloads[0]["blocks"][1]["text"]["text"]
+                )
+            self.assertIn("int-service-0", payloads[1]["text"])
+            self.assertIn("prod-service-9", payloads[2]["text"])
+
+            # A repeat of what was just posted is suppressed, but not a change
+            sent.reset_mock()
+            lambda_handler(
+                {
+                    "Records": [
+                        self.alarm_record("int-service-0"),
+                        self.alarm_record(
+                            "prod-service-1", new_state="OK", old_state="ALARM"
+                        ),
+                    ]
+                },
+                None,
+            )
+            self.assertEqual(sent.call_count, 1)
+            self.assertIn("prod-service-1", sent.call_args.args[0]["text"])
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    def test_failed_digest_fails_all_its_records(self):
+        records = [self.alarm_record(f"prod-service-{n}") for n in range(3)]
+        records.append(self.alarm_record("prod-service-0"))
+        sent = MagicMock(return_value=MagicMock(status=429, data=b""))
+
+        with patch("slack_lambda.send_slack_notification", sent):
+            result = lambda_handler({"Records": records}, None)
+
+        sent.assert_called_once()
+        self.assertEqual(
+            [f["itemIdentifier"] for f in result["batchItemFailures"]],
+            ["prod-service-0", "prod-service-1", "prod-service-2", "prod-service-0"],
+        )
+        # Nothing was posted, so a retry isn't suppressed
+        self.assertEqual(slack_lambda.alarm_states, {})
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    def test_alarm_without_state_is_sent(self):
+        sent = MagicMock(return_value=MagicMock(status=200, data=b"ok"))
+        message = {"AlarmName": "prod-odd", "AlarmDescription": "no state"}
+        event = {
+            "Records": [
+                {"Sns": {"MessageId": "1", "Message": json.dumps(message)}},
+                self.alarm_record("prod-cpu"),
+            ]
+        }
+
+        with patch("slack_lambda.send_slack_notification", sent):
+            result = lambda_handler(event, None)
+
+        self.assertEqual(result["batchItemFailures"], [])
+        self.assertEqual(sent.call_count, 2)
+        self.assertIn("prod-odd", sent.call_args_list[0].args[0]["text"])
+
+    def test_get_slack_message_payload_dispatch(self):
+        for filename, username in [
+            ("codepipeline_message", "AWS CodePipeline"),
+            ("cloudwatch_alarm_message", "AWS Cloudwatch Alarm"),
+            ("aws_incident_manager_shift_message", "AWS Incident Manager"),
+            ("generic_message", os.environ["slack_username"]),
+        ]:
+            payload = get_slack_message_payload(self.load_file(filename))
+            self.assertEqual(payload["username"], username, filename)
+
+    def test_register_formatter(self):
+        def format_guardduty_finding(formatter, data, slack_username, slack_icon):
+            if data["detail"]["severity"] < 4:
+                return None
+            return formatter.compose_payload(
+                text=data["detail"]["title"],
+                slack_username=slack_username,
+                slack_icon=slack_icon,
+            )
+
+        def event(severity):
+            message = {
+                "detail-type": "GuardDuty Finding",
+                "detail": {"severity": severity, "title": "Unusual API call"},
+            }
+            return {"Records": [{"Sns": {"Message": json.dumps(message)}}]}
+
+        with patch.dict(slack_lambda.FORMATTERS):
+            slack_lambda.register_formatter(
+                "GuardDuty Finding", slack_username="AWS GuardDuty"
+            )(format_guardduty_finding)
+
+            payload = get_slack_message_payload(event(8))
+            self.assertEqual(payload["text"], "Unusual API call")
+            self.assertEqual(payload["username"], "AWS GuardDuty")
+            self.assertEqual(payload["icon_emoji"], os.environ["slack_icon"])
+
+            # Declining to format falls back to the generic message
+            payload = get_slack_message_payload(event(1))
+            self.assertEqual(payload["username"], os.environ["slack_username"])
+            self.assertIn("GuardDuty Finding", payload["text"])
+
+        self.assertNotIn("GuardDuty Finding", slack_lambda.FORMATTERS)
+
+    @patch("time.sleep")
+    def test_transport_waits_out_rate_limits(self, sleep):
+        http = MagicMock()
+        http.request.side_effect = [
+            MagicMock(status=429, data=b"", headers={"Retry-After": "2"}),
+            MagicMock(status=200, data=b"ok", headers={}),
+        ]
+
+        with patch.object(slack_lambda, "http_pool", http), patch(
+            "slack_lambda.get_slack_webhook_url", return_value="https://hook/1"
+        ):
+            transport = slack_lambda.WebhookTransport()
+            response = transport.send({"channel": "alerts", "text": "hi"})
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(http.request.call_count, 2)
+        # The payload was serialized once, for both attempts
+        first, second = http.request.call_args_list
+        self.assertIs(first.kwargs["body"], second.kwargs["body"])
+        # The retry waited for the Retry-After Slack asked for
+        self.assertAlmostEqual(max(c.args[0] for c in sleep.call_args_list), 2, 1)
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    @patch("slack_lambda.thread_store", slack_lambda.MemoryThreadStore())
+    @patch("slack_lambda.transport", slack_lambda.WebApiTransport())
+    @patch("time.sleep")
+    def test_web_api_threads_ok_under_alarm(self, sleep):
+        http = MagicMock()
+        http.request.side_effect = [
+            MagicMock(status=200, data=b'{"ok": true, "ts": "1.1"}', headers={}),
+            MagicMock(status=200, data=b'{"ok": true, "ts": "1.2"}', headers={}),
+            MagicMock(status=200, data=b'{"ok": false, "error": "no"}', headers={}),
+        ]
+
+        with patch.object(slack_lambda, "http_pool", http), patch(
+            "slack_lambda.get_slack_bot_token", return_value="xoxb-1"
+        ):
+            alarm = {"Records": [self.alarm_record("prod-service-0")]}
+            ok = {
+                "Records": [
+                    self.alarm_record("prod-service-0", "OK", old_state="ALARM")
+                ]
+            }
+            self.assertEqual(lambda_handler(alarm, None)["batchItemFailures"], [])
+            self.assertEqual(lambda_handler(ok, None)["batchItemFailures"], [])
+            # Web API errors come back with a 200, but are still failures
+            self.assertEqual(len(lambda_handler(alarm, None)["batchItemFailures"]), 1)
+
+        requests = [json.loads(c.kwargs["body"]) for c in http.request.call_args_list]
+        self.assertNotIn("thread_ts", requests[0])
+        self.assertEqual(requests[1]["thread_ts"], "1.1")
+        self.assertEqual(
+            http.request.call_args.kwargs["headers"]["Authorization"], "Bearer xoxb-1"
+        )
+        # Once resolved, the alarm is no longer threaded
+        self.assertIsNone(slack_lambda.thread_store.get("prod-service-0"))
+
+    def test_replay(self):
+        from slack_lambda_replay import load_corpus, replay
+
+        records = load_corpus([os.path.dirname(__file__)])
+        result = replay(records, repeat=2, import_runs=0)
+
+        self.assertEqual(result["messages"], 2 * len(records))
+        self.assertEqual(result["slack_requests"], result["messages"])
+        self.assertEqual(
+            set(result["event_types"]),
+            {
+                "AWS Health Event",
+                "CloudWatch Alarm",
+                "CodePipeline Pipeline Execution State Change",
+                "Incident Manager",
+                "Lambda Monitor Notification",
+                "generic",
+            },
+        )
+        for event_type, stats in result["event_types"].items():
+            self.assertEqual(stats["fallback_rate"], 0, event_type)
+            self.assertGreater(stats["payload_bytes"]["p50"], 0)
+
+    def test_import_is_lazy(self):
+        code = "import sys, slack_lambda; print('boto3' in sys.modules)"
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        self.assertEqual(output.strip(), "False")
+
+    @patch("slack_lambda.config", None)
+    @patch("slack_lambda.notification_formatter", None)
+    def test_config(self):
+        config = slack_lambda.get_config()
+        self.assertEqual(config.channel, os.environ["slack_channel"])
+        self.assertEqual(config.webhook_url_parameter, "/slackurl/param")
+        self.assertEqual(config.warn_emoji, "")
+        self.assertIs(slack_lambda.get_config(), config)
+        self.assertIs(slack_lambda.get_formatter(), slack_lambda.get_formatter())
+        with self.assertRaises(AttributeError):
+            config.channel = "elsewhere"
+        with self.assertRaises(AttributeError):
+            config.extra = True
+
+        with self.assertRaisesRegex(
+            slack_lambda.ConfigError, "slack_username, slack_icon$"
+        ):
+            slack_lambda.SlackConfig.from_environ(
+                {"slack_channel": "c", "slack_webhook_url_parameter": "/p"}
+            )
+        with self.assertRaisesRegex(
+            slack_lambda.ConfigError, "slack_bot_token_parameter"
+        ):
+            slack_lambda.SlackConfig.from_environ(dict(os.environ), transport="web_api")
+
+        # Missing variables fail prepare, and so the Lambda init phase
+        with patch("slack_lambda.config", None), patch(
+            "slack_lambda.notification_formatter", None
+        ), patch.dict(os.environ, {"slack_icon": ""}):
+            with self.assertRaises(slack_lambda.ConfigError):
+                slack_lambda.prepare()
+
+    @patch("slack_lambda.http_pool", None)
+    @patch("slack_lambda.transport", None)
+    @patch("slack_lambda.thread_store", None)
+    @patch("slack_lambda.config", None)
+    @patch("slack_lambda.notification_formatter", None)
+    @patch.dict(slack_lambda.startup_timings, clear=True)
+    def test_prepare(self):
+        ssm = MagicMock()
+        ssm.get_parameter.return_value = {"Parameter": {"Value": "https://hook/1"}}
+
+        with patch.object(slack_lambda, "ssm_client", ssm), patch.dict(
+            slack_lambda.webhook_url_cache, {"url": None, "expires": 0.0}
+        ):
+            slack_lambda.prepare()
+            self.assertEqual(slack_lambda.get_slack_webhook_url(), "https://hook/1")
+
+        ssm.get_parameter.assert_called_once()
+        self.assertIsNotNone(slack_lambda.http_pool)
+        self.assertIsInstance(slack_lambda.transport, slack_lambda.WebhookTransport)
+        self.assertEqual(
+            set(slack_lambda.startup_timings),
+            {"config_ms", "prepare_ms", "ssm_fetch_ms", "http_pool_ms"},
+        )
+
+    def formatter(self):
+        return SlackNotificationFormatter(
+            event={},
+            default_slack_username=os.environ["slack_username"],
+            default_slack_icon=os.environ["slack_icon"],
+            slack_channel=os.environ["slack_channel"],
+        )
+
+    def assert_within_limits(self, payload):
+        for message in [payload] + payload.follow_ups:
+            self.assertLessEqual(len(message["text"]), slack_lambda.MAX_TEXT_LENGTH)
+            self.assertLessEqual(len(message["blocks"]), slack_lambda.MAX_BLOCKS)
+            for block in message["blocks"]:
+                self.assertLessEqual(
+                    len(block["text"]["text"]), slack_lambda.MAX_SECTION_LENGTH
+                )
+
+    def test_large_payloads_are_split(self):
+        details = {f"key-{n}": "x" * 100 for n in range(100)}
+        payload = self.formatter().format_lambda_monitor_notification(
+            {
+                "name": "big",
+                "description": "Lots of details",
+                "state": "WARN",
+                "detail": details,
+            }
+        )
+
+        self.assert_within_limits(payload)
+        self.assertEqual(len(payload.follow_ups), 0)
+        text = "\n".join(b["text"]["text"] for b in payload["blocks"])
+        for key in details:
+            self.assertIn(f"*{key}:*", text)
+
+        description = "\n".join(f"line {n} " + "y" * 50 for n in range(300))
+        event = self.load_file("aws_health_event_message")
+        data = json.loads(event["Records"][0]["Sns"]["Message"])
+        data["detail"]["eventDescription"][0]["latestDescription"] = description
+        payload = self.formatter().format_aws_health_event(data)
+
+        self.assert_within_limits(payload)
+        code = [
+            b["text"]["text"]
+            for m in [payload] + payload.follow_ups
+            for b in m["blocks"]
+            if b["text"]["text"].startswith("```")
+        ]
+        self.assertGreater(len(code), 1)
+        for chunk in code:
+            self.assertTrue(chunk.endswith("```"))
+
+    def test_huge_payloads_are_truncated(self):
+        payload = self.formatter().format_generic_slack_message("z" * 100000)
+
+        self.assert_within_limits(payload)
+        self.assertEqual(len(payload.follow_ups), slack_lambda.MAX_FOLLOW_UPS)
+        self.assertIn("truncated", payload.follow_ups[-1]["blocks"][-1]["text"]["text"])
+
+        alarm = json.loads(self.alarm_record("prod-big")["Sns"]["Message"])
+        alarm["AlarmArn"] = "arn:aws:cloudwatch:us-west-2:100000000001:alarm:prod-big"
+        alarm["NewStateReason"] = "r" * 100000
+        payload = self.formatter().format_cloudwatch_alarm_message(alarm)
+        self.assertIn(
+            "<https://console.aws.amazon.com/cloudwatch/home?region=us-west-2"
+            "#alarmsV2:alarm/prod-big|View the full event>",
+            payload.follow_ups[-1]["blocks"][-1]["text"]["text"],
+        )
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    def test_follow_ups_are_sent(self):
+        sent = MagicMock(return_value=MagicMock(status=200, data=b"ok"))
+        event = {"Records": [{"Sns": {"MessageId": "1", "Message": "m" * 20000}}]}
+
+        with patch("slack_lambda.send_slack_notification", sent):
+            result = lambda_handler(event, None)
+
+        self.assertEqual(result["batchItemFailures"], [])
+        self.assertEqual(
+            [c.args[0]["text"][:11] for c in sent.call_args_list],
+            ["m" * 11, "(continued)"],
+        )
+        sent_text = "".join(
+            b["text"]["text"] for c in sent.call_args_list for b in c.args[0]["blocks"]
+        )
+        self.assertEqual(sent_text, "m" * 20000)
+
+    @patch.dict(slack_lambda.alarm_states, clear=True)
+    @patch("slack_lambda.LOG_MODE", "structured")
+    @patch("slack_lambda.LOG_SAMPLE_RATE", 0.0)
+    @patch("slack_lambda.LOG_MAX_LENGTH", 10)
+    def test_structured_logs_and_metrics(self):
+        def send(payload):
+            if payload["text"].startswith("x"):
+                return MagicMock(status=429, data=b"rate_limited " * 100)
+            return MagicMock(status=200, data=b"ok")
+
+        sent = MagicMock(side_effect=send)
+        event = {
+            "Records": [
+                self.alarm_record("prod-cpu", minute=0),
+                {"Sns": {"MessageId": "2", "Message": "x" * 5000}},
+            ]
+        }
+
+        with patch("slack_lambda.send_slack_notification", sent), patch(
+            "builtins.print"
+        ) as printed, self.assertLogs(slack_lambda.logger) as logs:
+            result = lambda_handler(event, None)
+
+        self.assertEqual(len(result["batchItemFailures"]), 1)
+        # Only the failure is logged (besides the plain text message not
+        # parsing as JSON), cut down to LOG_MAX_LENGTH
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(logs.records[1].levelno, logging.ERROR)
+        entry = json.loads(logs.records[1].getMessage())
+        self.assertEqual(entry["formatter"], "generic")
+        self.assertEqual(entry["status_code"], 429)
+        self.assertEqual(entry["response"], "rate_limit…")
+        self.assertEqual(entry["text"], "xxxxxxxxxx…")
+
+        records = {}
+        for call in printed.call_args_list:
+            record = json.loads(call.args[0])
+            if "Formatter" in record:
+                records[record["Formatter"]] = record
+        self.assertEqual(set(records), {"CloudWatch Alarm", "generic"})
+        alarm = records["CloudWatch Alarm"]
+        self.assertEqual(alarm["Messages"], 1)
+        self.assertEqual(alarm["Status2xx"], 1)
+        self.assertEqual(len(alarm["SendLatency"]), 1)
+        self.assertEqual(records["generic"]["Status429"], 1)
+        self.assertEqual(
+            alarm["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Formatter"]]
+        )
+        units = {
+            m["Name"]: m["Unit"]
+            for m in alarm["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+        }
+        self.assertEqual(units["SendLatency"], "Milliseconds")
+        self.assertEqual(units["Messages"], "Count")
+
     def load_file(self, filename):
         with open(os.path.join(os.path.dirname(__file__), f"{filename}.json")) as f:
             return json.loads(f.read())
@@ -33,6 +33,118 @@ variable "slack_webhook_url_parameter" {
   type        = string
 }
 
+variable "slack_webhook_url_ttl" {
+  description = "Seconds a warm Lambda reuses the decrypted Slack Webhook URL before reading the SSM Parameter again."
+  type        = number
+  default     = 300
+}
+
+variable "slack_max_concurrent_sends" {
+  description = "Most records in a batched event to send to Slack at once."
+  type        = number
+  default     = 4
+}
+
+variable "slack_dedup_seconds" {
+  description = "Seconds to suppress a CloudWatch alarm repeating the state it was last posted in."
+  type        = number
+  default     = 300
+}
+
+variable "slack_digest_group_pattern" {
+  description = "Regular expression matching the part of an AlarmName used to group alarms into digests."
+  type        = string
+  default     = "^[^-]+"
+}
+
+variable "slack_digest_min_alarms" {
+  description = "Post CloudWatch alarms in the same group, state and time window as one digest once there are at least this many. 0 disables digests."
+  type        = number
+  default     = 3
+}
+
+variable "slack_digest_window_seconds" {
+  description = "Length of the time windows CloudWatch alarms are grouped into for digests."
+  type        = number
+  default     = 300
+}
+
+variable "slack_transport" {
+  description = "How to send messages to Slack: webhook, or web_api to use chat.postMessage with a bot token (which threads OK messages under their ALARM)."
+  type        = string
+  default     = "webhook"
+
+  validation {
+    condition     = contains(["webhook", "web_api"], var.slack_transport)
+    error_message = "slack_transport must be webhook or web_api."
+  }
+}
+
+variable "slack_bot_token_parameter" {
+  description = "Slack bot token SSM Parameter, used when slack_transport is web_api."
+  type        = string
+  default     = ""
+}
+
+variable "slack_channel_rate" {
+  description = "Most messages per second to post to the Slack channel."
+  type        = number
+  default     = 1
+}
+
+variable "slack_max_retry_wait" {
+  description = "Most seconds to spend waiting out Slack rate limit (429) responses for a message."
+  type        = number
+  default     = 30
+}
+
+variable "slack_thread_table_enabled" {
+  description = "Whether to create a DynamoDB table remembering ALARM messages to thread OK messages under, so threading survives new Lambda containers. Only used with the web_api transport."
+  type        = bool
+  default     = false
+}
+
+variable "slack_prepare_at_init" {
+  description = "Whether to import dependencies, create clients and read the Slack Webhook URL during the Lambda init phase, instead of in the first invocation after a cold start."
+  type        = bool
+  default     = true
+}
+
+variable "slack_startup_profile" {
+  description = "Whether to log how long each step of a cold start took, with the first invocation."
+  type        = bool
+  default     = false
+}
+
+variable "slack_log_mode" {
+  description = "How to log sent messages: full (every payload and response) or structured (a truncated JSON line for every failure and a sample of successes)."
+  type        = string
+  default     = "structured"
+
+  validation {
+    condition     = contains(["full", "structured"], var.slack_log_mode)
+    error_message = "slack_log_mode must be full or structured."
+  }
+}
+
+variable "slack_log_sample_rate" {
+  description = "Fraction of successfully sent messages to log, with the structured slack_log_mode."
+  type        = number
+  default     = 0.1
+}
+
+variable "slack_log_max_length" {
+  description = "Most characters of message text and Slack responses to log, with the structured slack_log_mode."
+  type        = number
+  default     = 1000
+}
+
+variable "slack_metrics_namespace" {
+  description = "CloudWatch namespace to publish message, send latency and Slack status code metrics per formatter to, as Embedded Metric Format logs. Set to an empty string to not publish them."
+  type        = string
+  default     = "SlackNotifications"
+}
+
 variable "slack_channel" {
   description = "Name of the Slack channel to send messages to. DO NOT include the # sign."
   type        = string
@@ -76,3 +188,21 @@ variable "slack_topic_arn" {
   description = "ARN of the SNS topic for the Lambda to subscribe to."
   type        = string
 }
+
+variable "slack_sqs_batching_enabled" {
+  description = "Whether to deliver the SNS topic's messages to the Lambda through an SQS queue, in batches, rather than one at a time. Alarm storm digests and retrying only the failed messages of a batch need this."
+  type        = bool
+  default     = false
+}
+
+variable "slack_sqs_batch_size" {
+  description = "Most messages to send the Lambda at once, with slack_sqs_batching_enabled."
+  type        = number
+  default     = 10
+}
+
+variable "slack_sqs_batching_window_seconds" {
+  description = "Most seconds to wait to gather a batch of messages before invoking the Lambda, with slack_sqs_batching_enabled."
+  type        = number
+  default     = 5
+}
@@ -33,13 +33,42 @@ data "aws_iam_policy_document" "lambda_policy" {
     effect = "Allow"
     actions = [
       "cloudwatch:PutMetricData",
-      "cloudwatch:GetMetricStatistics",
+      "cloudwatch:GetMetricData",
     ]
     resources = [
       # Change this once we know what the resources are, from errors.
       "*"
     ]
   }
+
+  dynamic "statement" {
+    for_each = var.rollup_cache_bucket == "" ? [] : [var.rollup_cache_bucket]
+    content {
+      sid    = "ReadWriteRollupCache"
+      effect = "Allow"
+      actions = [
+        "s3:GetObject",
+        "s3:PutObject",
+      ]
+      resources = [
+        "arn:aws:s3:::${statement.value}/${var.rollup_cache_prefix}*"
+      ]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = var.rollup_cache_bucket == "" ? [] : [var.rollup_cache_bucket]
+    content {
+      sid    = "ListRollupCacheBucket"
+      effect = "Allow"
+      actions = [
+        "s3:ListBucket",
+      ]
+      resources = [
+        "arn:aws:s3:::${statement.value}"
+      ]
+    }
+  }
 }
 
 # Default CW encryption is adequate for this low-impact Lambda
@@ -75,7 +104,10 @@ module "lambda_zip" {
 }
 
 locals {
-  namespace = var.namespace == "" ? "${var.env_name}/sli" : var.namespace
+  namespace    = var.namespace == "" ? "${var.env_name}/sli" : var.namespace
+  rollup_cache = var.rollup_cache_bucket == "" ? "" : (
+    "s3://${var.rollup_cache_bucket}/${var.rollup_cache_prefix}"
+  )
 }
 
 # Ignore missing XRay warning
@@ -95,6 +127,11 @@ resource "aws_lambda_function" "windowed_slo" {
   environment {
     variables = {
       WINDOW_DAYS       = var.window_days
+      MAX_WORKERS       = var.max_workers
+      ROLLUP_CACHE      = local.rollup_cache
+      INSTRUMENTATION   = tostring(var.instrumentation)
+      API_RATE          = var.cloudwatch_api_rate
+      API_MAX_ATTEMPTS  = var.cloudwatch_max_attempts
       SLI_NAMESPACE     = local.namespace
       LOAD_BALANCER_ARN = var.load_balancer_arn
       SLI_PREFIX        = var.sli_prefix
@@ -125,6 +162,33 @@ resource "aws_lambda_permission" "allow_cloudwatch_to_call_windowed_slo" {
   source_arn    = aws_cloudwatch_event_rule.every_one_day.arn
 }
 
+resource "aws_cloudwatch_event_rule" "burn_rates" {
+  count = var.burn_rate_schedule_expression == "" ? 0 : 1
+
+  name                = "burn-rates_${local.name}"
+  description         = "Fires on the SLI burn rate schedule"
+  schedule_expression = var.burn_rate_schedule_expression
+}
+
+resource "aws_cloudwatch_event_target" "burn_rates" {
+  count = var.burn_rate_schedule_expression == "" ? 0 : 1
+
+  rule      = aws_cloudwatch_event_rule.burn_rates[0].name
+  target_id = aws_lambda_function.windowed_slo.id
+  arn       = aws_lambda_function.windowed_slo.arn
+  input     = jsonencode({ burn_rates_only = true })
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_to_call_burn_rates" {
+  count = var.burn_rate_schedule_expression == "" ? 0 : 1
+
+  statement_id  = "AllowBurnRatesExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.windowed_slo.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.burn_rates[0].arn
+}
+
 resource "aws_cloudwatch_dashboard" "sli" {
   dashboard_name = "${var.env_name}-sli"
   dashboard_body = jsonencode({
@@ -136,9 +200,10 @@ resource "aws_cloudwatch_dashboard" "sli" {
         "properties" : {
           "view" : "timeSeries"
           "stacked" : false
-          "metrics" : [
-            [local.namespace, "${var.sli_prefix}-${k}"]
-          ]
+          "metrics" : concat(
+            [[local.namespace, "${var.sli_prefix}-${k}"]],
+            [for w in coalesce(v.windows, []) : [local.namespace, "${var.sli_prefix}-${k}-${w}d"]]
+          )
           "region" : data.aws_region.current.region
           "title" : "${v.description != null ? v.description : k} over last ${var.window_days} days"
           "stat" : "Average"
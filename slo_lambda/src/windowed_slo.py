@@ -3,12 +3,31 @@ Given SLIs that contain ratios of CloudWatch metrics, writes new metrics that
 aggregate over window_days and calculate the ratios.
 """
 
-from typing import Any, Dict, List, Optional, TypedDict, Union
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TypedDict,
+    Union,
+)
 import datetime
+import itertools
 import json
 import os
+import random
+import re
+import threading
+import time
 import boto3  # type: ignore
 import botocore  # type: ignore
+import botocore.config  # type: ignore
 
 
 # ENVIRONMENT VARIABLES
@@ -20,25 +39,710 @@ SLI_PREFIX = os.getenv("SLI_PREFIX")
 SLIS = os.getenv("SLIS")
 # If no window is specified, how long to calculate the SLI for
 WINDOW_DAYS = int(os.getenv("WINDOW_DAYS", 28))
+# How many SLIs and metric queries to evaluate at once (1 is serial)
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 1))
+# Where to keep daily rollups for incremental runs, either "s3://bucket/prefix"
+# or a local directory. If unset, every run queries the full window.
+ROLLUP_CACHE = os.getenv("ROLLUP_CACHE")
+# Set to "true" to log a summary of each run in Embedded Metric Format
+INSTRUMENTATION = os.getenv("INSTRUMENTATION", "false").lower() == "true"
+# Most CloudWatch calls per second to make, per API operation (0 is no limit)
+API_RATE = float(os.getenv("API_RATE", 20))
+# How many times to try a throttled or failed CloudWatch call
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", 8))
+
+# Maximum number of MetricDataQueries CloudWatch accepts per GetMetricData call
+MAX_METRIC_DATA_QUERIES = 500
+# Maximum number of datums and (approximate) request size for PutMetricData
+MAX_METRIC_DATA_DATUMS = 1000
+MAX_METRIC_DATA_BYTES = 1000000
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# Statistics whose daily values add up to the value over a whole window
+ADDITIVE_STATISTICS = ("Sum", "SampleCount")
+# How long after a day ends before its datapoints are trusted enough to cache
+ROLLUP_SETTLE_TIME = datetime.timedelta(hours=1)
+# CloudWatch namespace of the Embedded Metric Format run summary
+INSTRUMENTATION_NAMESPACE = "WindowedSLO"
+# Error codes CloudWatch returns when we exceed its request rate
+THROTTLING_ERROR_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded")
+# Full-jitter exponential backoff between retries: the Nth retry waits a random
+# time up to RETRY_BASE_DELAY * 2**N seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 10.0
+# The slowest an adaptive rate limit will go, in calls per second
+MIN_API_RATE = 1.0
+# Time to keep back from the Lambda deadline for writing results and the cache
+DEADLINE_MARGIN = datetime.timedelta(seconds=3)
+# Burn rate windows are given as a number of minutes, hours or days
+DURATION_UNITS = {"m": 60, "h": 60 * 60, "d": SECONDS_PER_DAY}
+# Datapoint periods to fetch burn rates at, coarsest first
+BURN_RATE_PERIODS = (60 * 60, 5 * 60, 60)
+
+
+class Instrumentation:
+    """
+    Instrumentation collects counters and timings for one invocation, and
+    logs them as a single CloudWatch Embedded Metric Format (EMF) record,
+    which CloudWatch turns into metrics without any extra API calls.
+
+    It is disabled unless reset(enabled=True) is called, in which case every
+    method returns straight away.
+    """
+
+    enabled = False
+    lock = threading.Lock()
+    # Metric name -> [value, unit]
+    metrics: Dict[str, list] = {}
+    # Property name -> {key: value}, logged with the record but not as metrics
+    properties: Dict[str, Dict] = {}
+
+    @classmethod
+    def reset(cls, enabled: bool):
+        """
+        reset clears everything recorded so far, and turns recording on or
+        off.
+        """
+        with cls.lock:
+            cls.enabled = enabled
+            cls.metrics = {}
+            cls.properties = {}
+
+    @classmethod
+    def count(cls, name: str, value: float = 1, unit: str = "Count"):
+        """
+        count adds value to the named metric.
+        """
+        if not cls.enabled:
+            return
+        with cls.lock:
+            cls.metrics.setdefault(name, [0, unit])[0] += value
+
+    @classmethod
+    def timer(cls, name: str, key: Optional[str] = None):
+        """
+        timer returns a context manager that adds the time spent inside it,
+        in milliseconds, to the named metric. With a key, the time is also
+        logged under that key in a property named after the metric, plural
+        (e.g. "SliTimes" for "SliTime"), so it's kept without becoming a
+        metric dimension.
+        """
+        if not cls.enabled:
+            return contextlib.nullcontext()
+        return cls.timed(name, key)
+
+    @classmethod
+    @contextlib.contextmanager
+    def timed(cls, name: str, key: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            cls.count(name, elapsed, unit="Milliseconds")
+            if key is not None:
+                with cls.lock:
+                    cls.properties.setdefault(name + "s", {})[key] = round(elapsed, 3)
+
+    @classmethod
+    def api_call(cls, operation: str, response: Dict):
+        """
+        api_call counts a CloudWatch API call from its response (or the
+        response of the error it raised).
+        """
+        if not cls.enabled:
+            return
+        cls.count(operation + "Calls")
+        error_code = response.get("Error", {}).get("Code")
+        if error_code:
+            cls.count("ApiErrors")
+            if error_code in THROTTLING_ERROR_CODES:
+                cls.count("Throttles")
+
+    @classmethod
+    def record(cls, dimensions: Dict[str, str]) -> Dict:
+        """
+        record returns everything recorded so far as an EMF record.
+        """
+        with cls.lock:
+            record = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": INSTRUMENTATION_NAMESPACE,
+                            "Dimensions": [sorted(dimensions)],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit}
+                                for name, (_, unit) in sorted(cls.metrics.items())
+                            ],
+                        }
+                    ],
+                },
+            }
+            record.update(dimensions)
+            record.update({name: value for name, (value, _) in cls.metrics.items()})
+            record.update(cls.properties)
+        return record
+
+    @classmethod
+    def emit(cls, dimensions: Dict[str, str]):
+        """
+        emit logs the EMF record, if enabled.
+        """
+        if cls.enabled:
+            print(json.dumps(cls.record(dimensions)))
+
+
+class DeadlineExceededError(botocore.exceptions.BotoCoreError):
+    """
+    DeadlineExceededError is raised instead of waiting to make or retry a
+    CloudWatch call when the wait would run past Cloudwatch.deadline.
+    """
+
+    fmt = "Not enough time left before the deadline to call {operation}"
+
+
+class TokenBucket:
+    """
+    TokenBucket limits calls to rate per second on average, with bursts of up
+    to burst calls. The rate adapts to what CloudWatch will take: it halves
+    whenever a call is throttled, and creeps back up to max_rate as calls
+    succeed.
+    """
+
+    def __init__(self, max_rate: float, burst: Optional[float] = None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max(1.0, max_rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """
+        reserve takes a token, and returns how many seconds the caller must
+        wait before it can be used. Tokens are handed out in order, so waiting
+        callers go in the order they arrived.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def throttled(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(MIN_API_RATE, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
 
 
 class Cloudwatch:
     """
     Cloudwatch contains a single Cloudwatch client so we don't have to
     reinitialize it or pass it as an argument everywhere.
+
+    Calls made through call() are rate limited per API operation, and retried
+    with backoff when throttled, until deadline (a time.monotonic() value)
+    when one is set.
     """
 
     cloudwatch_client = None
+    client_lock = threading.Lock()
+    api_rate = API_RATE
+    max_attempts = API_MAX_ATTEMPTS
+    deadline: Optional[float] = None
+    # API operation -> TokenBucket, kept across warm invocations so a rate
+    # CloudWatch has throttled us down to isn't immediately exceeded again
+    buckets: Dict[str, TokenBucket] = {}
 
     @classmethod
     def client(cls):
         """
         client returns an initialized Cloudwatch client or creates a new one.
+        The client is shared by every worker thread; boto3 clients are thread
+        safe once created, but creating one is not. botocore's own retries are
+        turned off, since call() retries with the rate limit and deadline in
+        mind.
         """
         if cls.cloudwatch_client is None:
-            cls.cloudwatch_client = boto3.client("cloudwatch")
+            with cls.client_lock:
+                if cls.cloudwatch_client is None:
+                    cls.cloudwatch_client = boto3.client(
+                        "cloudwatch",
+                        config=botocore.config.Config(
+                            max_pool_connections=max(10, MAX_WORKERS),
+                            retries={"mode": "standard", "total_max_attempts": 1},
+                        ),
+                    )
         return cls.cloudwatch_client
 
+    @classmethod
+    def set_deadline(cls, context):
+        """
+        set_deadline sets the deadline from the Lambda context, leaving
+        DEADLINE_MARGIN to write out results. Without a context (as when run
+        locally) there is no deadline.
+        """
+        if context is None:
+            cls.deadline = None
+            return
+        cls.deadline = (
+            time.monotonic()
+            + context.get_remaining_time_in_millis() / 1000
+            - DEADLINE_MARGIN.total_seconds()
+        )
+
+    @classmethod
+    def bucket(cls, operation: str) -> Optional[TokenBucket]:
+        if not cls.api_rate:
+            return None
+        with cls.client_lock:
+            bucket = cls.buckets.get(operation)
+            if bucket is None or bucket.max_rate != cls.api_rate:
+                bucket = cls.buckets[operation] = TokenBucket(cls.api_rate)
+        return bucket
+
+    @classmethod
+    def wait(cls, seconds: float, operation: str, error: Exception = None):
+        """
+        wait sleeps for seconds, or raises error (or a DeadlineExceededError)
+        straight away if that would take us past the deadline.
+        """
+        if seconds <= 0:
+            return
+        if cls.deadline is not None and time.monotonic() + seconds > cls.deadline:
+            Instrumentation.count("DeadlineExceeded")
+            raise error or DeadlineExceededError(operation=operation)
+        time.sleep(seconds)
+
+    @staticmethod
+    def retryable(error: Exception) -> bool:
+        """
+        retryable returns whether error is worth retrying: throttling, a
+        server error, or a connection problem.
+        """
+        if isinstance(error, botocore.exceptions.ClientError):
+            error_code = error.response.get("Error", {}).get("Code")
+            status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            return error_code in THROTTLING_ERROR_CODES or (status or 0) >= 500
+        return isinstance(
+            error,
+            (botocore.exceptions.HTTPClientError, botocore.exceptions.ConnectionError),
+        )
+
+    @classmethod
+    def call(cls, method: str, **kwargs) -> Dict:
+        """
+        call runs the named client method, e.g. "get_metric_data", and
+        records it with Instrumentation. It waits its turn under the rate
+        limit, and retries throttled and failed calls with full-jitter
+        exponential backoff, up to max_attempts times or until the deadline.
+        """
+        operation = "".join(word.title() for word in method.split("_"))
+        bucket = cls.bucket(operation)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                with Instrumentation.timer("RateLimitWaitTime"):
+                    cls.wait(bucket.reserve(), operation)
+            try:
+                with Instrumentation.timer(operation + "Time"):
+                    response = getattr(cls.client(), method)(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                Instrumentation.api_call(operation, e.response)
+                if bucket is not None and (
+                    e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+                ):
+                    bucket.throttled()
+                error = e
+            except (
+                botocore.exceptions.HTTPClientError,
+                botocore.exceptions.ConnectionError,
+            ) as e:
+                Instrumentation.api_call(
+                    operation, {"Error": {"Code": type(e).__name__}}
+                )
+                error = e
+            else:
+                Instrumentation.api_call(operation, response)
+                if bucket is not None:
+                    bucket.succeeded()
+                return response
+
+            attempt += 1
+            if attempt >= cls.max_attempts or not cls.retryable(error):
+                raise error
+            delay = random.uniform(
+                0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+            )
+            cls.wait(delay, operation, error=error)
+            Instrumentation.count("Retries")
+
+
+def utc_now() -> datetime.datetime:
+    """
+    utc_now returns the current time in UTC. Everything that depends on the
+    time of day gets it from here, so tests can fix it.
+    """
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def map_with_workers(func: Callable, items: Iterable, max_workers: int = 1) -> Iterator:
+    """
+    map_with_workers works like map(), but runs func on up to max_workers
+    threads at once when max_workers is more than 1. Results are always
+    yielded in the same order as items.
+    """
+    if max_workers <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(func, items)
+
+
+class MetricWriter:
+    """
+    MetricWriter buffers metric datums and writes them with as few
+    PutMetricData calls as the API limits allow. Use it as a context manager
+    so that anything still buffered is written on exit, unless the block
+    raised, in which case it is dropped.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.metric_data: List[Dict] = []
+        self.metric_data_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+        # Writing now could retry for a while, and a failure would replace
+        # the exception already being raised
+        if self.metric_data:
+            print(
+                "Dropping %d unwritten metric datums after error: %s"
+                % (len(self.metric_data), exc_value)
+            )
+        self.metric_data = []
+        self.metric_data_bytes = 0
+
+    def put(self, metric_name: str, value: float):
+        """
+        put buffers a datum, first writing out the buffer if the datum would
+        push the request past the PutMetricData limits.
+        """
+        datum = {"MetricName": metric_name, "Value": value}
+        # The request is form encoded, which costs more than JSON, so pad
+        # each datum's size generously.
+        datum_bytes = len(json.dumps(datum)) + 64
+        if (
+            len(self.metric_data) >= MAX_METRIC_DATA_DATUMS
+            or self.metric_data_bytes + datum_bytes > MAX_METRIC_DATA_BYTES
+        ):
+            self.flush()
+        self.metric_data.append(datum)
+        self.metric_data_bytes += datum_bytes
+
+    def flush(self):
+        """
+        flush writes every buffered datum in a single PutMetricData call.
+        """
+        if not self.metric_data:
+            return
+        Cloudwatch.call(
+            "put_metric_data",
+            Namespace=self.namespace,
+            MetricData=self.metric_data,
+        )
+        self.metric_data = []
+        self.metric_data_bytes = 0
+
+
+class RollupStore(ABC):
+    """
+    RollupStore is where a RollupCache keeps its state. Backends only need to
+    read and write a single named object.
+    """
+
+    @abstractmethod
+    def read(self, name: str) -> Optional[bytes]:
+        """
+        read returns the contents of the named object, or None if it does
+        not exist yet.
+        """
+
+    @abstractmethod
+    def write(self, name: str, body: bytes):
+        """
+        write replaces the contents of the named object.
+        """
+
+
+class LocalRollupStore(RollupStore):
+    """
+    LocalRollupStore keeps rollups in a local directory, for testing and for
+    running outside of Lambda.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name: str, body: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(body)
+
+
+class S3RollupStore(RollupStore):
+    """
+    S3RollupStore keeps rollups in an S3 bucket under an optional prefix.
+    """
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = boto3.client("s3")
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.prefix + name
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return response["Body"].read()
+
+    def write(self, name: str, body: bytes):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=body)
+
+
+def rollup_store_from_uri(uri: str) -> RollupStore:
+    """
+    rollup_store_from_uri returns an S3RollupStore for "s3://bucket/prefix"
+    URIs and a LocalRollupStore for anything else, treated as a directory.
+    """
+    if uri.startswith("s3://"):
+        bucket, _, prefix = uri[len("s3://") :].partition("/")
+        return S3RollupStore(bucket=bucket, prefix=prefix)
+    return LocalRollupStore(directory=uri)
+
+
+class RollupCache:
+    """
+    RollupCache keeps the daily totals of additive series (see
+    ADDITIVE_STATISTICS) so that an incremental run only queries CloudWatch
+    for days it has not seen before.
+
+    In incremental mode a window covers the window_days most recent complete
+    UTC days. Days that have aged out of every window are dropped on save.
+    """
+
+    object_name = "windowed_slo_rollups.json"
+
+    def __init__(self, store: RollupStore):
+        self.store = store
+        self.lock = threading.Lock()
+        # Settled daily totals, by series rollup_key and then ISO date
+        self.rollups: Dict[str, Dict[str, float]] = {}
+        # Daily totals that are too recent to cache, kept for this run only
+        self.unsettled: Dict[str, Dict[str, float]] = {}
+        # Days each series needed this run, which are the only ones saved
+        self.days_in_use: Dict[str, set] = {}
+
+        body = store.read(self.object_name)
+        if body:
+            try:
+                self.rollups = json.loads(body)["rollups"]
+            except (KeyError, TypeError, ValueError) as e:
+                print("Ignoring unreadable rollup cache: %s" % e)
+
+    def missing_days(self, series: "MetricSeries", days: List[str]) -> List[str]:
+        """
+        missing_days returns the days, out of those given, that have no
+        cached total for the series.
+        """
+        key = series.rollup_key()
+        with self.lock:
+            self.days_in_use.setdefault(key, set()).update(days)
+            rollups = self.rollups.get(key, {})
+            missing = [day for day in days if day not in rollups]
+        Instrumentation.count("RollupCacheHits", len(days) - len(missing))
+        Instrumentation.count("RollupCacheMisses", len(missing))
+        return missing
+
+    def update(
+        self,
+        series: "MetricSeries",
+        days: List[str],
+        totals: Dict[str, float],
+        settled_before: datetime.datetime,
+    ):
+        """
+        update records freshly fetched totals for the given days. Days with
+        no datapoints are recorded as 0. Only days that ended before
+        settled_before are kept for later runs.
+        """
+        key = series.rollup_key()
+        with self.lock:
+            for day in days:
+                day_end = datetime.datetime.fromisoformat(day) + datetime.timedelta(
+                    days=1
+                )
+                if day_end <= settled_before:
+                    rollups = self.rollups.setdefault(key, {})
+                else:
+                    rollups = self.unsettled.setdefault(key, {})
+                rollups[day] = totals.get(day, 0.0)
+
+    def daily_totals(self, series: "MetricSeries", days: List[str]) -> List[float]:
+        """
+        daily_totals returns the total of the series on each of the given
+        days.
+        """
+        key = series.rollup_key()
+        with self.lock:
+            rollups = self.rollups.get(key, {})
+            unsettled = self.unsettled.get(key, {})
+            return [rollups.get(day, unsettled.get(day, 0.0)) for day in days]
+
+    def save(self):
+        """
+        save writes the settled totals that are still in use to the store.
+        """
+        with self.lock:
+            rollups = {
+                key: {
+                    day: total
+                    for day, total in self.rollups.get(key, {}).items()
+                    if day in days
+                }
+                for key, days in self.days_in_use.items()
+            }
+        self.store.write(
+            self.object_name,
+            json.dumps(
+                {"version": 1, "rollups": rollups},
+                separators=(",", ":"),
+                sort_keys=True,
+            ).encode("utf-8"),
+        )
+
+
+class MetricSeries:
+    """
+    A single CloudWatch series (metric, dimensions and statistic) over
+    window_days. SingleMetrics that query the same series share one
+    MetricSeries, so it is fetched and summed once per invocation.
+
+    A daily series is fetched one complete UTC day at a time, so that totals
+    over any shorter trailing window can be computed from the same data.
+    """
+
+    def __init__(
+        self,
+        window_days: int,
+        namespace: str,
+        metric_name: str,
+        dimensions: List,
+        stat: str,
+        daily: bool = False,
+    ):
+        self.window_days = window_days
+        self.namespace = namespace
+        self.metric_name = metric_name
+        self.dimensions = dimensions
+        self.stat = stat
+        self.daily = daily
+
+        # Total over window_days, filled in by fetch_metrics
+        self.total: Optional[float] = None
+        # For daily series, trailing_totals[n - 1] is the total over the
+        # last n days
+        self.trailing_totals: List[float] = []
+
+    def set_daily_totals(self, daily_totals: List[float]):
+        """
+        set_daily_totals stores the total of each day in the window, oldest
+        first, as prefix sums from the newest day back.
+        """
+        self.trailing_totals = list(itertools.accumulate(reversed(daily_totals)))
+        self.total = self.trailing_totals[-1] if self.trailing_totals else 0.0
+
+    def window_total(self, window_days: Optional[int] = None) -> float:
+        """
+        window_total returns the total over the last window_days days, which
+        must be no longer than the series window. Shorter windows are only
+        available for daily series.
+        """
+        if window_days is None or window_days == self.window_days:
+            return self.total
+        return self.trailing_totals[window_days - 1]
+
+    def metric_stat(self, period: Optional[int] = None) -> Dict:
+        """
+        metric_stat returns the MetricStat used to query this series with
+        GetMetricData. By default the period is the whole window.
+        """
+        return {
+            "Metric": {
+                "Namespace": self.namespace,
+                "MetricName": self.metric_name,
+                "Dimensions": self.dimensions,
+            },
+            "Period": period or self.window_days * SECONDS_PER_DAY,
+            "Stat": self.stat,
+        }
+
+    def rollup_key(self) -> str:
+        """
+        rollup_key identifies the series in a RollupCache. It leaves out the
+        window, since cached days are shared by windows of any length.
+        """
+        return json.dumps(
+            [
+                self.namespace,
+                self.metric_name,
+                sorted(sorted(d.items()) for d in self.dimensions),
+                self.stat,
+            ],
+            separators=(",", ":"),
+        )
+
+    def window_days_before(self, day: datetime.datetime) -> List[str]:
+        """
+        window_days_before returns the ISO dates of the window_days complete
+        days before the given midnight, oldest first.
+        """
+        return [
+            (day - datetime.timedelta(days=n)).date().isoformat()
+            for n in range(self.window_days, 0, -1)
+        ]
+
 
 class SingleMetric:
     """
@@ -56,6 +760,10 @@ class SingleMetric:
           }
         ]
       }
+
+    If series_cache is given, the underlying MetricSeries is looked up there
+    (and added if missing), so identical queries across SLIs are only
+    fetched once. The multiplier always belongs to this SingleMetric.
     """
 
     def __init__(
@@ -67,6 +775,8 @@ class SingleMetric:
         statistic: Optional[str] = None,
         extended_statistic: Optional[str] = None,
         multiplier: float = 1.0,
+        series_cache: Optional[Dict[tuple, MetricSeries]] = None,
+        daily: bool = False,
     ):
         self.namespace = namespace
         self.metric_name = metric_name
@@ -74,44 +784,312 @@ class SingleMetric:
         self.statistic = statistic
         self.extended_statistic = extended_statistic
         self.multiplier = float(multiplier)
+        self.window_days = window_days
+        self.daily = daily
 
-        self.stat_args = {
-            "StartTime": datetime.datetime.utcnow()
-            - datetime.timedelta(days=window_days),
-            "EndTime": datetime.datetime.utcnow(),
-            "Period": window_days * 24 * 60 * 60,
-        }
-        if extended_statistic:
-            self.stat_args["ExtendedStatistics"] = [extended_statistic]
-        elif statistic:
-            self.stat_args["Statistics"] = [statistic]
-        else:
+        if not extended_statistic and not statistic:
             self.statistic = "Sum"
-            self.stat_args["Statistics"] = ["Sum"]
 
-    def sum(self) -> float:
+        key = self.series_key()
+        if series_cache is not None and key in series_cache:
+            self.series = series_cache[key]
+            Instrumentation.count("SeriesCacheHits")
+        else:
+            self.series = MetricSeries(
+                window_days=window_days,
+                namespace=namespace,
+                metric_name=metric_name,
+                dimensions=dimensions,
+                stat=extended_statistic or self.statistic,
+                daily=daily,
+            )
+            if series_cache is not None:
+                series_cache[key] = self.series
+
+    def series_key(self) -> tuple:
+        """
+        series_key returns a canonical key for the series this metric
+        queries, ignoring the order of its dimensions.
+        """
+        return (
+            self.namespace,
+            self.metric_name,
+            tuple(sorted(tuple(sorted(d.items())) for d in self.dimensions)),
+            self.statistic,
+            self.extended_statistic,
+            self.window_days,
+            self.daily,
+        )
+
+    @property
+    def total(self) -> Optional[float]:
+        """
+        total is the unmultiplied total of the underlying series, or None if
+        it has not been fetched yet.
+        """
+        return self.series.total
+
+    def sum(self, window_days: Optional[int] = None) -> float:
         """
         sum returns the sum of a single cloudwatch metric over window_days
-        multiplied by the multiplier.
+        (by default, the whole window) multiplied by the multiplier.
         """
+        if self.total is None:
+            fetch_metrics([self])
+        return self.series.window_total(window_days) * self.multiplier
+
+
+def fetch_metrics(
+    metrics: List[SingleMetric],
+    max_workers: int = 1,
+    rollup_cache: Optional[RollupCache] = None,
+):
+    """
+    fetch_metrics queries CloudWatch for the series behind every metric
+    given, using as few GetMetricData calls as possible, and stores the
+    total of each series on the series itself. Series shared by several
+    metrics are only queried once. With max_workers above 1 the calls run
+    concurrently.
+
+    Daily series are queried one complete UTC day at a time. With a
+    rollup_cache, additive series are also handled day by day, but summed
+    from cached daily totals so only the days missing from the cache are
+    queried.
+    """
+    end_time = utc_now().replace(tzinfo=None)
+    today = end_time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def is_cached(series: MetricSeries) -> bool:
+        return rollup_cache is not None and series.stat in ADDITIVE_STATISTICS
+
+    # Every query in a GetMetricData call shares one time range and period,
+    # so group the series by those before splitting them into pages.
+    ranges: Dict[tuple, Dict[int, MetricSeries]] = {}
+    for metric in metrics:
+        series = metric.series
+        if not series.daily and not is_cached(series):
+            time_range = (
+                end_time - datetime.timedelta(days=series.window_days),
+                end_time,
+                series.window_days * SECONDS_PER_DAY,
+            )
+        else:
+            days = series.window_days_before(today)
+            missing = days
+            if is_cached(series):
+                missing = rollup_cache.missing_days(series, days)
+                if not missing:
+                    series.set_daily_totals(rollup_cache.daily_totals(series, days))
+                    continue
+            time_range = (
+                datetime.datetime.fromisoformat(missing[0]),
+                datetime.datetime.fromisoformat(missing[-1])
+                + datetime.timedelta(days=1),
+                SECONDS_PER_DAY,
+            )
+        ranges.setdefault(time_range, {})[id(series)] = series
+
+    pages = []
+    for time_range, range_series in ranges.items():
+        series_list = list(range_series.values())
+        for i in range(0, len(series_list), MAX_METRIC_DATA_QUERIES):
+            pages.append((time_range, series_list[i : i + MAX_METRIC_DATA_QUERIES]))
+
+    def fetch_page(time_range_and_page):
+        (start_time, page_end_time, period), page = time_range_and_page
+        values = get_metric_data_values(
+            queries={"m%d" % n: s.metric_stat(period) for n, s in enumerate(page)},
+            start_time=start_time,
+            end_time=page_end_time,
+        )
+        for n, series in enumerate(page):
+            if not series.daily and not is_cached(series):
+                series.total = sum(value for _, value in values["m%d" % n])
+                continue
+
+            totals: Dict[str, float] = {}
+            for timestamp, value in values["m%d" % n]:
+                day = timestamp.date().isoformat()
+                totals[day] = totals.get(day, 0.0) + value
+            days = series.window_days_before(today)
+            if not is_cached(series):
+                series.set_daily_totals([totals.get(day, 0.0) for day in days])
+                continue
+
+            fetched_days = [
+                (start_time + datetime.timedelta(days=d)).date().isoformat()
+                for d in range((page_end_time - start_time).days)
+            ]
+            rollup_cache.update(
+                series,
+                days=fetched_days,
+                totals=totals,
+                settled_before=end_time - ROLLUP_SETTLE_TIME,
+            )
+            series.set_daily_totals(rollup_cache.daily_totals(series, days))
+
+    for _ in map_with_workers(fetch_page, pages, max_workers=max_workers):
+        pass
+
+
+def get_metric_data_values(
+    queries: Dict[str, Dict],
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+) -> Dict[str, List[tuple]]:
+    """
+    get_metric_data_values runs one GetMetricData request (following
+    NextToken as needed) and returns the (timestamp, value) datapoints for
+    each query id.
+    """
+    values: Dict[str, List[tuple]] = {query_id: [] for query_id in queries}
+    args = {
+        "MetricDataQueries": [
+            {"Id": query_id, "MetricStat": metric_stat, "ReturnData": True}
+            for query_id, metric_stat in queries.items()
+        ],
+        "StartTime": start_time,
+        "EndTime": end_time,
+    }
+    while True:
+        response = Cloudwatch.call("get_metric_data", **args)
+        for result in response["MetricDataResults"]:
+            Instrumentation.count("Datapoints", len(result["Values"]))
+            values[result["Id"]].extend(
+                zip(result.get("Timestamps", []), result["Values"])
+            )
+        if not response.get("NextToken"):
+            return values
+        args["NextToken"] = response["NextToken"]
+
+
+def parse_duration(duration: str) -> int:
+    """
+    parse_duration turns a duration such as "5m", "1h" or "3d" into seconds.
+    """
+    match = re.fullmatch(r"(\d+)([mhd])", duration)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("invalid burn rate window %r" % duration)
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class BurnRate:
+    """
+    BurnRate calculates how fast an SLI is using up its error budget over
+    several short windows. The SLI's metrics are fetched once, at the
+    coarsest period that evenly divides every window, over the longest
+    window, and each window is summed from the same datapoints.
+
+    A burn rate of 1 uses up exactly the error budget over the SLO window.
+    """
+
+    def __init__(self, sli: "SLI", slo_target: float, windows: List[str]):
+        self.sli = sli
+        self.slo_target = slo_target
+        # (label, seconds), shortest first
+        self.windows = sorted(
+            ((w, parse_duration(w)) for w in windows), key=lambda w: w[1]
+        )
+        self.lookback = self.windows[-1][1]
+        self.period = next(
+            period
+            for period in BURN_RATE_PERIODS
+            if all(seconds % period == 0 for _, seconds in self.windows)
+        )
+
+        # Filled in by fetch_burn_rates: the end of the last complete period,
+        # and the (timestamp, value) datapoints of each series by rollup_key
+        self.end_time: Optional[datetime.datetime] = None
+        self.values: Optional[Dict[str, List[tuple]]] = None
+
+    def total(self, metrics: List["SingleMetric"], seconds: int) -> float:
+        """
+        total returns the multiplied sum of the given metrics over the last
+        seconds.
+        """
+        start_time = self.end_time - datetime.timedelta(seconds=seconds)
         total = 0.0
-        for datapoint in Cloudwatch.client().get_metric_statistics(
-            Namespace=self.namespace,
-            MetricName=self.metric_name,
-            Dimensions=self.dimensions,
-            **self.stat_args,
-        )["Datapoints"]:
-            total += self.extract_stat(datapoint)
-        return total * self.multiplier
+        for metric in metrics:
+            datapoints = self.values[metric.series.rollup_key()]
+            total += metric.multiplier * sum(
+                value for timestamp, value in datapoints if timestamp >= start_time
+            )
+        return total
 
-    def extract_stat(self, datapoint: Dict) -> float:
+    def get_burn_rate(self, seconds: int) -> float:
         """
-        extract_stat takes a Cloudwatch datapoint and returns the numeric value
+        get_burn_rate returns the error rate over the last seconds divided by
+        the error rate the SLO target allows.
+
+        Can return ZeroDivisionError.
         """
-        if self.extended_statistic:
-            return datapoint["ExtendedStatistics"][self.extended_statistic]
+        ratio = self.total(self.sli.numerator.metrics, seconds) / self.total(
+            self.sli.denominator.metrics, seconds
+        )
+        return (1 - ratio) / (1 - self.slo_target)
 
-        return datapoint[self.statistic]
+
+def fetch_burn_rates(burn_rates: List[BurnRate], max_workers: int = 1):
+    """
+    fetch_burn_rates fetches the recent datapoints every BurnRate needs in as
+    few GetMetricData calls as possible. A series shared by several SLIs is
+    only queried once for each period and lookback it is needed at.
+    """
+    now = utc_now()
+
+    # Group series by (period, lookback), which sets the time range of a query
+    ranges: Dict[tuple, Dict[str, MetricSeries]] = {}
+    for burn_rate in burn_rates:
+        for metric in burn_rate.sli.metrics():
+            ranges.setdefault((burn_rate.period, burn_rate.lookback), {})[
+                metric.series.rollup_key()
+            ] = metric.series
+
+    pages = []
+    end_times: Dict[tuple, datetime.datetime] = {}
+    for (period, lookback), range_series in ranges.items():
+        # Only use complete periods
+        end_time = datetime.datetime.fromtimestamp(
+            now.timestamp() // period * period, tz=datetime.timezone.utc
+        )
+        end_times[(period, lookback)] = end_time
+        series_list = list(range_series.items())
+        for i in range(0, len(series_list), MAX_METRIC_DATA_QUERIES):
+            pages.append(
+                (
+                    period,
+                    lookback,
+                    end_time,
+                    series_list[i : i + MAX_METRIC_DATA_QUERIES],
+                )
+            )
+
+    values: Dict[tuple, List[tuple]] = {}
+
+    def fetch_page(page_args):
+        period, lookback, end_time, page = page_args
+        page_values = get_metric_data_values(
+            queries={
+                "m%d" % n: series.metric_stat(period)
+                for n, (_, series) in enumerate(page)
+            },
+            start_time=end_time - datetime.timedelta(seconds=lookback),
+            end_time=end_time,
+        )
+        for n, (key, _) in enumerate(page):
+            values[(period, lookback, key)] = page_values["m%d" % n]
+
+    for _ in map_with_workers(fetch_page, pages, max_workers=max_workers):
+        pass
+
+    for burn_rate in burn_rates:
+        burn_rate.end_time = end_times[(burn_rate.period, burn_rate.lookback)]
+        burn_rate.values = {
+            metric.series.rollup_key(): values[
+                (burn_rate.period, burn_rate.lookback, metric.series.rollup_key())
+            ]
+            for metric in burn_rate.sli.metrics()
+        }
 
 
 class CompositeMetric:
@@ -119,14 +1097,27 @@ class CompositeMetric:
     Holds multiple SingleMetrics allowing for returning the sum of the metrics.
     """
 
-    def __init__(self, window_days: int, metrics: List[Dict]):
-        self.metrics = [SingleMetric(window_days=window_days, **m) for m in metrics]
+    def __init__(
+        self,
+        window_days: int,
+        metrics: List[Dict],
+        series_cache: Optional[Dict[tuple, MetricSeries]] = None,
+        daily: bool = False,
+    ):
+        self.metrics = [
+            SingleMetric(
+                window_days=window_days, series_cache=series_cache, daily=daily, **m
+            )
+            for m in metrics
+        ]
+
+    def sum(self, window_days: Optional[int] = None) -> float:
+        fetch_metrics([m for m in self.metrics if m.total is None])
 
-    def sum(self) -> float:
         total = 0.0
 
         for m in self.metrics:
-            total += m.sum()
+            total += m.sum(window_days)
 
         return total
 
@@ -143,6 +1134,7 @@ class SLI:
 
     interesting_availability = {
       window_days = 30
+      windows     = [1, 7]
       numerator = {
         namespace   = "foo_env/sli"
         metric_name = "InterestingUrisSuccess"
@@ -155,6 +1147,17 @@ class SLI:
       }
       ...
     }
+
+    `windows` optionally lists extra window lengths, in days, to publish the
+    SLI over as well as window_days. The metrics are then fetched once, one
+    complete UTC day at a time over the longest window, and every window is
+    calculated from the same daily totals. That only makes sense for Sum and
+    SampleCount metrics.
+
+    With an `slo_target` (e.g. 0.999), the fraction of the error budget
+    consumed and remaining over window_days is published too, and
+    `burn_rate_windows` (e.g. ["5m", "1h", "6h"]) publishes the burn rate
+    over each of those windows (see BurnRate).
     """
 
     def __init__(
@@ -163,20 +1166,82 @@ class SLI:
         denominator: List[Dict],
         description: str = "",
         window_days: int = WINDOW_DAYS,
+        windows: Optional[List[int]] = None,
+        slo_target: Optional[float] = None,
+        burn_rate_windows: Optional[List[str]] = None,
+        series_cache: Optional[Dict[tuple, MetricSeries]] = None,
     ):
         if window_days is None:
             window_days = WINDOW_DAYS
-        self.numerator = CompositeMetric(window_days=window_days, metrics=numerator)
-        self.denominator = CompositeMetric(window_days=window_days, metrics=denominator)
+        self.window_days = window_days
+        self.windows = sorted(set(windows or []))
+        if any(n < 1 for n in self.windows):
+            raise ValueError("windows must be at least 1 day long")
 
-    def get_ratio(self) -> float:
+        daily = bool(self.windows)
+        fetch_days = max([window_days] + self.windows)
+        self.numerator = CompositeMetric(
+            window_days=fetch_days,
+            metrics=numerator,
+            series_cache=series_cache,
+            daily=daily,
+        )
+        self.denominator = CompositeMetric(
+            window_days=fetch_days,
+            metrics=denominator,
+            series_cache=series_cache,
+            daily=daily,
+        )
+
+        # Both daily windows and burn rates add datapoints up, which only
+        # gives a meaningful total for additive statistics
+        if (daily or burn_rate_windows) and any(
+            m.series.stat not in ADDITIVE_STATISTICS for m in self.metrics()
+        ):
+            raise ValueError(
+                "%s can only be used with %s metrics"
+                % (
+                    "windows" if daily else "burn_rate_windows",
+                    " or ".join(ADDITIVE_STATISTICS),
+                )
+            )
+
+        if slo_target is not None and not 0 < slo_target < 1:
+            raise ValueError("slo_target must be between 0 and 1")
+        self.slo_target = slo_target
+        self.burn_rate: Optional[BurnRate] = None
+        if burn_rate_windows:
+            if slo_target is None:
+                raise ValueError("burn_rate_windows need an slo_target")
+            self.burn_rate = BurnRate(
+                sli=self, slo_target=slo_target, windows=burn_rate_windows
+            )
+
+    def get_ratio(self, window_days: Optional[int] = None) -> float:
         """
         get_ratio returns the sum of the numerator divided by the sum of the
-        denominator, calculated over the last window_days.
+        denominator, calculated over the last window_days (by default, the
+        SLI's window_days).
 
         Can return ZeroDivisonError.
         """
-        return self.numerator.sum() / self.denominator.sum()
+        if window_days is None:
+            window_days = self.window_days
+        fetch_metrics([m for m in self.metrics() if m.total is None])
+        return self.numerator.sum(window_days) / self.denominator.sum(window_days)
+
+    def published_windows(self) -> List[tuple]:
+        """
+        published_windows returns (metric name suffix, window_days) for each
+        window the SLI is published over.
+        """
+        return [("", self.window_days)] + [("-%dd" % n, n) for n in self.windows]
+
+    def metrics(self) -> List[SingleMetric]:
+        """
+        metrics returns every SingleMetric in the numerator and denominator.
+        """
+        return self.numerator.metrics + self.denominator.metrics
 
 
 def publish_slis(
@@ -184,37 +1249,121 @@ def publish_slis(
     sli_namespace: str,
     sli_prefix: str,
     handle_exceptions: bool = True,
+    max_workers: int = 1,
+    rollup_cache: Optional[RollupCache] = None,
+    burn_rates_only: bool = False,
 ):
     """
     create_slis takes a dictionary of SLIs, gets their values and writes the
-    associated Cloudwatch metrics.
+    associated Cloudwatch metrics. With max_workers above 1 the SLIs are
+    evaluated concurrently, but results are still logged and written in
+    the order of slis, exactly as in serial mode.
+
+    With a rollup_cache, SLIs are computed incrementally from daily totals
+    (see RollupCache), and the cache is saved once every SLI is evaluated.
+
+    With burn_rates_only, only burn rates are published, which only needs
+    recent datapoints, so it is cheap enough to run every few minutes.
     """
-    for sli_name, sli in slis.items():
+    burn_rates = [sli.burn_rate for sli in slis.values() if sli.burn_rate]
+
+    # Fetch every metric up front in batches. Anything this fails to fetch
+    # is retried per SLI below, so errors are still reported per SLI.
+    try:
+        if not burn_rates_only:
+            fetch_metrics(
+                [m for sli in slis.values() for m in sli.metrics() if m.total is None],
+                max_workers=max_workers,
+                rollup_cache=rollup_cache,
+            )
+        fetch_burn_rates(burn_rates, max_workers=max_workers)
+    except (
+        botocore.exceptions.ClientError,
+        botocore.exceptions.BotoCoreError,
+    ) as e:
+        if not handle_exceptions:
+            raise
+        print("CloudWatch API error fetching SLI metrics: %s" % e)
+
+    def get_ratios(name_and_sli):
+        sli_name, sli = name_and_sli
+        Instrumentation.count("SlisEvaluated")
+        with Instrumentation.timer("SliTime", key=sli_name):
+            return evaluate(sli)
+
+    def evaluate(sli):
+        try:
+            if not burn_rates_only:
+                fetch_metrics(
+                    [m for m in sli.metrics() if m.total is None],
+                    rollup_cache=rollup_cache,
+                )
+            if sli.burn_rate is not None and sli.burn_rate.values is None:
+                fetch_burn_rates([sli.burn_rate])
+        except (
+            botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError,
+        ) as e:
+            return [("", None, e)]
+
+        ratios = []
+        for suffix, window_days in [] if burn_rates_only else sli.published_windows():
+            try:
+                ratio = sli.get_ratio(window_days)
+            except (
+                ZeroDivisionError,
+                botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError,
+            ) as e:
+                ratios.append((suffix, None, e))
+                continue
+            ratios.append((suffix, ratio, None))
+            if suffix == "" and sli.slo_target is not None:
+                budget_consumed = (1 - ratio) / (1 - sli.slo_target)
+                ratios.append(("-budget-consumed", budget_consumed, None))
+                ratios.append(("-budget-remaining", 1 - budget_consumed, None))
+
+        if sli.burn_rate is not None:
+            for label, seconds in sli.burn_rate.windows:
+                try:
+                    burn_rate = sli.burn_rate.get_burn_rate(seconds)
+                except ZeroDivisionError as e:
+                    ratios.append(("-burn-rate-" + label, None, e))
+                    continue
+                ratios.append(("-burn-rate-" + label, burn_rate, None))
+
+        return ratios
+
+    with MetricWriter(namespace=sli_namespace) as writer:
+        results = map_with_workers(get_ratios, slis.items(), max_workers=max_workers)
+        for sli_name, ratios in zip(slis, results):
+            for suffix, value, error in ratios:
+                name = sli_name + suffix
+                if isinstance(error, ZeroDivisionError):
+                    print("x/0 error for %s" % name)
+                    continue
+                if error is not None:
+                    if not handle_exceptions:
+                        raise error
+                    print("CloudWatch API error for %s: %s" % (name, error))
+                    continue
+
+                print("%s: %f" % (name, value))
+                writer.put(metric_name=sli_prefix + "-" + name, value=value)
+
+    if rollup_cache is not None:
         try:
-            value = sli.get_ratio()
-        except ZeroDivisionError:
-            print("x/0 error for %s" % sli_name)
-            continue
+            with Instrumentation.timer("RollupCacheSaveTime"):
+                rollup_cache.save()
         except (
             botocore.exceptions.ClientError,
             botocore.exceptions.BotoCoreError,
+            OSError,
         ) as e:
             if not handle_exceptions:
                 raise
-            print("CloudWatch API error for %s: %s" % (sli_name, e))
-            continue
-
-        print("%s: %f" % (sli_name, value))
-        metric_data = [
-            {
-                "MetricName": sli_prefix + "-" + sli_name,
-                "Value": value,
-            }
-        ]
-        Cloudwatch.client().put_metric_data(
-            Namespace=sli_namespace,
-            MetricData=metric_data,
-        )
+            # The next run just queries the days that were not saved
+            print("Error saving rollup cache: %s" % e)
 
 
 def parse_sli_json(sli_json: str, handle_exceptions: bool = True) -> Dict[str, SLI]:
@@ -227,11 +1376,13 @@ def parse_sli_json(sli_json: str, handle_exceptions: bool = True) -> Dict[str, S
 
     sli_configs = json.loads(sli_json)
     slis = {}
+    # Shared by every SLI so that identical metric queries are interned
+    series_cache: Dict[tuple, MetricSeries] = {}
     # Since the SLIs were defined in Terraform and converted to JSON
     # dictionaries, we need to convert them to SLI objects.
     for sli_name, sli_config in sli_configs.items():
         try:
-            slis[sli_name] = SLI(**sli_config)
+            slis[sli_name] = SLI(series_cache=series_cache, **sli_config)
         except (KeyError, TypeError, ValueError) as e:
             if not handle_exceptions:
                 raise
@@ -249,11 +1400,33 @@ def lambda_handler(event, context):
     if SLIS is None:
         raise RuntimeError("SLIS definition JSON not set in environment")
 
+    Instrumentation.reset(enabled=INSTRUMENTATION)
+    Cloudwatch.set_deadline(context)
+
     # Parse SLIs into SLI objects
-    slis = parse_sli_json(sli_json=SLIS)
+    with Instrumentation.timer("ParseTime"):
+        slis = parse_sli_json(sli_json=SLIS)
+
+    # A scheduled burn rate check only publishes burn rates
+    burn_rates_only = bool(event and event.get("burn_rates_only"))
+
+    rollup_cache = None
+    if ROLLUP_CACHE and not burn_rates_only:
+        with Instrumentation.timer("RollupCacheLoadTime"):
+            rollup_cache = RollupCache(store=rollup_store_from_uri(ROLLUP_CACHE))
 
     # Write SLI metrics from the SLI definitions
-    publish_slis(slis=slis, sli_namespace=SLI_NAMESPACE, sli_prefix=SLI_PREFIX)
+    with Instrumentation.timer("PublishTime"):
+        publish_slis(
+            slis=slis,
+            sli_namespace=SLI_NAMESPACE,
+            sli_prefix=SLI_PREFIX,
+            max_workers=MAX_WORKERS,
+            rollup_cache=rollup_cache,
+            burn_rates_only=burn_rates_only,
+        )
+
+    Instrumentation.emit(dimensions={"SliPrefix": SLI_PREFIX})
 
 
 def main():
@@ -0,0 +1,240 @@
+"""
+Benchmarks parse_sli_json and publish_slis against a local, latency-injecting
+stand-in for CloudWatch, so we can see how a run scales with the size of the
+SLI config before it gets anywhere near the Lambda timeout.
+
+Example:
+
+  python windowed_slo_bench.py --slis 10 100 1000 10000 --fan-out 3 \\
+      --latency-ms 20 --max-workers 1 4
+
+Prints one JSON result per line.
+"""
+
+from typing import Dict, List
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# windowed_slo reads its config from the environment at import time
+os.environ.setdefault("SLIS", "")
+os.environ.setdefault("WINDOW_DAYS", "28")
+
+# autopep8: off
+from windowed_slo import (
+    MAX_METRIC_DATA_DATUMS,
+    MAX_METRIC_DATA_QUERIES,
+    Cloudwatch,
+    fetch_metrics,
+    parse_sli_json,
+    publish_slis,
+)
+
+# autopep8: on
+
+
+class FakeCloudwatch:
+    """
+    FakeCloudwatch answers GetMetricData and PutMetricData locally, sleeping
+    for latency seconds per call to stand in for the network. It counts
+    calls by operation and rejects requests over the API limits.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.datapoints = 0
+
+    def record(self, operation: str, datapoints: int = 0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.datapoints += datapoints
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        if len(MetricDataQueries) > MAX_METRIC_DATA_QUERIES:
+            raise ValueError("too many MetricDataQueries")
+
+        # One datapoint per period, all with the same value
+        results = []
+        for query in MetricDataQueries:
+            period = query["MetricStat"]["Period"]
+            timestamps = []
+            timestamp = StartTime
+            while timestamp < EndTime:
+                timestamps.append(timestamp)
+                timestamp += datetime.timedelta(seconds=period)
+            results.append(
+                {
+                    "Id": query["Id"],
+                    "Timestamps": timestamps,
+                    "Values": [1.0] * len(timestamps),
+                    "StatusCode": "Complete",
+                }
+            )
+
+        self.record("GetMetricData", sum(len(r["Values"]) for r in results))
+        return {"MetricDataResults": results}
+
+    def put_metric_data(self, Namespace, MetricData):
+        if len(MetricData) > MAX_METRIC_DATA_DATUMS:
+            raise ValueError("too many MetricData datums")
+        self.record("PutMetricData", len(MetricData))
+        return {}
+
+
+def generate_sli_config(
+    num_slis: int, fan_out: int = 1, shared_denominators: int = 0
+) -> Dict:
+    """
+    generate_sli_config returns a synthetic SLI config with num_slis SLIs,
+    each with fan_out numerator and denominator metrics. With
+    shared_denominators, the SLIs reuse that many distinct denominators, as
+    SLIs built on the same load balancer do.
+    """
+
+    def metric(metric_name: str, n: int) -> Dict:
+        return {
+            "namespace": "bench/sli",
+            "metric_name": metric_name,
+            "dimensions": [{"Name": "Service", "Value": "service-%d" % n}],
+        }
+
+    sli_config = {}
+    for n in range(num_slis):
+        denominator_n = n % shared_denominators if shared_denominators else n
+        sli_config["sli-%d" % n] = {
+            "description": "Synthetic SLI %d" % n,
+            "numerator": [metric("Good%d" % f, n) for f in range(fan_out)],
+            "denominator": [
+                metric("Total%d" % f, denominator_n) for f in range(fan_out)
+            ],
+        }
+    return sli_config
+
+
+def run_cycle(sli_json: str, max_workers: int) -> Dict[str, float]:
+    """
+    run_cycle parses and publishes the SLIs once, returning the time spent
+    in each phase.
+    """
+    phases = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        slis = parse_sli_json(sli_json, handle_exceptions=False)
+        phases["parse"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fetch_metrics(
+            [m for sli in slis.values() for m in sli.metrics()],
+            max_workers=max_workers,
+        )
+        phases["fetch"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        publish_slis(
+            slis,
+            sli_namespace="bench/sli",
+            sli_prefix="bench",
+            handle_exceptions=False,
+            max_workers=max_workers,
+        )
+        phases["publish"] = time.perf_counter() - start
+    return phases
+
+
+def run_benchmark(
+    num_slis: int,
+    fan_out: int = 1,
+    shared_denominators: int = 0,
+    latency: float = 0.0,
+    max_workers: int = 1,
+    measure_memory: bool = True,
+    api_rate: float = 0.0,
+) -> Dict:
+    """
+    run_benchmark runs one parse and publish cycle against a FakeCloudwatch
+    and returns its timings and API call counts. tracemalloc slows Python
+    down considerably, so with measure_memory the peak memory is measured
+    in a second, untimed cycle. CloudWatch calls are not rate limited
+    unless api_rate is set.
+    """
+    sli_json = json.dumps(
+        generate_sli_config(
+            num_slis=num_slis,
+            fan_out=fan_out,
+            shared_denominators=shared_denominators,
+        )
+    )
+    cloudwatch = FakeCloudwatch(latency=latency)
+    original_client = Cloudwatch.cloudwatch_client
+    original_api_rate = Cloudwatch.api_rate
+    Cloudwatch.cloudwatch_client = cloudwatch
+    Cloudwatch.api_rate = api_rate
+    try:
+        phases = run_cycle(sli_json, max_workers=max_workers)
+        calls = dict(cloudwatch.calls)
+        datapoints = cloudwatch.datapoints
+
+        peak_memory = None
+        if measure_memory:
+            cloudwatch.latency = 0.0
+            tracemalloc.start()
+            try:
+                run_cycle(sli_json, max_workers=max_workers)
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+    finally:
+        Cloudwatch.cloudwatch_client = original_client
+        Cloudwatch.api_rate = original_api_rate
+
+    return {
+        "slis": num_slis,
+        "fan_out": fan_out,
+        "shared_denominators": shared_denominators,
+        "latency_ms": latency * 1000,
+        "max_workers": max_workers,
+        "api_rate": api_rate,
+        "wall_time_s": sum(phases.values()),
+        "phases_s": phases,
+        "api_calls": calls,
+        "datapoints": datapoints,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slis", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--fan-out", type=int, default=1)
+    parser.add_argument("--shared-denominators", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--max-workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--api-rate", type=float, default=0.0)
+    parser.add_argument("--no-memory", action="store_true")
+    args = parser.parse_args(argv)
+
+    for max_workers in args.max_workers:
+        for num_slis in args.slis:
+            result = run_benchmark(
+                num_slis=num_slis,
+                fan_out=args.fan_out,
+                shared_denominators=args.shared_denominators,
+                latency=args.latency_ms / 1000,
+                max_workers=max_workers,
+                measure_memory=not args.no_memory,
+                api_rate=args.api_rate,
+            )
+            print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
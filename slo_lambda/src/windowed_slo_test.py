@@ -1,9 +1,13 @@
+import datetime
 import os
+import time
 import boto3
+import botocore  # type: ignore
 import json
 from botocore.stub import Stubber, ANY
 from moto import mock_aws
 import pytest
+from unittest.mock import MagicMock, patch
 
 os.environ["WINDOW_DAYS"] = "24"
 SLI_NAMESPACE = "test/sli"
@@ -12,27 +16,67 @@ os.environ["SLIS"] = ""
 
 # This import relies on our env var insertions above, so can't be reordered
 # autopep8: off
-from windowed_slo import parse_sli_json, publish_slis, Cloudwatch
+from windowed_slo import (
+    parse_sli_json,
+    publish_slis,
+    fetch_metrics,
+    Cloudwatch,
+    DeadlineExceededError,
+    Instrumentation,
+    LocalRollupStore,
+    MetricWriter,
+    RollupCache,
+    TokenBucket,
+)
 
 # autopep8: on
 
 LOAD_BALANCER_ID = "app/login-idp-alb-pretend/1234"
 
 
-def get_metric_statistics(metric_name, datapoints_sum):
+def metric_data_query(query_id, metric_name):
+    return {
+        "Id": query_id,
+        "MetricStat": {
+            "Metric": {
+                "Namespace": "AWS/ApplicationELB",
+                "MetricName": metric_name,
+                "Dimensions": [{"Name": "LoadBalancer", "Value": LOAD_BALANCER_ID}],
+            },
+            "Period": 2073600,
+            "Stat": "Sum",
+        },
+        "ReturnData": True,
+    }
+
+
+def get_metric_data(metric_sums, next_token=None):
+    """
+    Builds a Stubber response for a single GetMetricData call, given
+    (metric_name, sum) pairs in query order.
+    """
+    response = {
+        "MetricDataResults": [
+            {
+                "Id": "m%d" % n,
+                "Timestamps": [datetime.datetime(2024, 1, 1)],
+                "Values": [datapoints_sum],
+            }
+            for n, (_, datapoints_sum) in enumerate(metric_sums)
+        ]
+    }
+    if next_token:
+        response["NextToken"] = next_token
     return [
-        "get_metric_statistics",
-        {"Datapoints": [{"Sum": datapoints_sum}]},
+        "get_metric_data",
+        response,
         {
-            "Dimensions": [
-                {"Name": "LoadBalancer", "Value": "app/login-idp-alb-pretend/1234"}
+            "MetricDataQueries": [
+                metric_data_query("m%d" % n, metric_name)
+                for n, (metric_name, _) in enumerate(metric_sums)
             ],
-            "EndTime": ANY,
-            "MetricName": metric_name,
-            "Namespace": "AWS/ApplicationELB",
-            "Period": 2073600,
             "StartTime": ANY,
-            "Statistics": ["Sum"],
+            "EndTime": ANY,
         },
     ]
 
@@ -52,9 +96,15 @@ def put_metric_data(metric_name, value):
 def test_simple_sli():
     cw = boto3.client("cloudwatch", region_name="us-west-2")
     with Stubber(cw) as stubber:
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_2XX_Count", 2))
-        stubber.add_response(*get_metric_statistics("RequestCount", 4))
-        stubber.add_response(*get_metric_statistics("HTTPCode_ELB_5XX_Count", 2))
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 2),
+                    ("RequestCount", 4),
+                    ("HTTPCode_ELB_5XX_Count", 2),
+                ]
+            )
+        )
         stubber.add_response(*put_metric_data("test-http-200-availability", 1 / 3))
 
         Cloudwatch.cloudwatch_client = cw
@@ -109,11 +159,17 @@ def test_multiple_metric_sli():
     cw = boto3.client("cloudwatch", region_name="us-west-2")
 
     with Stubber(cw) as stubber:
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_2XX_Count", 2))
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_3XX_Count", 1))
-        stubber.add_response(*get_metric_statistics("HTTPCode_Target_4XX_Count", 1))
-        stubber.add_response(*get_metric_statistics("RequestCount", 6))
-        stubber.add_response(*get_metric_statistics("HTTPCode_ELB_5XX_Count", 2))
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 2),
+                    ("HTTPCode_Target_3XX_Count", 1),
+                    ("HTTPCode_Target_4XX_Count", 1),
+                    ("RequestCount", 6),
+                    ("HTTPCode_ELB_5XX_Count", 2),
+                ]
+            )
+        )
         stubber.add_response(*put_metric_data("test-all-availability", 0.5))
 
         Cloudwatch.cloudwatch_client = cw
@@ -182,6 +238,625 @@ def test_multiple_metric_sli():
         publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
 
 
+def alb_metric(metric_name):
+    return {
+        "namespace": "AWS/ApplicationELB",
+        "metric_name": metric_name,
+        "dimensions": [{"Name": "LoadBalancer", "Value": LOAD_BALANCER_ID}],
+    }
+
+
+@mock_aws
+def test_metric_queries_are_paged():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    # 300 SLIs of two metrics each need two GetMetricData pages of 500 and 100
+    sli_config = {
+        f"sli-{n}": {
+            "window_days": 24,
+            "numerator": [alb_metric("Good%d" % n)],
+            "denominator": [alb_metric("Total%d" % n)],
+        }
+        for n in range(300)
+    }
+    metric_sums = []
+    for n in range(300):
+        metric_sums.append(("Good%d" % n, 1))
+        metric_sums.append(("Total%d" % n, 4))
+
+    with Stubber(cw) as stubber:
+        # The first page is split across two responses by NextToken
+        first_page = get_metric_data(metric_sums[:500], next_token="more")
+        first_page[1]["MetricDataResults"] = first_page[1]["MetricDataResults"][:250]
+        stubber.add_response(*first_page)
+        first_page_rest = get_metric_data(metric_sums[:500])
+        first_page_rest[1]["MetricDataResults"] = first_page_rest[1][
+            "MetricDataResults"
+        ][250:]
+        first_page_rest[2]["NextToken"] = "more"
+        stubber.add_response(*first_page_rest)
+        stubber.add_response(*get_metric_data(metric_sums[500:]))
+
+        Cloudwatch.cloudwatch_client = cw
+
+        slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+        fetch_metrics([m for sli in slis.values() for m in sli.metrics()])
+        stubber.assert_no_pending_responses()
+
+        # Every ratio is computed from the batched results, without more calls
+        for sli in slis.values():
+            assert sli.get_ratio() == 0.25
+
+
+@mock_aws
+def test_metric_writer_chunks_puts():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    metric_data = [
+        {"MetricName": f"test-sli-{n}", "Value": n / 1000} for n in range(1001)
+    ]
+
+    with Stubber(cw) as stubber:
+        stubber.add_response(
+            "put_metric_data",
+            {},
+            {"MetricData": metric_data[:1000], "Namespace": "test/sli"},
+        )
+        stubber.add_response(
+            "put_metric_data",
+            {},
+            {"MetricData": metric_data[1000:], "Namespace": "test/sli"},
+        )
+
+        Cloudwatch.cloudwatch_client = cw
+
+        with MetricWriter(namespace=SLI_NAMESPACE) as writer:
+            for datum in metric_data:
+                writer.put(metric_name=datum["MetricName"], value=datum["Value"])
+            # Only the full chunk has been written before exit
+            assert len(writer.metric_data) == 1
+
+        stubber.assert_no_pending_responses()
+
+
+def test_metric_writer_drops_buffer_on_error(monkeypatch, capsys):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    monkeypatch.setattr(cw, "put_metric_data", MagicMock())
+    monkeypatch.setattr(Cloudwatch, "cloudwatch_client", cw)
+
+    with pytest.raises(ValueError, match="original error"):
+        with MetricWriter(namespace=SLI_NAMESPACE) as writer:
+            writer.put(metric_name="test-availability", value=0.75)
+            raise ValueError("original error")
+
+    cw.put_metric_data.assert_not_called()
+    assert writer.metric_data == []
+    assert "Dropping 1 unwritten metric datums" in capsys.readouterr().out
+
+
+@mock_aws
+def test_concurrent_matches_serial(capsys):
+    sli_config = {
+        f"sli-{n}": {
+            "window_days": 24,
+            "numerator": [alb_metric(f"Good{n}")],
+            "denominator": [alb_metric(f"Total{n}")],
+        }
+        for n in range(20)
+    }
+    # Every fifth SLI has no requests, so is skipped with a x/0 error
+    metric_sums = []
+    for n in range(20):
+        metric_sums.append((f"Good{n}", n % 5))
+        metric_sums.append((f"Total{n}", n % 5 * 2))
+
+    outputs = []
+    for max_workers in (1, 4):
+        cw = boto3.client("cloudwatch", region_name="us-west-2")
+        with Stubber(cw) as stubber:
+            stubber.add_response(*get_metric_data(metric_sums))
+            stubber.add_response(
+                "put_metric_data",
+                {},
+                {
+                    "MetricData": [
+                        {"MetricName": f"test-sli-{n}", "Value": 0.5}
+                        for n in range(20)
+                        if n % 5
+                    ],
+                    "Namespace": "test/sli",
+                },
+            )
+
+            Cloudwatch.cloudwatch_client = cw
+
+            slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+            publish_slis(
+                slis,
+                SLI_NAMESPACE,
+                SLI_PREFIX,
+                handle_exceptions=False,
+                max_workers=max_workers,
+            )
+            stubber.assert_no_pending_responses()
+        outputs.append(capsys.readouterr().out)
+
+    assert "x/0 error for sli-5" in outputs[0]
+    assert outputs[0] == outputs[1]
+
+
+@mock_aws
+def test_shared_metrics_are_fetched_once():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+
+    requests = alb_metric("RequestCount")
+    # Same series, with dimensions in a different order and a multiplier
+    requests_reordered = {
+        "namespace": "AWS/ApplicationELB",
+        "metric_name": "RequestCount",
+        "statistic": "Sum",
+        "multiplier": 2,
+        "dimensions": [{"Value": LOAD_BALANCER_ID, "Name": "LoadBalancer"}],
+    }
+    sli_config = {
+        "2xx-availability": {
+            "window_days": 24,
+            "numerator": [alb_metric("HTTPCode_Target_2XX_Count")],
+            "denominator": [requests],
+        },
+        "3xx-availability": {
+            "window_days": 24,
+            "numerator": [alb_metric("HTTPCode_Target_3XX_Count")],
+            "denominator": [requests_reordered],
+        },
+    }
+
+    with Stubber(cw) as stubber:
+        stubber.add_response(
+            *get_metric_data(
+                [
+                    ("HTTPCode_Target_2XX_Count", 3),
+                    ("RequestCount", 4),
+                    ("HTTPCode_Target_3XX_Count", 1),
+                ]
+            )
+        )
+        stubber.add_response(
+            "put_metric_data",
+            {},
+            {
+                "MetricData": [
+                    {"MetricName": "test-2xx-availability", "Value": 0.75},
+                    {"MetricName": "test-3xx-availability", "Value": 0.125},
+                ],
+                "Namespace": "test/sli",
+            },
+        )
+
+        Cloudwatch.cloudwatch_client = cw
+
+        slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+        assert (
+            slis["2xx-availability"].denominator.metrics[0].series
+            is slis["3xx-availability"].denominator.metrics[0].series
+        )
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+        stubber.assert_no_pending_responses()
+
+
+# Late enough in the day that yesterday's rollups have settled
+NOON = datetime.datetime(2025, 1, 15, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+@mock_aws
+@patch("windowed_slo.utc_now", return_value=NOON)
+def test_incremental_rollups(utc_now, tmp_path):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    store = LocalRollupStore(directory=str(tmp_path))
+    today = NOON.replace(hour=0, tzinfo=None)
+    days = [today - datetime.timedelta(days=n) for n in (3, 2, 1)]
+
+    sli_config = {
+        "availability": {
+            "window_days": 3,
+            "numerator": [alb_metric("HTTPCode_Target_2XX_Count")],
+            "denominator": [alb_metric("RequestCount")],
+        }
+    }
+
+    def daily_query(query_id, metric_name):
+        query = metric_data_query(query_id, metric_name)
+        query["MetricStat"]["Period"] = 86400
+        return query
+
+    with Stubber(cw) as stubber:
+        # With an empty cache the whole window is queried by day
+        stubber.add_response(
+            "get_metric_data",
+            {
+                "MetricDataResults": [
+                    {"Id": "m0", "Timestamps": days, "Values": [1, 2, 3]},
+                    # No datapoints at all on the first day
+                    {"Id": "m1", "Timestamps": days[1:], "Values": [4, 4]},
+                ]
+            },
+            {
+                "MetricDataQueries": [
+                    daily_query("m0", "HTTPCode_Target_2XX_Count"),
+                    daily_query("m1", "RequestCount"),
+                ],
+                "StartTime": days[0],
+                "EndTime": today,
+            },
+        )
+        stubber.add_response(*put_metric_data("test-availability", 0.75))
+        # Once cached, the next run in the same day makes no queries
+        stubber.add_response(*put_metric_data("test-availability", 0.75))
+
+        Cloudwatch.cloudwatch_client = cw
+
+        for _ in range(2):
+            slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+            publish_slis(
+                slis,
+                SLI_NAMESPACE,
+                SLI_PREFIX,
+                handle_exceptions=False,
+                rollup_cache=RollupCache(store=store),
+            )
+
+            # Add a day that has aged out of the window, to check it is evicted
+            cache = json.loads(store.read(RollupCache.object_name))
+            for rollups in cache["rollups"].values():
+                assert sorted(rollups) == [d.date().isoformat() for d in days]
+                rollups["2000-01-01"] = 100
+            store.write(RollupCache.object_name, json.dumps(cache).encode("utf-8"))
+
+        stubber.assert_no_pending_responses()
+
+
+@mock_aws
+def test_multiple_windows(capsys):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    today = datetime.datetime.utcnow().replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    days = [today - datetime.timedelta(days=n) for n in (3, 2, 1)]
+
+    sli_config = {
+        "availability": {
+            "window_days": 3,
+            "windows": [2, 1],
+            "numerator": [alb_metric("HTTPCode_Target_2XX_Count")],
+            "denominator": [alb_metric("RequestCount")],
+        }
+    }
+
+    def daily_query(query_id, metric_name):
+        query = metric_data_query(query_id, metric_name)
+        query["MetricStat"]["Period"] = 86400
+        return query
+
+    with Stubber(cw) as stubber:
+        # Daily datapoints are fetched once, for the longest window
+        stubber.add_response(
+            "get_metric_data",
+            {
+                "MetricDataResults": [
+                    {"Id": "m0", "Timestamps": days[:2], "Values": [1, 2]},
+                    {"Id": "m1", "Timestamps": days[:2], "Values": [4, 4]},
+                ]
+            },
+            {
+                "MetricDataQueries": [
+                    daily_query("m0", "HTTPCode_Target_2XX_Count"),
+                    daily_query("m1", "RequestCount"),
+                ],
+                "StartTime": days[0],
+                "EndTime": today,
+            },
+        )
+        stubber.add_response(
+            "put_metric_data",
+            {},
+            {
+                "MetricData": [
+                    {"MetricName": "test-availability", "Value": 0.375},
+                    {"MetricName": "test-availability-2d", "Value": 0.5},
+                ],
+                "Namespace": "test/sli",
+            },
+        )
+
+        Cloudwatch.cloudwatch_client = cw
+
+        slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+        publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+        stubber.assert_no_pending_responses()
+
+    # No requests at all on the last day
+    assert "x/0 error for availability-1d" in capsys.readouterr().out
+
+
+def test_windows_need_additive_statistics():
+    sli_config = {
+        "latency": {
+            "windows": [1, 7],
+            "numerator": [dict(alb_metric("TargetResponseTime"), statistic="Average")],
+            "denominator": [alb_metric("RequestCount")],
+        }
+    }
+    with pytest.raises(ValueError):
+        parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+
+
+def test_burn_rate_windows_need_additive_statistics():
+    sli_config = {
+        "latency": {
+            "slo_target": 0.99,
+            "burn_rate_windows": ["5m", "1h"],
+            "numerator": [dict(alb_metric("TargetResponseTime"), statistic="p90")],
+            "denominator": [alb_metric("RequestCount")],
+        }
+    }
+    with pytest.raises(ValueError, match="burn_rate_windows"):
+        parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+
+
+@mock_aws
+@patch("windowed_slo.utc_now", return_value=NOON + datetime.timedelta(minutes=7))
+def test_burn_rates(utc_now, capsys):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    # The end of the last complete 5 minute period
+    end_time = NOON + datetime.timedelta(minutes=5)
+    timestamps = [
+        end_time - datetime.timedelta(minutes=30),
+        end_time - datetime.timedelta(minutes=5),
+    ]
+
+    sli_config = {
+        "availability": {
+            "window_days": 24,
+            "slo_target": 0.9,
+            "burn_rate_windows": ["1h", "5m"],
+            "numerator": [alb_metric("HTTPCode_Target_2XX_Count")],
+            "denominator": [alb_metric("RequestCount")],
+        }
+    }
+
+    def recent_query(query_id, metric_name):
+        query = metric_data_query(query_id, metric_name)
+        query["MetricStat"]["Period"] = 300
+        return query
+
+    burn_rate_response = [
+        "get_metric_data",
+        {
+            "MetricDataResults": [
+                {"Id": "m0", "Timestamps": timestamps, "Values": [90, 8]},
+                {"Id": "m1", "Timestamps": timestamps, "Values": [100, 10]},
+            ]
+        },
+        {
+            "MetricDataQueries": [
+                recent_query("m0", "HTTPCode_Target_2XX_Count"),
+                recent_query("m1", "RequestCount"),
+            ],
+            "StartTime": end_time - datetime.timedelta(hours=1),
+            "EndTime": end_time,
+        },
+    ]
+    put_response = [
+        "put_metric_data",
+        {},
+        {"MetricData": ANY, "Namespace": "test/sli"},
+    ]
+
+    with Stubber(cw) as stubber:
+        stubber.add_response(
+            *get_metric_data(
+                [("HTTPCode_Target_2XX_Count", 3), ("RequestCount", 4)],
+            )
+        )
+        stubber.add_response(*burn_rate_response)
+        stubber.add_response(*put_response)
+        # A burn rate check only fetches recent datapoints
+        stubber.add_response(*burn_rate_response)
+        stubber.add_response(*put_response)
+
+        Cloudwatch.cloudwatch_client = cw
+
+        for burn_rates_only in (False, True):
+            slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+            publish_slis(
+                slis,
+                SLI_NAMESPACE,
+                SLI_PREFIX,
+                handle_exceptions=False,
+                burn_rates_only=burn_rates_only,
+            )
+        stubber.assert_no_pending_responses()
+
+    assert capsys.readouterr().out.splitlines() == [
+        "availability: 0.750000",
+        "availability-budget-consumed: 2.500000",
+        "availability-budget-remaining: -1.500000",
+        "availability-burn-rate-5m: 2.000000",
+        "availability-burn-rate-1h: 1.090909",
+        "availability-burn-rate-5m: 2.000000",
+        "availability-burn-rate-1h: 1.090909",
+    ]
+
+
+def test_throttled_calls_are_retried(monkeypatch):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    monkeypatch.setattr(Cloudwatch, "buckets", {})
+    monkeypatch.setattr(Cloudwatch, "deadline", None)
+
+    with Stubber(cw) as stubber:
+        stubber.add_client_error(
+            "put_metric_data", service_error_code="Throttling", http_status_code=400
+        )
+        stubber.add_client_error(
+            "put_metric_data",
+            service_error_code="InternalFailure",
+            http_status_code=500,
+        )
+        stubber.add_response("put_metric_data", {}, None)
+        stubber.add_client_error(
+            "put_metric_data",
+            service_error_code="InvalidParameterValue",
+            http_status_code=400,
+        )
+
+        Cloudwatch.cloudwatch_client = cw
+
+        Cloudwatch.call("put_metric_data", Namespace=SLI_NAMESPACE, MetricData=[])
+        # Client errors other than throttling aren't retried
+        with pytest.raises(botocore.exceptions.ClientError):
+            Cloudwatch.call("put_metric_data", Namespace=SLI_NAMESPACE, MetricData=[])
+        stubber.assert_no_pending_responses()
+
+    # Two jittered backoffs, each within its cap
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.2 and 0 <= sleeps[1] <= 0.4
+    # The throttle slowed the rate limit down, then success sped it up again
+    bucket = Cloudwatch.buckets["PutMetricData"]
+    assert bucket.rate < bucket.max_rate
+
+
+def test_connection_errors_are_retried(monkeypatch):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    monkeypatch.setattr(Cloudwatch, "buckets", {})
+    monkeypatch.setattr(Cloudwatch, "deadline", None)
+    monkeypatch.setattr(
+        cw,
+        "put_metric_data",
+        MagicMock(
+            side_effect=[
+                botocore.exceptions.EndpointConnectionError(
+                    endpoint_url="https://monitoring.us-west-2.amazonaws.com"
+                ),
+                {},
+            ]
+        ),
+    )
+    monkeypatch.setattr(Cloudwatch, "cloudwatch_client", cw)
+
+    Instrumentation.reset(enabled=True)
+    try:
+        Cloudwatch.call("put_metric_data", Namespace=SLI_NAMESPACE, MetricData=[])
+        record = Instrumentation.record({"SliPrefix": SLI_PREFIX})
+    finally:
+        Instrumentation.reset(enabled=False)
+
+    assert cw.put_metric_data.call_count == 2
+    assert len(sleeps) == 1
+    assert record["PutMetricDataCalls"] == 2
+    assert record["ApiErrors"] == 1
+
+
+def test_retries_stop_at_the_deadline(monkeypatch):
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    monkeypatch.setattr(Cloudwatch, "buckets", {})
+    # Already past the deadline, so nothing that needs to wait can be done
+    monkeypatch.setattr(Cloudwatch, "deadline", time.monotonic())
+
+    with Stubber(cw) as stubber:
+        stubber.add_client_error(
+            "put_metric_data", service_error_code="Throttling", http_status_code=400
+        )
+
+        Cloudwatch.cloudwatch_client = cw
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            Cloudwatch.call("put_metric_data", Namespace=SLI_NAMESPACE, MetricData=[])
+        stubber.assert_no_pending_responses()
+
+    # Once the burst is used up, calls can't wait for the rate limit either
+    monkeypatch.setattr(Cloudwatch, "api_rate", 1)
+    monkeypatch.setattr(Cloudwatch, "buckets", {"PutMetricData": TokenBucket(1)})
+    Cloudwatch.buckets["PutMetricData"].reserve()
+    with pytest.raises(DeadlineExceededError):
+        Cloudwatch.call("put_metric_data", Namespace=SLI_NAMESPACE, MetricData=[])
+
+
+def test_token_bucket():
+    bucket = TokenBucket(max_rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Later callers queue up behind each other
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    bucket.throttled()
+    assert bucket.rate == 5
+    for _ in range(100):
+        bucket.throttled()
+    assert bucket.rate == 1
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 10
+
+
+def test_instrumentation():
+    cw = boto3.client("cloudwatch", region_name="us-west-2")
+    sli_config = {
+        "availability": {
+            "window_days": 24,
+            "numerator": [alb_metric("HTTPCode_Target_2XX_Count")],
+            "denominator": [alb_metric("RequestCount")],
+        },
+    }
+
+    with Stubber(cw) as stubber:
+        stubber.add_response(
+            *get_metric_data([("HTTPCode_Target_2XX_Count", 3), ("RequestCount", 4)])
+        )
+        stubber.add_response("put_metric_data", {}, None)
+
+        Cloudwatch.cloudwatch_client = cw
+
+        Instrumentation.reset(enabled=True)
+        try:
+            slis = parse_sli_json(json.dumps(sli_config), handle_exceptions=False)
+            publish_slis(slis, SLI_NAMESPACE, SLI_PREFIX, handle_exceptions=False)
+            record = Instrumentation.record({"SliPrefix": SLI_PREFIX})
+        finally:
+            Instrumentation.reset(enabled=False)
+        stubber.assert_no_pending_responses()
+
+    assert record["GetMetricDataCalls"] == 1
+    assert record["PutMetricDataCalls"] == 1
+    assert record["Datapoints"] == 2
+    assert record["SlisEvaluated"] == 1
+    assert "SeriesCacheHits" not in record
+    assert list(record["SliTimes"]) == ["availability"]
+    assert record["SliPrefix"] == SLI_PREFIX
+
+    (directive,) = record["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "WindowedSLO"
+    assert directive["Dimensions"] == [["SliPrefix"]]
+    names = {m["Name"] for m in directive["Metrics"]}
+    assert {"GetMetricDataCalls", "PutMetricDataCalls", "SliTime"} <= names
+    # Per-SLI timings are properties, not metrics
+    assert all(isinstance(record[name], (int, float)) for name in names)
+
+
+def test_benchmark():
+    from windowed_slo_bench import run_benchmark
+
+    result = run_benchmark(num_slis=600, fan_out=2, shared_denominators=10)
+
+    # 1200 numerators plus 20 shared denominators is three pages of queries
+    assert result["api_calls"] == {"GetMetricData": 3, "PutMetricData": 1}
+    assert set(result["phases_s"]) == {"parse", "fetch", "publish"}
+    assert result["peak_memory_bytes"] > 0
+
+
 def test_sad_config():
     # By default, blithely continue on
     with open(
@@ -25,6 +25,70 @@ variable "window_days" {
   default     = 28
 }
 
+variable "max_workers" {
+  description = <<EOM
+Number of SLIs and CloudWatch metric queries to evaluate concurrently.
+Leave at 1 to evaluate serially.
+EOM
+  type        = number
+  default     = 1
+}
+
+variable "cloudwatch_api_rate" {
+  description = <<EOM
+Most CloudWatch API calls per second to make for each API operation.
+The rate adapts downwards when CloudWatch throttles. Set to 0 for no limit.
+EOM
+  type        = number
+  default     = 20
+}
+
+variable "cloudwatch_max_attempts" {
+  description = <<EOM
+How many times to try a throttled or failed CloudWatch API call, backing
+off exponentially in between, before skipping the SLIs it was for.
+EOM
+  type        = number
+  default     = 8
+}
+
+variable "instrumentation" {
+  description = <<EOM
+Whether to log per-run instrumentation (API calls, retries, datapoints,
+cache hits and timings) as CloudWatch Embedded Metric Format records,
+published as metrics in the WindowedSLO namespace.
+EOM
+  type        = bool
+  default     = false
+}
+
+variable "rollup_cache_bucket" {
+  description = <<EOM
+(OPTIONAL) Name of an S3 bucket in which to cache daily totals of each SLI
+metric. When set, SLIs with Sum or SampleCount metrics are computed
+incrementally over the last window_days complete UTC days, and each run
+only queries CloudWatch for days missing from the cache.
+EOM
+  type        = string
+  default     = ""
+}
+
+variable "rollup_cache_prefix" {
+  description = "Key prefix for the rollup cache within rollup_cache_bucket."
+  type        = string
+  default     = "windowed_slo/"
+}
+
+variable "burn_rate_schedule_expression" {
+  description = <<EOM
+(OPTIONAL) Schedule on which to publish only the burn rates of SLIs with
+burn_rate_windows, e.g. "rate(5 minutes)". Burn rates are otherwise only
+published with the daily SLI run.
+EOM
+  type        = string
+  default     = ""
+}
+
 variable "namespace" {
   description = <<EOM
 Manually-specified CloudWatch namespace in which to insert the SLI metric
@@ -46,10 +110,24 @@ variable "sli_prefix" {
 }
 
 variable "slis" {
-  description = "SLI configuration"
+  description = <<EOM
+SLI configuration. Each SLI is published over window_days (or the global
+window_days), and also over each of the optional windows, in days, as
+"<sli_prefix>-<name>-<N>d". SLIs with windows must use Sum or SampleCount
+metrics, and are calculated over complete UTC days.
+
+With an slo_target (e.g. 0.999), the fraction of the error budget consumed
+and remaining is published as "<sli_prefix>-<name>-budget-consumed" and
+"-budget-remaining", and the burn rate over each of the burn_rate_windows
+(e.g. ["5m", "1h", "6h"]) as "<sli_prefix>-<name>-burn-rate-<window>".
+SLIs with burn_rate_windows must also use Sum or SampleCount metrics.
+EOM
   type = map(object({
-    description = optional(string)
-    window_days = optional(number)
+    description       = optional(string)
+    window_days       = optional(number)
+    windows           = optional(list(number))
+    slo_target        = optional(number)
+    burn_rate_windows = optional(list(string))
     numerator = list(object({
       namespace          = string
       metric_name        = string